@@ -0,0 +1,51 @@
+"""Benchmark of the time it takes to import the extension.
+
+IPython is imported first, since it is always already loaded in a kernel, so this
+measures the extension's own cost with `python -X importtime`.
+
+    python -m benchmarks.bench_import
+"""
+import subprocess
+import sys
+from pathlib import Path
+from statistics import median
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+SETUP = "import IPython.core.magic"
+
+
+def import_times_us(module="gpt_magic"):
+    """Cumulative import time of `module` and of each module it pulled in, in us.
+    Modules already imported by `SETUP` are excluded."""
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            f"{SETUP}; import sys; print('---', file=sys.stderr); import {module}",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=REPO_ROOT,
+    )
+    times = {}
+    for line in result.stderr.split("---\n", 1)[1].splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        times[name.strip()] = int(cumulative_us)
+    return times
+
+
+def main(repeat=5):
+    runs = [import_times_us() for _ in range(repeat)]
+    print(f"import gpt_magic: {median(r['gpt_magic'] for r in runs) / 1000:.1f} ms")
+    print("modules imported:", ", ".join(sorted(runs[-1])))
+    if "openai" in runs[-1]:
+        print("WARNING: `openai` is imported eagerly.")
+
+
+if __name__ == "__main__":
+    main()
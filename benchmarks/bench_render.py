@@ -0,0 +1,96 @@
+"""Micro-benchmark of the cost of rendering a streamed response in a notebook.
+
+Compares the previous approach (re-accumulate the string and re-display the whole
+Markdown every 100 ms, clearing the output on every chunk) with `NotebookStreamRenderer`.
+Display messages are JSON encoded, as the kernel does before sending them to the
+frontend, and time is simulated so that the results don't depend on the stream rate.
+
+    python -m benchmarks.bench_render
+
+The cost per character should stay roughly constant for the new renderer as responses
+get longer, and grow linearly for the old one.
+"""
+import json
+from time import perf_counter
+from unittest.mock import patch
+
+from gpt_magic import displays
+from gpt_magic.displays import NotebookDisplay
+
+CHUNK = "lorem "
+CHUNKS_PER_SECOND = 50
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def tick(self):
+        self.now += 1 / CHUNKS_PER_SECOND
+
+
+class FakeHandle:
+    def update(self, obj):
+        json.dumps({"text/markdown": obj.data})
+
+
+def fake_display(obj, display_id=False):
+    json.dumps({"text/markdown": obj.data})
+    return FakeHandle()
+
+
+def fake_clear_output(wait=False):
+    json.dumps({"wait": wait})
+
+
+def legacy_render(n_chunks, clock):
+    partial_resp = ""
+    t_last_update = clock()
+    for _ in range(n_chunks):
+        partial_resp += CHUNK
+        clock.tick()
+        fake_clear_output(wait=True)
+        t_now = clock()
+        if t_now - t_last_update > 0.1:
+            fake_display(displays.Markdown(partial_resp))
+            t_last_update = t_now
+    fake_clear_output(wait=False)
+
+
+def incremental_render(n_chunks, clock):
+    with patch.object(displays, "monotonic", clock), patch.object(
+        displays, "display", fake_display
+    ):
+        renderer = NotebookDisplay().stream_renderer("GPT[A0]: ")
+        for _ in range(n_chunks):
+            clock.tick()
+            renderer.feed(CHUNK)
+        renderer.finish()
+
+
+def measure(render, n_chunks, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        t_start = perf_counter()
+        render(n_chunks, FakeClock())
+        best = min(best, perf_counter() - t_start)
+    return best
+
+
+def main():
+    print(f"{'chars':>8} {'legacy us/char':>16} {'incremental us/char':>20}")
+    for n_chunks in [1_000, 4_000, 16_000]:
+        n_chars = n_chunks * len(CHUNK)
+        legacy = measure(legacy_render, n_chunks)
+        incremental = measure(incremental_render, n_chunks)
+        print(
+            f"{n_chars:>8} {legacy / n_chars * 1e6:>16.3f}"
+            f" {incremental / n_chars * 1e6:>20.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
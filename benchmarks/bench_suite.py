@@ -0,0 +1,383 @@
+"""End-to-end benchmarks of the extension's own overhead, against a local mock API.
+
+No network is used: requests go to `gpt_magic.mock_server`, so the numbers measure
+the client, parsing and rendering, not OpenAI.
+
+    python -m benchmarks.bench_suite                   # run, and compare to the baseline
+    python -m benchmarks.bench_suite --save-baseline   # run, and make this the baseline
+
+Metrics (medians over `--repeat` runs):
+
+- ttft_ms: time to first token of `Conversation.do_completion` (the `%%gpt` path),
+  with a server that answers immediately.
+- e2e_ms: time to stream a whole ~150 delta response through `do_completion`.
+- gpt_command_ms: a whole `%%gpt` command, with the shell display.
+- render_shell_ms / render_notebook_ms: time spent rendering the response within
+  `gpt_command`, with the shell or notebook display.
+- code_extraction_us: `Conversation.get_code` on a long response.
+- code_command_ms: a whole `%%gpt --code` command, with the response streamed at 500
+  deltas per second.
+- cancel_ms: time from closing a `do_completion` stream part way through (as
+  `%%gpt` does when interrupted) to the server seeing the client hang up, with the
+  response streamed at 200 deltas per second.
+- background_cancel_ms: time from cancelling a running `%%gpt --background` completion
+  to it finishing, at the same rate.
+- broker_fanout_ms: 8 threads streaming the same completion at once through a
+  `gpt_magic.broker` (one upstream request, fanned out), until the last one finishes,
+  with the response streamed at 1000 deltas per second.
+- async_throughput_rps / map_throughput_rps: completions per second with many
+  requests in flight, through `acomplete` and `gpt_map`, against a server with a fixed
+  latency and token rate.
+
+A metric which is worse than the baseline by more than `--threshold` (and by more than
+its noise floor) is reported as a regression, and the exit status is 1.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+from pathlib import Path
+from statistics import median
+from time import perf_counter, sleep
+from unittest.mock import patch
+
+os.environ.setdefault("OPENAI_API_KEY", "sk-mock")
+
+from gpt_magic import displays, gpt_command as gpt_command_module
+from gpt_magic.aio import acomplete
+from gpt_magic.api_client import parse_api_base, set_api_base, set_broker_socket
+from gpt_magic.background import run_in_background
+from gpt_magic.batch import gpt_map
+from gpt_magic.broker import Broker
+from gpt_magic.gpt_state import Conversation, GPTMagicState
+from gpt_magic.mock_server import DEFAULT_REPLY, MockOpenAIServer, MockServerConfig
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+MODEL = "gpt-3.5-turbo"
+
+# name -> (unit, higher is better, noise floor: differences smaller than this are
+# never regressions).
+METRICS = {
+    "ttft_ms": ("ms", False, 0.5),
+    "e2e_ms": ("ms", False, 1.0),
+    "gpt_command_ms": ("ms", False, 1.0),
+    "render_shell_ms": ("ms", False, 0.5),
+    "render_notebook_ms": ("ms", False, 0.5),
+    "code_extraction_us": ("us", False, 5.0),
+    "code_command_ms": ("ms", False, 5.0),
+    "cancel_ms": ("ms", False, 5.0),
+    "background_cancel_ms": ("ms", False, 5.0),
+    "broker_fanout_ms": ("ms", False, 5.0),
+    "async_throughput_rps": ("req/s", True, 5.0),
+    "map_throughput_rps": ("req/s", True, 5.0),
+}
+
+
+def _new_convo():
+    convo = Conversation("A", "You are a helpful assistant.")
+    convo.add_prompt("Plot the mean value per category.", False, [])
+    return convo
+
+
+def bench_ttft(repeat):
+    times = []
+    for _ in range(repeat):
+        convo = _new_convo()
+        t_start = perf_counter()
+        stream = convo.do_completion(MODEL, stream=True)
+        next(stream)
+        times.append(perf_counter() - t_start)
+        for _ in stream:
+            pass
+    return median(times) * 1000
+
+
+def bench_e2e(repeat):
+    times = []
+    for _ in range(repeat):
+        convo = _new_convo()
+        t_start = perf_counter()
+        for _ in convo.do_completion(MODEL, stream=True):
+            pass
+        times.append(perf_counter() - t_start)
+    return median(times) * 1000
+
+
+class _FakeHandle:
+    def update(self, obj):
+        json.dumps({"text/markdown": obj.data})
+
+
+def _fake_display(obj, display_id=False):
+    # Display messages are JSON encoded before they are sent to the frontend.
+    json.dumps({"text/markdown": getattr(obj, "data", str(obj))})
+    return _FakeHandle()
+
+
+class _TimedRenderer:
+    """Wraps a stream renderer, adding up the time spent in it."""
+
+    def __init__(self, renderer, timings):
+        self._renderer = renderer
+        self._timings = timings
+
+    def feed(self, delta):
+        t_start = perf_counter()
+        self._renderer.feed(delta)
+        self._timings.append(perf_counter() - t_start)
+
+    def finish(self, *args, **kwargs):
+        t_start = perf_counter()
+        self._renderer.finish(*args, **kwargs)
+        self._timings.append(perf_counter() - t_start)
+
+
+def bench_gpt_command(repeat, display_class):
+    """Median time of a whole `%%gpt` command, and of the rendering within it."""
+    state = GPTMagicState()
+    timings = []
+
+    def get_display():
+        ipy_display = display_class()
+        make_renderer = ipy_display.stream_renderer
+
+        def stream_renderer(*args, **kwargs):
+            t_start = perf_counter()
+            renderer = make_renderer(*args, **kwargs)
+            timings.append(perf_counter() - t_start)
+            return _TimedRenderer(renderer, timings)
+
+        ipy_display.stream_renderer = stream_renderer
+        return ipy_display
+
+    totals, render_times = [], []
+    with patch.object(
+        gpt_command_module, "get_registered_display", get_display
+    ), patch.object(displays, "display", _fake_display), contextlib.redirect_stdout(
+        io.StringIO()
+    ):
+        for _ in range(repeat):
+            timings.clear()
+            t_start = perf_counter()
+            gpt_command_module.gpt_command(state, "--no-cache 'Plot it.'")
+            totals.append(perf_counter() - t_start)
+            render_times.append(sum(timings))
+    return median(totals) * 1000, median(render_times) * 1000
+
+
+def bench_code_command(repeat):
+    """Median time of a whole `%%gpt --code` command."""
+    state = GPTMagicState()
+    times = []
+    with patch.object(
+        gpt_command_module, "get_ipython", create=True
+    ), contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            t_start = perf_counter()
+            gpt_command_module.gpt_command(state, "--code --no-cache 'Plot it.'")
+            times.append(perf_counter() - t_start)
+    return median(times) * 1000
+
+
+def bench_cancel(repeat, server):
+    """Median time from closing a stream to the server seeing the hang-up."""
+    times = []
+    for _ in range(repeat):
+        server.disconnected.clear()
+        stream = _new_convo().do_completion(MODEL, stream=True)
+        next(stream)
+        t_start = perf_counter()
+        stream.close()
+        server.disconnected.wait(timeout=5)
+        times.append(perf_counter() - t_start)
+    return median(times) * 1000
+
+
+def bench_background_cancel(repeat):
+    """Median time from cancelling a streaming background completion to it ending."""
+    state = GPTMagicState()
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            convo = state.get_convo((None, None))
+            completion = run_in_background(
+                state, convo, "Plot it.", [], MODEL, displays.ShellDisplay()
+            )
+            while convo.head is None or not completion.running():
+                sleep(0.001)
+            # Let a few deltas arrive.
+            sleep(0.02)
+            t_start = perf_counter()
+            completion.cancel()
+            completion.exception(timeout=5)
+            times.append(perf_counter() - t_start)
+    return median(times) * 1000
+
+
+def bench_broker_fanout(repeat, server, n_kernels=8):
+    """Median time for `n_kernels` threads to stream the same completion through the
+    broker."""
+    socket_path = os.path.join(tempfile.mkdtemp(), "broker.sock")
+    times = []
+    with Broker(socket_path, parse_api_base(server.url)):
+        set_broker_socket(socket_path)
+        try:
+            for _ in range(repeat):
+                kernels = [
+                    threading.Thread(
+                        target=lambda: list(
+                            _new_convo().do_completion(MODEL, stream=True)
+                        )
+                    )
+                    for _ in range(n_kernels)
+                ]
+                t_start = perf_counter()
+                for kernel in kernels:
+                    kernel.start()
+                for kernel in kernels:
+                    kernel.join()
+                times.append(perf_counter() - t_start)
+        finally:
+            set_broker_socket(None)
+    return median(times) * 1000
+
+
+def bench_code_extraction(repeat):
+    convo = _new_convo()
+    convo.add_response(DEFAULT_REPLY * 50)
+    times = []
+    for _ in range(repeat * 10):
+        t_start = perf_counter()
+        convo.get_code()
+        times.append(perf_counter() - t_start)
+    return median(times) * 1e6
+
+
+def bench_async_throughput(n_requests):
+    async def run():
+        await asyncio.gather(
+            *[acomplete(f"Question {i}", use_cache=False) for i in range(n_requests)]
+        )
+
+    t_start = perf_counter()
+    asyncio.run(run())
+    return n_requests / (perf_counter() - t_start)
+
+
+def bench_map_throughput(n_requests):
+    t_start = perf_counter()
+    gpt_map(
+        range(n_requests),
+        "Question {item}",
+        concurrency=16,
+        use_cache=False,
+        progress=False,
+        errors="raise",
+    )
+    return n_requests / (perf_counter() - t_start)
+
+
+def run_benchmarks(repeat=9, n_requests=64):
+    results = {}
+    with MockOpenAIServer() as server:
+        set_api_base(server.url)
+        # Warm up imports and the connection pool.
+        bench_e2e(1)
+        results["ttft_ms"] = bench_ttft(repeat)
+        results["e2e_ms"] = bench_e2e(repeat)
+        results["gpt_command_ms"], results["render_shell_ms"] = bench_gpt_command(
+            repeat, displays.ShellDisplay
+        )
+        _, results["render_notebook_ms"] = bench_gpt_command(
+            repeat, displays.NotebookDisplay
+        )
+    results["code_extraction_us"] = bench_code_extraction(repeat)
+
+    # Streamed at a realistic rate, so stopping after the code block saves time.
+    with MockOpenAIServer(MockServerConfig(tokens_per_second=500)) as server:
+        set_api_base(server.url)
+        results["code_command_ms"] = bench_code_command(max(3, repeat // 3))
+
+    with MockOpenAIServer(MockServerConfig(tokens_per_second=200)) as server:
+        set_api_base(server.url)
+        results["cancel_ms"] = bench_cancel(repeat, server)
+        results["background_cancel_ms"] = bench_background_cancel(repeat)
+
+    with MockOpenAIServer(MockServerConfig(tokens_per_second=1000)) as server:
+        results["broker_fanout_ms"] = bench_broker_fanout(repeat, server)
+
+    # A server which is slow to answer, so throughput depends on concurrency.
+    config = MockServerConfig(latency=0.05, tokens_per_second=1000)
+    with MockOpenAIServer(config) as server:
+        set_api_base(server.url)
+        results["async_throughput_rps"] = bench_async_throughput(n_requests)
+        results["map_throughput_rps"] = bench_map_throughput(n_requests)
+    return results
+
+
+def find_regressions(results, baseline, threshold):
+    """Names of the metrics which got worse than `baseline` by more than `threshold`
+    (a fraction) and by more than the metric's noise floor."""
+    regressions = []
+    for name, value in results.items():
+        if name not in baseline:
+            continue
+        _, higher_is_better, noise_floor = METRICS[name]
+        old = baseline[name]
+        worse_by = old - value if higher_is_better else value - old
+        if worse_by > noise_floor and worse_by > threshold * abs(old):
+            regressions.append(name)
+    return regressions
+
+
+def report(results, baseline, regressions):
+    print(f"{'metric':<22} {'value':>12} {'baseline':>12} {'change':>8}")
+    for name, value in results.items():
+        unit = METRICS[name][0]
+        line = f"{name:<22} {value:>8.2f} {unit:<5}"
+        if name in baseline:
+            old = baseline[name]
+            change = (value - old) / old * 100 if old else 0.0
+            line += f" {old:>8.2f} {unit:<5} {change:>+7.1f}%"
+        if name in regressions:
+            line += "  REGRESSION"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.bench_suite")
+    parser.add_argument("--repeat", type=int, default=9)
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="Relative slowdown reported as a regression (default 0.2, i.e. 20%%).",
+    )
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.repeat, args.requests)
+
+    baseline = {}
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+    regressions = find_regressions(results, baseline, args.threshold)
+    report(results, baseline, regressions)
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"Saved baseline to {args.baseline}")
+    elif regressions:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,42 @@
+import importlib
 import os
+import threading
 
 from IPython.core.magic import Magics, cell_magic, line_magic, magics_class
-from .gpt_state import GPTMagicState
-from .gpt_command import gpt_command
 
-from .displays import get_registered_display
-from .subcommands import ChatCommand, ChatModelsBrowserCommand, ConfigCommand
+# Everything else (in particular `openai`) is imported on first use, so that loading
+# the extension, which happens on every kernel start, is fast.
+_LAZY_ATTRIBUTES = {
+    "GPTMagicState": ".gpt_state",
+    "acomplete": ".aio",
+    "astream": ".aio",
+    "gpt_map": ".batch",
+    "get_registered_display": ".displays",
+    "get_metrics_recorder": ".metrics",
+    "preconnect_in_background": ".api_client",
+    "set_broker_socket": ".api_client",
+    "ChatCommand": ".subcommands",
+    "ChatModelsBrowserCommand": ".subcommands",
+    "ConfigCommand": ".subcommands",
+}
+
+_state = None
+_state_lock = threading.Lock()
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        return getattr(importlib.import_module(_LAZY_ATTRIBUTES[name], __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-_state = GPTMagicState()
 
 def get_GPTMagicState():
     global _state
+    with _state_lock:
+        if _state is None:
+            from .gpt_state import GPTMagicState
+
+            _state = GPTMagicState()
     return _state
 
 @magics_class
@@ -18,20 +44,29 @@ class IPythonGPT(Magics):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        # self._context = {
-        #     "config": {
-        #         "openai_api_key":
-        #         os.environ.get("OPENAI_API_KEY")
-        #         or globals().get("OPENAI_API_KEY"),
-        #         "default_model":
-        #         "gpt-3.5-turbo",
-        #         "default_system_message":
-        #         "You are a python data science coding assistant",
-        #     },
-        #     "message_history": [],
-        # }
-        # self.display = get_registered_display()
-        self.state = get_GPTMagicState()
+        # Config and history of the `%chat` magics, set up on first use.
+        self._chat_context = None
+
+    @property
+    def _context(self):
+        if self._chat_context is None:
+            self._chat_context = {
+                "config": {
+                    "openai_api_key": os.environ.get("OPENAI_API_KEY"),
+                    "default_model": self.state.default_model,
+                    "default_system_message": self.state.default_system_message,
+                },
+                "message_history": [],
+            }
+        return self._chat_context
+
+    @property
+    def display(self):
+        return self.state.display
+
+    @property
+    def state(self):
+        return get_GPTMagicState()
 
     @cell_magic
     @line_magic
@@ -48,22 +83,49 @@ class IPythonGPT(Magics):
           %%gpt --code <prompt>
             Generate executable Python code based on <prompt> and put in this cell.
         """
-        gpt_command(self.state, line, cell)
+        from .gpt_command import gpt_command
+
+        return gpt_command(self.state, line, cell)
+
+    @cell_magic
+    @line_magic
+    def gpt_map(self, line, cell=None):
+        """
+        Apply a prompt template to every item of an iterable or pandas Series.
+
+        Run `%gpt_map --help` for more information.
+
+        Usage:
+          %gpt_map <items> "<template>"
+          %%gpt_map <items>
+          <template>
+            `{}` in the template is replaced by each item. Returns the responses in
+            input order.
+        """
+        from .batch import gpt_map_command
+
+        return gpt_map_command(self.shell, line, cell)
 
     @cell_magic
     def chat(self, line, cell):
+        from .subcommands import ChatCommand
+
         cmd = ChatCommand(self._context)
         result = cmd.execute(line, cell)
         self.display.display(result)
 
     @line_magic
     def chat_config(self, line):
+        from .subcommands import ConfigCommand
+
         cmd = ConfigCommand(self._context)
         result = cmd.execute(line)
         self.display.display(result)
 
     @line_magic
     def chat_models(self, line):
+        from .subcommands import ChatModelsBrowserCommand
+
         cmd = ChatModelsBrowserCommand(self._context)
         result = cmd.execute(line)
         self.display.display(result)
@@ -72,5 +134,30 @@ class IPythonGPT(Magics):
 name = "ipython_gpt"
 
 
+def _preconnect_on_load() -> bool:
+    """`GPTMagicState.preconnect_on_load` if the state was set up before the extension
+    was loaded, otherwise the `GPT_MAGIC_PRECONNECT` environment variable ("1" to
+    enable)."""
+    if _state is not None:
+        return _state.preconnect_on_load
+    return os.environ.get("GPT_MAGIC_PRECONNECT", "0") == "1"
+
+
+def _preconnect():
+    # Only the API client, the rest of the extension is imported by the first magic.
+    from .api_client import get_connection_pool, get_request_target
+
+    host, port, use_tls = get_request_target()
+    get_connection_pool().preconnect(host, port, use_tls=use_tls)
+
+
 def load_ipython_extension(ipython):
     ipython.register_magics(IPythonGPT)
+    if _preconnect_on_load():
+        # Open a keep-alive connection off the critical path, so that a `%chat` request
+        # soon after loading skips the handshakes. Opt-in: `%%gpt` goes through
+        # `openai`'s own connections, and an unused one is dropped after
+        # `MAX_IDLE_SECONDS`.
+        threading.Thread(
+            target=_preconnect, name="gpt-magic-preconnect", daemon=True
+        ).start()
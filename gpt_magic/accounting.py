@@ -0,0 +1,208 @@
+"""Token accounting, and budgets which stop runaway notebooks before they send requests.
+
+Every completion which reaches the API (through `Conversation` or the `%chat` command)
+is counted, from the response's `usage` when it has one, or else counted locally (see
+`tokens`), as streamed responses don't include it. Usage is aggregated for the session,
+each conversation and each model, see `%gpt --usage`.
+
+    get_GPTMagicState().accountant.budget = TokenBudget(
+        max_session_tokens=200_000,
+        max_conversation_tokens=50_000,
+        # Send requests to a cheaper model once 80% of a budget is used.
+        downgrade_at=0.8,
+    )
+
+Budgets are checked before each request, with its prompt (and `max_tokens`, if set), so
+the completion of the last request admitted may go over.
+"""
+import threading
+from dataclasses import dataclass, replace
+from typing import Dict, List, Mapping, Optional
+
+from .tokens import count_message_tokens, count_tokens
+
+# `%gpt --usage` lists the conversations which used the most tokens.
+MAX_LISTED_CONVERSATIONS = 10
+
+
+class BudgetExceeded(Exception):
+    """A request was blocked, as it would have gone over a `TokenBudget`."""
+
+
+@dataclass
+class TokenUsage:
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, prompt_tokens: int, completion_tokens: int):
+        self.requests += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+
+    def describe(self) -> str:
+        return (
+            f"{self.total_tokens} tokens ({self.prompt_tokens} prompt,"
+            f" {self.completion_tokens} completion) in {self.requests} requests"
+        )
+
+
+@dataclass
+class TokenBudget:
+    # Requests which would take the session's or a conversation's tokens (prompt +
+    # completion) over these are blocked. None for no limit.
+    max_session_tokens: Optional[int] = None
+    max_conversation_tokens: Optional[int] = None
+    # Once either budget is this far (a fraction) used up, requests are sent to
+    # `downgrade_model` instead. None to never downgrade.
+    downgrade_at: Optional[float] = None
+    downgrade_model: str = "gpt-3.5-turbo"
+
+
+def usage_counts(usage: Optional[Mapping], messages: List[Dict], completion: str):
+    """(prompt tokens, completion tokens) of a request, from the response's `usage` if
+    there is one, or else counted locally."""
+    if usage:
+        return usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+    return count_message_tokens(messages), count_tokens(completion)
+
+
+class TokenAccountant:
+    """Tokens used by the session, by conversation and by model, and the budget which
+    admits requests."""
+
+    def __init__(self, budget: Optional[TokenBudget] = None):
+        self.budget = budget or TokenBudget()
+        self._lock = threading.Lock()
+        self._session = TokenUsage()
+        self._conversations: Dict[str, TokenUsage] = {}
+        self._models: Dict[str, TokenUsage] = {}
+        # Requests blocked, and sent to the downgrade model, by the budget.
+        self.blocked = 0
+        self.downgraded = 0
+
+    def usage(self, convo_key: Optional[str] = None) -> TokenUsage:
+        """A copy of the session's usage, or of conversation `convo_key`'s."""
+        with self._lock:
+            if convo_key is None:
+                return replace(self._session)
+            return replace(self._conversations.get(convo_key, TokenUsage()))
+
+    def model_usage(self) -> Dict[str, TokenUsage]:
+        with self._lock:
+            return {model: replace(u) for model, u in self._models.items()}
+
+    def admit(
+        self, model: str, request_tokens: int, convo_key: Optional[str] = None
+    ) -> str:
+        """The model to send a request of about `request_tokens` tokens with: `model`,
+        or the budget's downgrade model. Raises `BudgetExceeded` if the request would
+        go over the budget."""
+        budget = self.budget
+        with self._lock:
+            scopes = [("session", budget.max_session_tokens, self._session)]
+            if convo_key is not None:
+                used = self._conversations.get(convo_key, TokenUsage())
+                scopes.append(
+                    (f"conversation {convo_key}", budget.max_conversation_tokens, used)
+                )
+            used_fraction = 0.0
+            for scope, limit, usage in scopes:
+                if limit is None:
+                    continue
+                if usage.total_tokens + request_tokens > limit:
+                    self.blocked += 1
+                    raise BudgetExceeded(
+                        f"Request blocked: the {scope} has used {usage.total_tokens}"
+                        f" of its {limit} token budget, and the request needs about"
+                        f" {request_tokens} more."
+                    )
+                used_fraction = max(
+                    used_fraction, (usage.total_tokens + request_tokens) / limit
+                )
+            if (
+                budget.downgrade_at is not None
+                and used_fraction >= budget.downgrade_at
+                and model != budget.downgrade_model
+            ):
+                self.downgraded += 1
+                return budget.downgrade_model
+        return model
+
+    def record(
+        self,
+        convo_key: Optional[str],
+        model: str,
+        prompt_tokens: int,
+        completion_tokens: int,
+    ):
+        with self._lock:
+            self._session.add(prompt_tokens, completion_tokens)
+            self._models.setdefault(model, TokenUsage()).add(
+                prompt_tokens, completion_tokens
+            )
+            if convo_key is not None:
+                self._conversations.setdefault(convo_key, TokenUsage()).add(
+                    prompt_tokens, completion_tokens
+                )
+
+    def reset(self):
+        with self._lock:
+            self._session = TokenUsage()
+            self._conversations.clear()
+            self._models.clear()
+            self.blocked = 0
+            self.downgraded = 0
+
+    def format_usage(self) -> str:
+        """Usage and budget, as shown by `%gpt --usage`."""
+        with self._lock:
+            session = replace(self._session)
+            models = sorted(self._models.items())
+            conversations = sorted(
+                self._conversations.items(), key=lambda item: -item[1].total_tokens
+            )
+        lines = [f"Session: {session.describe()}"]
+
+        budget = self.budget
+        limits = [
+            f"{limit} tokens per {scope}"
+            for scope, limit in (
+                ("session", budget.max_session_tokens),
+                ("conversation", budget.max_conversation_tokens),
+            )
+            if limit is not None
+        ]
+        if limits:
+            line = f"Budget: {', '.join(limits)}"
+            if budget.downgrade_at is not None:
+                line += (
+                    f", {budget.downgrade_model} once {budget.downgrade_at:.0%} used"
+                )
+            lines.append(
+                line + f" ({self.blocked} blocked, {self.downgraded} downgraded)"
+            )
+
+        for title, rows in (
+            ("By model:", models),
+            ("By conversation:", conversations[:MAX_LISTED_CONVERSATIONS]),
+        ):
+            if rows:
+                lines.append(title)
+                lines += [f"  {name}: {usage.describe()}" for name, usage in rows]
+        if len(conversations) > MAX_LISTED_CONVERSATIONS:
+            lines.append(
+                f"  ... and {len(conversations) - MAX_LISTED_CONVERSATIONS} more"
+            )
+        return "\n".join(lines)
+
+
+_token_accountant = TokenAccountant()
+
+
+def get_token_accountant() -> TokenAccountant:
+    return _token_accountant
@@ -0,0 +1,59 @@
+"""Programmatic async API.
+
+These coroutines run on the caller's event loop (e.g. the one IPython kernels use for
+top level `await`), so many conversations can be driven concurrently:
+
+    results = await asyncio.gather(*[acomplete(p) for p in prompts])
+"""
+from typing import AsyncIterator, Optional
+
+from .api_client import AsyncOpenAIClient
+from .gpt_state import GPTMagicState
+
+
+def _get_state() -> GPTMagicState:
+    from . import get_GPTMagicState
+
+    return get_GPTMagicState()
+
+
+async def astream(
+    prompt: str,
+    followup: Optional[str] = None,
+    model: Optional[str] = None,
+    code: bool = False,
+    temperature: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+    use_cache: bool = True,
+    client: Optional[AsyncOpenAIClient] = None,
+) -> AsyncIterator[str]:
+    """Send `prompt` to GPT and yield the response as it is streamed back.
+
+    Args:
+        prompt: The user message.
+        followup: Conversation to continue, with the same meaning as `%%gpt -f`.
+            None starts a new conversation.
+        model: Defaults to the state's `default_model`.
+        code: Ask for code, as with `%%gpt --code`.
+        use_cache: Answer from the response cache if possible.
+    """
+    state = _get_state()
+    convo = state.get_convo(state.parse_followup_key(followup))
+    # The reply goes to this prompt, even if the conversation's head has moved on by
+    # the time it is complete.
+    node = convo.add_prompt(prompt, code, [])
+
+    async for delta in convo.ado_completion(
+        model or state.default_model,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        cache=state.response_cache if use_cache else None,
+        client=client,
+        node=node,
+    ):
+        yield delta
+
+
+async def acomplete(prompt: str, **kwargs) -> str:
+    """Like `astream`, but return the whole response once it is complete."""
+    return "".join([delta async for delta in astream(prompt, **kwargs)])
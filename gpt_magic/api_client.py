@@ -1,10 +1,55 @@
+import asyncio
 import http.client
 import json
+import os
+import re
+import socket
+import ssl
+import sys
+import threading
 import urllib.parse
+import warnings
+from collections import defaultdict
+from itertools import count
+from time import monotonic
+from typing import NamedTuple
+
+from .metrics import RequestMetrics, get_metrics_recorder
+from .retry import (
+    call_with_retry,
+    estimate_request_tokens,
+    get_rate_limiter,
+    get_retry_policy,
+)
 
 OPEN_AI_API_HOST = "api.openai.com"
 OPEN_AI_API_PORT = 443
 DEFAULT_API_VERSION = "v1"
+DEFAULT_API_BASE = f"https://{OPEN_AI_API_HOST}/{DEFAULT_API_VERSION}"
+
+# Path of the Unix socket of a `gpt_magic.broker`. When set, requests go through the
+# broker instead of straight to the API.
+BROKER_SOCKET_ENV = "GPT_MAGIC_BROKER_SOCKET"
+# Host header of requests sent to the broker, which doesn't look at it.
+BROKER_HOST = "gpt-magic-broker"
+
+# Servers close keep-alive sockets which have been idle for a while. Rather than finding
+# out the hard way, stop reusing connections once they have been idle this long.
+MAX_IDLE_SECONDS = 60.0
+MAX_IDLE_PER_HOST = 4
+# Give up connecting after this long, e.g. on a network which drops traffic to the API.
+# Once connected, each read may wait longer, for a slow completion.
+CONNECT_TIMEOUT_SECONDS = 10.0
+READ_TIMEOUT_SECONDS = 600.0
+
+# Errors which indicate the server closed a kept-alive connection under our feet.
+_STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    BrokenPipeError,
+    ConnectionResetError,
+    ConnectionAbortedError,
+)
 
 
 class APIClientException(Exception):
@@ -13,23 +58,390 @@ class APIClientException(Exception):
 
 class APIResponseException(APIClientException):
 
-    def __init__(self, method, path, headers, query_params, body, resp_body):
+    def __init__(self,
+                 method,
+                 path,
+                 headers,
+                 query_params,
+                 body,
+                 resp_body,
+                 status=None,
+                 resp_headers=None):
         self.method = method
         self.path = path
         self.headers = headers
         self.query_params = query_params
         self.body = body
         self.resp_body = resp_body
+        self.status = status
+        self.resp_headers = resp_headers
 
     def __str__(self):
         return f"Failed API Request '{self.method} {self.path} {self.resp_body.decode()}'"
 
 
+class APIBase(NamedTuple):
+    """Where API requests are sent, e.g. a local mock server instead of OpenAI.
+
+    `path_prefix` is the part of the URL's path before the API version, e.g. "/openai"
+    for a proxy at "https://example.com/openai/v1".
+    """
+    host: str
+    port: int
+    use_tls: bool = True
+    path_prefix: str = ""
+
+    @property
+    def url(self):
+        scheme = "https" if self.use_tls else "http"
+        return (f"{scheme}://{self.host}:{self.port}{self.path_prefix}"
+                f"/{DEFAULT_API_VERSION}")
+
+    @property
+    def target(self):
+        """`(host, port, use_tls)`, as connected to by `ConnectionPool`."""
+        return self.host, self.port, self.use_tls
+
+
+_API_VERSION_SEGMENT = re.compile(r"/v\d+$")
+
+
+def parse_api_base(url):
+    """Parse an `OPENAI_API_BASE` style URL, like "http://127.0.0.1:8000/v1"."""
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError(f"Invalid API base URL: '{url}'")
+    use_tls = parts.scheme == "https"
+    # Requests add the API version themselves.
+    path_prefix = _API_VERSION_SEGMENT.sub("", parts.path.rstrip("/"))
+    return APIBase(parts.hostname, parts.port or (443 if use_tls else 80),
+                   use_tls, path_prefix)
+
+
+# Shares the environment variable used by the `openai` package, so that both the
+# `%%gpt` magic and the `%chat` commands talk to the same server. Parsed on first use.
+_api_base = None
+
+
+def get_api_base():
+    global _api_base
+    if _api_base is None:
+        url = os.environ.get("OPENAI_API_BASE") or DEFAULT_API_BASE
+        try:
+            _api_base = parse_api_base(url)
+        except ValueError as e:
+            warnings.warn(f"{e}, using {DEFAULT_API_BASE} instead.")
+            _api_base = parse_api_base(DEFAULT_API_BASE)
+    return _api_base
+
+
+def set_api_base(url):
+    """Send all subsequent requests to `url`, e.g. "http://127.0.0.1:8000/v1"."""
+    global _api_base
+    _api_base = parse_api_base(url)
+    os.environ["OPENAI_API_BASE"] = url
+    if "openai" in sys.modules:
+        # Otherwise the environment variable is read when `openai` is imported.
+        sys.modules["openai"].api_base = url
+
+
+_broker_socket = os.environ.get(BROKER_SOCKET_ENV) or None
+
+
+def get_broker_socket():
+    return _broker_socket
+
+
+def set_broker_socket(path):
+    """Send all subsequent requests through the broker listening on `path`, or
+    straight to the API again if `path` is None."""
+    global _broker_socket
+    _broker_socket = path
+    if path is None:
+        os.environ.pop(BROKER_SOCKET_ENV, None)
+    else:
+        os.environ[BROKER_SOCKET_ENV] = path
+    if "openai" in sys.modules:
+        configure_openai()
+
+
+def call_api_with_retry(fn, tokens=0, on_retry=None):
+    """`call_with_retry`, for requests from the kernel. Requests which go through the
+    broker are sent once, as the broker retries them, within the rate limits shared by
+    all the kernels."""
+    if _broker_socket is not None:
+        return fn()
+    return call_with_retry(fn, tokens=tokens, on_retry=on_retry)
+
+
+def get_request_target(api_base=None):
+    """`(host, port, use_tls)` to connect to for requests to `api_base`. The port is
+    None for the broker, in which case the host is the path of its socket."""
+    if _broker_socket is not None:
+        return _broker_socket, None, False
+    return (api_base or get_api_base()).target
+
+
+_ssl_context = None
+
+
+def get_ssl_context():
+    """TLS context shared by API connections. Created once, as it loads the system's CA
+    certificates."""
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP over a Unix socket, e.g. to the broker."""
+
+    def __init__(self, socket_path, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        super().__init__(BROKER_HOST, timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class _TimeoutsMixin:
+    """Connects within `timeout`, then waits up to `read_timeout` for each read."""
+
+    def __init__(self, *args, read_timeout=READ_TIMEOUT_SECONDS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.read_timeout = read_timeout
+
+    def connect(self):
+        super().connect()
+        self.sock.settimeout(self.read_timeout)
+
+
+class _HTTPConnection(_TimeoutsMixin, http.client.HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_TimeoutsMixin, http.client.HTTPSConnection):
+    pass
+
+
+def _make_openai_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3 import HTTPConnectionPool
+    from urllib3.connection import HTTPConnection
+
+    class BrokerConnection(HTTPConnection):
+
+        def __init__(self, *args, socket_path, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.socket_path = socket_path
+
+        def _new_conn(self):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            if isinstance(self.timeout, (int, float)):
+                sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            return sock
+
+    class BrokerConnectionPool(HTTPConnectionPool):
+        ConnectionCls = BrokerConnection
+
+    class BrokerAdapter(HTTPAdapter):
+        """Sends every request to the broker, whatever its URL, while one is in use.
+        Decided for each request, as `openai` keeps its sessions for a while."""
+
+        def __init__(self):
+            super().__init__()
+            self._broker_pools = {}
+
+        def _broker_pool(self):
+            socket_path = _broker_socket
+            if socket_path is None:
+                return None
+            if socket_path not in self._broker_pools:
+                self._broker_pools[socket_path] = BrokerConnectionPool(
+                    BROKER_HOST, maxsize=MAX_IDLE_PER_HOST, socket_path=socket_path)
+            return self._broker_pools[socket_path]
+
+        def get_connection_with_tls_context(self, request, verify, proxies=None,
+                                            cert=None):
+            return self._broker_pool() or super().get_connection_with_tls_context(
+                request, verify, proxies, cert)
+
+        def get_connection(self, url, proxies=None):
+            return self._broker_pool() or super().get_connection(url, proxies)
+
+        def cert_verify(self, conn, url, verify, cert):
+            if not isinstance(conn, BrokerConnectionPool):
+                super().cert_verify(conn, url, verify, cert)
+
+        def close(self):
+            super().close()
+            for pool in self._broker_pools.values():
+                pool.close()
+
+    session = requests.Session()
+    adapter = BrokerAdapter()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def configure_openai():
+    """Have the `openai` package send its requests through the broker, while one is
+    in use.
+
+    Call before making requests with `openai`: unlike the API base, the package
+    doesn't pick the broker up from the environment.
+    """
+    import openai
+
+    if _broker_socket is not None and openai.requestssession is None:
+        openai.requestssession = _make_openai_session
+
+
+class ConnectionPool:
+    """Thread-safe pool of keep-alive HTTP(S) connections, keyed by (host, port).
+
+    A port of None means the host is the path of a Unix socket, as for the broker.
+
+    Connections are checked out with `acquire` and handed back with `release` once the
+    response has been fully read. A connection which has been idle for longer than
+    `max_idle_seconds` is closed instead of being reused.
+    """
+
+    def __init__(
+        self,
+        max_idle_per_host=MAX_IDLE_PER_HOST,
+        max_idle_seconds=MAX_IDLE_SECONDS,
+        connect_timeout=CONNECT_TIMEOUT_SECONDS,
+        read_timeout=READ_TIMEOUT_SECONDS,
+    ):
+        self.max_idle_per_host = max_idle_per_host
+        self.max_idle_seconds = max_idle_seconds
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._lock = threading.Lock()
+        # (host, port) -> [(connection, time it was released), ...]
+        self._idle = defaultdict(list)
+
+    def _new_connection(self, host, port, use_tls=True):
+        if port is None:
+            return UnixHTTPConnection(host)
+        timeouts = {"timeout": self.connect_timeout, "read_timeout": self.read_timeout}
+        if not use_tls:
+            return _HTTPConnection(host=host, port=port, **timeouts)
+        return _HTTPSConnection(
+            host=host, port=port, context=get_ssl_context(), **timeouts
+        )
+
+    def acquire(self, host, port, use_tls=True):
+        """Return `(connection, reused)` for the given host.
+
+        `reused` is True if the connection has been used before, in which case the
+        server may have silently closed it and the caller should be ready to retry.
+        """
+        now = monotonic()
+        stale = []
+        conn = None
+        with self._lock:
+            idle = self._idle[(host, port)]
+            while idle:
+                candidate, t_released = idle.pop()
+                if now - t_released <= self.max_idle_seconds:
+                    conn = candidate
+                    break
+                stale.append(candidate)
+
+        for c in stale:
+            c.close()
+
+        if conn is not None:
+            return conn, True
+        return self._new_connection(host, port, use_tls), False
+
+    def release(self, host, port, conn):
+        """Return a connection to the pool so it can be reused."""
+        with self._lock:
+            idle = self._idle[(host, port)]
+            if len(idle) < self.max_idle_per_host:
+                idle.append((conn, monotonic()))
+                return
+        conn.close()
+
+    def preconnect(self, host, port, n=1, use_tls=True):
+        """Open `n` connections to the host (TCP + TLS) and park them in the pool."""
+        for _ in range(n):
+            conn = self._new_connection(host, port, use_tls)
+            try:
+                conn.connect()
+            except OSError:
+                conn.close()
+                return
+            self.release(host, port, conn)
+
+    def clear(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle = [c for conns in self._idle.values() for c, _ in conns]
+            self._idle.clear()
+        for conn in idle:
+            conn.close()
+
+
+_connection_pool = ConnectionPool()
+
+
+def get_connection_pool():
+    return _connection_pool
+
+
+def preconnect_in_background(api_base=None, n=1):
+    """Warm up the shared connection pool on a daemon thread.
+
+    This lets the first request of a session skip the TCP and TLS handshakes.
+    """
+    host, port, use_tls = get_request_target(api_base)
+    thread = threading.Thread(
+        target=_connection_pool.preconnect,
+        args=(host, port, n, use_tls),
+        name="gpt-magic-preconnect",
+        daemon=True,
+    )
+    thread.start()
+    return thread
+
+
 class OpenAIClient:
 
-    def __init__(self, openai_api_key, api_version=DEFAULT_API_VERSION):
+    def __init__(
+        self,
+        openai_api_key,
+        api_version=DEFAULT_API_VERSION,
+        connection_pool=None,
+        api_base=None,
+        metrics=None,
+    ):
         self.openai_api_key = openai_api_key
         self.api_version = api_version
+        self.connection_pool = connection_pool or _connection_pool
+        self.api_base = api_base or get_api_base()
+        self.metrics = metrics or get_metrics_recorder()
+        # Requests go through the broker, if one is in use.
+        self.target = get_request_target(self.api_base)
 
     def request(self,
                 method,
@@ -42,9 +454,6 @@ class OpenAIClient:
         assert not path.startswith(
             "/v"), "API Version must be specified at moment of client creation"
 
-        connection = http.client.HTTPSConnection(host=OPEN_AI_API_HOST,
-                                                 port=OPEN_AI_API_PORT)
-
         headers = headers or {}
         headers.setdefault("Authorization", f"Bearer {self.openai_api_key}")
         headers.setdefault("Content-Type", "application/json")
@@ -53,20 +462,298 @@ class OpenAIClient:
         if json_body:
             body = json.dumps(json_body)
 
-        path = f"/{self.api_version}" + path
+        path = f"{self.api_base.path_prefix}/{self.api_version}" + path
         if query_params is not None:
             path += "?" + urllib.parse.urlencode(query_params)
 
+        metrics = RequestMetrics("api", f"{method} {path}",
+                                 (json_body or {}).get("model"))
+
+        def send():
+            resp, resp_body = self._send(method, path, body, headers, metrics)
+            if not 200 <= resp.status < 300:
+                raise APIResponseException(method, path, headers, query_params,
+                                           body, resp_body, resp.status,
+                                           resp.headers)
+            get_rate_limiter().update_from_headers(resp.headers)
+            return resp_body
+
+        error = None
+        try:
+            resp_body = call_api_with_retry(
+                send,
+                tokens=estimate_request_tokens(json_body),
+                on_retry=metrics.count_retry)
+            metrics.chunks = 1
+            metrics.bytes = len(resp_body or b"")
+            if resp_body and len(resp_body) > 0:
+                resp = json.loads(resp_body.decode("utf-8"))
+                if isinstance(resp, dict) and "usage" in resp:
+                    metrics.output_tokens = resp["usage"].get(
+                        "completion_tokens", 0)
+                return resp
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            metrics.finish(error)
+            self.metrics.record(metrics)
+
+    def _send(self, method, path, body, headers, metrics=None):
+        """Send a request over a pooled connection and read the whole response."""
+        pool = self.connection_pool
+        host, port, _ = self.target
+        connection, resp, connect_time = open_pooled(pool, self.target, method,
+                                                     path, body, headers)
+        try:
+            if metrics is not None:
+                # Summed over attempts, if the request is retried.
+                metrics.connect = (metrics.connect or 0.0) + connect_time
+                metrics.first_token()
+            resp_body = resp.read()
+        except BaseException:
+            connection.close()
+            raise
+
+        if resp.will_close:
+            connection.close()
+        else:
+            pool.release(host, port, connection)
+        return resp, resp_body
+
+
+def open_pooled(pool, target, method, path, body, headers):
+    """Send a request over a connection from `pool` to `target` (a `(host, port,
+    use_tls)`), returning `(connection, response, connect time)` once the response
+    headers have arrived. Release the connection to the pool once the response body
+    has been read.
+
+    If a reused connection turns out to have been closed by the server, the request
+    is transparently retried once on a fresh connection.
+    """
+    host, port, use_tls = target
+    while True:
+        connection, reused = pool.acquire(host, port, use_tls)
         try:
+            t_start = monotonic()
+            # Connects first, if the connection is new.
             connection.request(method, path, body, headers)
+            t_sent = monotonic()
             resp = connection.getresponse()
+        except _STALE_CONNECTION_ERRORS:
+            connection.close()
+            if reused:
+                continue
+            raise
+        except BaseException:
+            connection.close()
+            raise
+        return connection, resp, 0.0 if reused else t_sent - t_start
 
-            resp_body = resp.read()
-            if 200 <= resp.status < 300:
-                if resp_body and len(resp_body) > 0:
-                    return json.loads(resp_body.decode("utf-8"))
+
+class SSEParser:
+    """Incremental parser for a `text/event-stream` response body.
+
+    Bytes are fed in as they arrive from the network, and the `data` of each complete
+    event is returned as soon as its terminating blank line has been seen.
+    """
+
+    def __init__(self):
+        self._buffer = b""
+        self._data = []
+
+    def feed(self, chunk: bytes):
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split(b"\n")
+
+        events = []
+        for raw_line in lines:
+            # A multi-byte UTF-8 sequence never contains b"\n", so lines decode safely.
+            line = raw_line.rstrip(b"\r").decode("utf-8")
+            if not line:
+                if self._data:
+                    events.append("\n".join(self._data))
+                    self._data = []
+            elif line.startswith(":"):
+                # Comment / keep-alive line.
+                continue
             else:
-                raise APIResponseException(method, path, headers, query_params,
-                                           body, resp_body)
+                field, _, value = line.partition(":")
+                if field == "data":
+                    self._data.append(value[1:] if value.startswith(" ") else value)
+        return events
+
+
+def parse_stream_event(data: str):
+    """Decode the data of one SSE event. Returns None for the final `[DONE]` event."""
+    if data.strip() == "[DONE]":
+        return None
+    return json.loads(data)
+
+
+class AsyncOpenAIClient:
+    """asyncio counterpart of `OpenAIClient`, with support for streamed responses.
+
+    Each request uses its own connection, so any number of requests can be in flight
+    on one event loop.
+    """
+
+    def __init__(self,
+                 openai_api_key,
+                 api_version=DEFAULT_API_VERSION,
+                 api_base=None):
+        self.openai_api_key = openai_api_key
+        self.api_version = api_version
+        self.api_base = api_base or get_api_base()
+
+    def _prepare(self, method, path, headers, query_params, json_body):
+        method = method.upper()
+        assert path.startswith("/"), "Invalid path"
+        assert not path.startswith(
+            "/v"), "API Version must be specified at moment of client creation"
+
+        headers = dict(headers or {})
+        headers.setdefault("Authorization", f"Bearer {self.openai_api_key}")
+        headers.setdefault("Content-Type", "application/json")
+
+        body = json.dumps(json_body).encode("utf-8") if json_body else b""
+
+        path = f"{self.api_base.path_prefix}/{self.api_version}" + path
+        if query_params is not None:
+            path += "?" + urllib.parse.urlencode(query_params)
+        return method, path, headers, body
+
+    async def _open(self, method, path, headers, body):
+        host, port, use_tls = get_request_target(self.api_base)
+        if port is None:
+            reader, writer = await asyncio.open_unix_connection(host)
+            host = BROKER_HOST
+        else:
+            reader, writer = await asyncio.open_connection(
+                host,
+                port,
+                ssl=get_ssl_context() if use_tls else None,
+                server_hostname=host if use_tls else None,
+            )
+        head = [
+            f"{method} {path} HTTP/1.1",
+            f"Host: {host}",
+            "Connection: close",
+            f"Content-Length: {len(body)}",
+            *[f"{k}: {v}" for k, v in headers.items()],
+        ]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            writer.close()
+            raise APIClientException("Connection closed before a response was sent")
+        status = int(status_line.split()[1])
+
+        resp_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            resp_headers[name.strip().lower()] = value.strip()
+        return reader, writer, status, resp_headers
+
+    async def _iter_body(self, reader, resp_headers):
+        """Yield the raw response body as it arrives, undoing chunked encoding."""
+        if resp_headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = await reader.readline()
+                size = int(size_line.split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    return
+                yield await reader.readexactly(size)
+                await reader.readline()  # CRLF after each chunk.
+        elif "content-length" in resp_headers:
+            yield await reader.readexactly(int(resp_headers["content-length"]))
+        else:
+            while True:
+                data = await reader.read(64 * 1024)
+                if not data:
+                    return
+                yield data
+
+    async def _read_error(self, method, path, headers, query_params, body, reader,
+                          status, resp_headers):
+        resp_body = b"".join([c async for c in self._iter_body(reader, resp_headers)])
+        return APIResponseException(method, path, headers, query_params, body,
+                                    resp_body, status, resp_headers)
+
+    async def _open_with_retry(self, method, path, headers, query_params, body):
+        """Open a request, waiting for the rate limits and retrying retryable
+        failures. Returns `(reader, writer, response headers)` once a successful
+        status line and headers have arrived.
+
+        As in `call_api_with_retry`, requests which go through the broker are left
+        for it to retry and rate limit."""
+        brokered = _broker_socket is not None
+        limiter = get_rate_limiter()
+        tokens = estimate_request_tokens(json.loads(body) if body else None)
+        for attempt in count():
+            # As in `call_with_retry`, the tokens are only reserved once.
+            if not brokered:
+                await asyncio.sleep(
+                    limiter.reserve(tokens if attempt == 0 else 0))
+            try:
+                reader, writer, status, resp_headers = await self._open(
+                    method, path, headers, body)
+                if 200 <= status < 300:
+                    limiter.update_from_headers(resp_headers)
+                    return reader, writer, resp_headers
+                try:
+                    raise await self._read_error(method, path, headers,
+                                                 query_params, body, reader,
+                                                 status, resp_headers)
+                finally:
+                    writer.close()
+            except Exception as e:
+                if brokered:
+                    raise
+                delay = get_retry_policy().retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                limiter.update_from_headers(getattr(e, "resp_headers", None))
+                await asyncio.sleep(delay)
+
+    async def request(self,
+                      method,
+                      path,
+                      headers=None,
+                      query_params=None,
+                      json_body=None):
+        method, path, headers, body = self._prepare(method, path, headers,
+                                                    query_params, json_body)
+        reader, writer, resp_headers = await self._open_with_retry(
+            method, path, headers, query_params, body)
+        try:
+            resp_body = b"".join(
+                [c async for c in self._iter_body(reader, resp_headers)])
+            if resp_body:
+                return json.loads(resp_body.decode("utf-8"))
         finally:
-            connection.close()
+            writer.close()
+
+    async def stream(self, method, path, headers=None, json_body=None):
+        """Make a streaming request, yielding each decoded server-sent event."""
+        json_body = dict(json_body or {}, stream=True)
+        headers = dict(headers or {}, Accept="text/event-stream")
+        method, path, headers, body = self._prepare(method, path, headers, None,
+                                                    json_body)
+        reader, writer, resp_headers = await self._open_with_retry(
+            method, path, headers, None, body)
+        try:
+            parser = SSEParser()
+            async for data in self._iter_body(reader, resp_headers):
+                for event in parser.feed(data):
+                    event = parse_stream_event(event)
+                    if event is None:
+                        return
+                    yield event
+        finally:
+            writer.close()
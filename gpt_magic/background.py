@@ -0,0 +1,112 @@
+import threading
+from concurrent.futures import Future
+from typing import List, Optional, Tuple
+
+from .cache import ResponseCache
+from .displays import BaseDisplay
+from .gpt_state import Conversation, GPTMagicState
+from .semantic_cache import SemanticCache
+
+
+class BackgroundCompletion:
+    """Future-like handle to a `%%gpt --background` completion.
+
+    The handle is bound to its conversation key (e.g. "A") as soon as it is created, and
+    to its message key (e.g. "A3") once the worker has added the prompt.
+    """
+
+    def __init__(self, convo_key: str):
+        self.convo_key = convo_key
+        self.message_key: Optional[str] = None
+        self._future: Optional[Future] = None
+        self._cancel_requested = threading.Event()
+
+    @property
+    def key(self) -> str:
+        return self.message_key or self.convo_key
+
+    def result(self, timeout: Optional[float] = None) -> str:
+        """Block until the response is complete, and return it."""
+        return self._future.result(timeout)
+
+    def exception(self, timeout: Optional[float] = None):
+        return self._future.exception(timeout)
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    def running(self) -> bool:
+        return self._future.running()
+
+    def cancel(self) -> bool:
+        """Cancel the completion. If it is already streaming, it stops when the next
+        piece of the response arrives, keeping the partial response (see `%%gpt
+        --resume`)."""
+        if self._future.cancel():
+            return True
+        if self._future.done():
+            return False
+        self._cancel_requested.set()
+        return True
+
+    @property
+    def cancel_requested(self) -> bool:
+        return self._cancel_requested.is_set()
+
+    def add_done_callback(self, fn):
+        self._future.add_done_callback(lambda _: fn(self))
+
+    def __repr__(self):
+        if not self._future.done():
+            status = "running" if self._future.running() else "pending"
+        elif self._future.cancelled() or self.cancel_requested:
+            status = "cancelled"
+        elif self._future.exception() is not None:
+            status = "failed"
+        else:
+            status = "done"
+        return f"<GPT[{self.key}] {status}>"
+
+
+def run_in_background(
+    state: GPTMagicState,
+    convo: Conversation,
+    prompt: str,
+    ipy_history: List[Tuple],
+    model: str,
+    ipy_display: BaseDisplay,
+    cache: Optional[ResponseCache] = None,
+    semantic_cache: Optional[SemanticCache] = None,
+) -> BackgroundCompletion:
+    """Stream a completion on a worker thread, into its own display area."""
+    completion = BackgroundCompletion(convo.key)
+    # Created here rather than in the worker, so it displays in the calling cell.
+    renderer = ipy_display.stream_renderer(f"GPT[{convo.key}]: ", live=False)
+
+    def work():
+        with state.tracer.span("background_completion", model=model), convo.lock:
+            convo.add_prompt(prompt, False, ipy_history)
+            completion.message_key = convo.get_message_key()
+            renderer.label = f"GPT[{completion.message_key}]: "
+            stream = convo.do_completion(
+                model, stream=True, cache=cache, semantic_cache=semantic_cache
+            )
+            try:
+                for delta in stream:
+                    if completion.cancel_requested:
+                        break
+                    if convo.head.cache_hit and not renderer.text:
+                        renderer.label = f"GPT[{completion.message_key}] (cached): "
+                    renderer.feed(delta)
+            except Exception as e:
+                renderer.feed(f"\n\nFailed: {e}")
+                raise
+            finally:
+                # Hangs up if the response is incomplete, keeping what has arrived.
+                stream.close()
+                renderer.finish()
+            return convo.get_message()
+
+    completion._future = state.get_executor().submit(work)
+    state.background_completions[convo.key] = completion
+    return completion
@@ -0,0 +1,189 @@
+import argparse
+import shlex
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import count
+from typing import Iterable, Optional
+
+from .displays import get_registered_display
+from .gpt_state import Conversation, GPTMagicState
+from .models import get_model_catalog
+from .utils import require_openai_api_key
+
+# Numbers each `gpt_map` call, so that the conversations of different batches have
+# their own keys (and token budgets).
+_batch_numbers = count(1)
+
+
+def _get_state() -> GPTMagicState:
+    from . import get_GPTMagicState
+
+    return get_GPTMagicState()
+
+
+def render_template(template: str, item) -> str:
+    """Substitute `item` into `template`.
+
+    The item can be referred to as `{}` or `{item}`. Fields of mapping items (e.g. rows
+    from `df.to_dict("records")`) can also be referred to by name, e.g. `{title}`.
+    """
+    fields = {**item, "item": item} if isinstance(item, Mapping) else {"item": item}
+    return template.format(item, **fields)
+
+
+def _wrap_results(items, results):
+    """Return results in the same container type as the input, where possible."""
+    if type(items).__module__.startswith("pandas") and hasattr(items, "index"):
+        # Avoid importing pandas, only callers which already use it get a Series.
+        from pandas import Series
+
+        return Series(results, index=items.index, name=getattr(items, "name", None))
+    return results
+
+
+def gpt_map(
+    items: Iterable,
+    template: str,
+    model: Optional[str] = None,
+    concurrency: int = 8,
+    code: bool = False,
+    system_message: Optional[str] = None,
+    use_cache: bool = True,
+    progress: bool = True,
+    errors: str = "capture",
+):
+    """Apply one prompt template to every item, with up to `concurrency` requests in flight.
+
+    Each item gets its own single-turn conversation, built the same way as `%%gpt`
+    builds them. These conversations are not added to the state.
+
+    Raises `AuthenticationError` before sending anything if no API key is set, as the
+    worker threads can't prompt for one.
+
+    Args:
+        items: An iterable, or a pandas Series (in which case a Series with the same
+            index is returned).
+        template: Prompt template, see `render_template`.
+        model: Resolved as with `%%gpt -m`, e.g. "4". Defaults to the state's
+            `default_model`.
+        code: Ask for code (as with `%%gpt --code`) and return the extracted code.
+        errors: "capture" to put the exception in the failed item's slot and carry on,
+            or "raise" to stop at the first failure.
+
+    Returns:
+        The responses, in input order.
+    """
+    if errors not in ("capture", "raise"):
+        raise ValueError(f"errors must be 'capture' or 'raise', not {errors!r}")
+
+    state = _get_state()
+    require_openai_api_key()
+    if model is None:
+        model = state.default_model
+    else:
+        resolved = get_model_catalog().resolve(model)
+        if resolved is None:
+            raise ValueError(f"Model {model} not found.")
+        model = resolved
+    batch = next(_batch_numbers)
+    cache = state.response_cache if use_cache else None
+    values = list(items)
+    results = [None] * len(values)
+
+    def run_one(i):
+        convo = Conversation(
+            key=f"map{batch}-{i}",
+            system_message=system_message or state.default_system_message,
+        )
+        convo.add_prompt(render_template(template, values[i]), code, [])
+        convo.complete(model, cache=cache)
+        return convo.get_code() if code else convo.get_message()
+
+    def status(n_done, n_failed):
+        msg = f"gpt_map: {n_done}/{len(values)} done"
+        return msg + (f", {n_failed} failed" if n_failed else "")
+
+    progress_handle = (
+        get_registered_display().display_updatable(status(0, 0)) if progress else None
+    )
+    n_failed = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {pool.submit(run_one, i): i for i in range(len(values))}
+        for n_done, future in enumerate(as_completed(futures), 1):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                if errors == "raise":
+                    for f in futures:
+                        f.cancel()
+                    raise
+                results[i] = e
+                n_failed += 1
+            if progress_handle is not None:
+                progress_handle.update(
+                    status(n_done, n_failed), final=n_done == len(values)
+                )
+
+    return _wrap_results(items, results)
+
+
+def _parse_args(line):
+    parser = argparse.ArgumentParser(prog="%gpt_map")
+    parser.add_argument(
+        "items", help="Expression for the items to map over, e.g. `df.text`."
+    )
+    parser.add_argument(
+        "template",
+        nargs="?",
+        default=None,
+        help="Prompt template, where `{}` is replaced by each item. In cell mode, the cell body is the template.",
+    )
+    parser.add_argument("--model", "-m", help="The OpenAI model to use.")
+    parser.add_argument(
+        "--concurrency",
+        "-j",
+        type=int,
+        default=8,
+        help="Maximum number of requests in flight at once.",
+    )
+    parser.add_argument(
+        "--code",
+        "-c",
+        action="store_true",
+        help="Ask for code, and return the extracted code for each item.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always query the API, even if an identical request has been made before.",
+    )
+    parser.add_argument(
+        "--raise-errors",
+        action="store_true",
+        help="Stop at the first failed item, instead of returning the exception in its place.",
+    )
+    return parser.parse_args(shlex.split(line))
+
+
+def gpt_map_command(shell, line, cell=None):
+    try:
+        args = _parse_args(line)
+    except SystemExit:
+        # Assume this was caused by `--help`.
+        return
+
+    template = cell if cell is not None else args.template
+    if not template:
+        print("A prompt template is required.")
+        return
+
+    return gpt_map(
+        shell.ev(args.items),
+        template,
+        model=args.model,
+        concurrency=args.concurrency,
+        code=args.code,
+        use_cache=not args.no_cache,
+        errors="raise" if args.raise_errors else "capture",
+    )
@@ -0,0 +1,409 @@
+"""A local sidecar through which the kernels on one machine (e.g. a JupyterHub) share
+their requests to the OpenAI API.
+
+    python -m gpt_magic.broker --socket /tmp/gpt-magic-broker.sock --tokens-per-minute 90000
+
+Then start the kernels with `GPT_MAGIC_BROKER_SOCKET=/tmp/gpt-magic-broker.sock`, or call
+`gpt_magic.api_client.set_broker_socket("/tmp/gpt-magic-broker.sock")`.
+
+Kernels send their requests to the broker, as HTTP over the Unix socket, and the broker
+sends them on to the API (`OPENAI_API_BASE`, or `--api-base`) over one pool of
+keep-alive connections:
+
+- Identical requests (method, path, body and API key) which are in flight at the same
+  time are sent upstream once. The response, streamed or not, is fanned out to every
+  kernel which sent it, each receiving it from the start.
+- All requests draw from one set of rate limit budgets, learned from the response
+  headers or set on the command line, and retryable failures are retried here.
+- Once every kernel waiting for a response has hung up, the upstream request is
+  abandoned.
+
+Anyone who can connect to the socket can use the broker (with their own API key), so
+the socket's permissions decide who shares it.
+"""
+import argparse
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import stat
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler
+from typing import Dict, List, Optional, Tuple
+
+from .api_client import (
+    BROKER_SOCKET_ENV,
+    APIBase,
+    APIResponseException,
+    ConnectionPool,
+    get_api_base,
+    open_pooled,
+    parse_api_base,
+)
+from .retry import RateLimiter, call_with_retry, estimate_request_tokens
+
+DEFAULT_SOCKET_PATH = os.path.join(tempfile.gettempdir(), "gpt-magic-broker.sock")
+# Kept-alive upstream connections, shared by all the kernels.
+MAX_IDLE_UPSTREAM = 16
+READ_SIZE = 64 * 1024
+# Response header telling the kernel whether it joined a request already in flight.
+COALESCED_HEADER = "X-Broker-Coalesced"
+
+# Headers which only apply to one hop, kernel to broker or broker to API. Responses
+# are always relayed uncompressed and chunked, whatever each kernel asked for.
+_HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-connection",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+    "content-length",
+    "host",
+    "accept-encoding",
+}
+_RESPONSE_DROPPED_HEADERS = _HOP_BY_HOP_HEADERS | {"date", "server"}
+# Identical requests made with different API keys aren't coalesced.
+_IDENTITY_HEADERS = ("authorization", "openai-organization")
+
+
+class _Flight:
+    """An upstream request, and its response so far, shared by the kernels which sent
+    it."""
+
+    def __init__(self, key: str):
+        self.key = key
+        self._cond = threading.Condition()
+        self.status: Optional[int] = None
+        self.headers: List[Tuple[str, str]] = []
+        self.chunks: List[bytes] = []
+        self.done = False
+        # The upstream response broke off, so the relayed ones must too.
+        self.failed = False
+        # Kernels receiving the response, under the broker's lock.
+        self.waiters = 0
+        self.abandoned = False
+
+    def start(self, status: int, headers: List[Tuple[str, str]]):
+        with self._cond:
+            self.status, self.headers = status, headers
+            self._cond.notify_all()
+
+    def add_chunk(self, chunk: bytes):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    def finish(self, failed: bool = False):
+        with self._cond:
+            self.done = True
+            self.failed = failed
+            self._cond.notify_all()
+
+    def wait_for_response(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self.status is not None or self.done)
+
+    def iter_chunks(self):
+        """The response body from the start, as it arrives."""
+        i = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self.chunks) > i or self.done)
+                chunks, done = self.chunks[i:], self.done
+            i += len(chunks)
+            yield from chunks
+            if done:
+                return
+
+
+def _request_key(method: str, path: str, body: Optional[bytes], headers) -> str:
+    digest = hashlib.sha256(f"{method} {path}\n".encode("utf-8"))
+    for name in _IDENTITY_HEADERS:
+        digest.update(f"{headers.get(name, '')}\n".encode("utf-8"))
+    digest.update(body or b"")
+    return digest.hexdigest()
+
+
+def _request_tokens(body: Optional[bytes]) -> int:
+    try:
+        return estimate_request_tokens(json.loads(body) if body else None)
+    except (ValueError, TypeError, AttributeError):
+        return 0
+
+
+def _relayed_headers(headers) -> List[Tuple[str, str]]:
+    return [
+        (name, value)
+        for name, value in headers
+        if name.lower() not in _RESPONSE_DROPPED_HEADERS
+    ]
+
+
+def _remove_stale_socket(path: str):
+    """Remove the socket left behind by a broker which didn't shut down cleanly."""
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(f"{path} exists, and isn't a socket")
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise OSError(f"A broker is already listening on {path}")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "Broker"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _relay(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else None
+        headers = {
+            name: value
+            for name, value in self.headers.items()
+            if name.lower() not in _HOP_BY_HOP_HEADERS
+        }
+        headers["Accept-Encoding"] = "identity"
+
+        flight, coalesced = self.server.submit(self.command, self.path, body, headers)
+        try:
+            self._send_flight(flight, coalesced)
+        except (BrokenPipeError, ConnectionResetError):
+            # The kernel hung up, e.g. because the user interrupted the stream.
+            self.close_connection = True
+        finally:
+            self.server.leave(flight)
+
+    do_GET = do_POST = do_DELETE = _relay
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _send_flight(self, flight: _Flight, coalesced: bool):
+        flight.wait_for_response()
+        self.send_response(flight.status)
+        for name, value in flight.headers:
+            self.send_header(name, value)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header(COALESCED_HEADER, "1" if coalesced else "0")
+        self.end_headers()
+        for chunk in flight.iter_chunks():
+            self._write_chunk(chunk)
+        if flight.failed:
+            # Without the final chunk, the kernel sees the response break off too.
+            self.close_connection = True
+            return
+        self._write_chunk(b"")
+
+
+class Broker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """The broker, listening on the Unix socket at `socket_path`.
+
+    Use as a context manager to serve on a background thread:
+
+        with Broker("/tmp/gpt-magic-broker.sock") as broker:
+            set_broker_socket(broker.socket_path)
+            ...
+    """
+
+    daemon_threads = True
+    # Room for many kernels connecting at once.
+    request_queue_size = 128
+
+    def __init__(
+        self,
+        socket_path: str = DEFAULT_SOCKET_PATH,
+        api_base: Optional[APIBase] = None,
+        limiter: Optional[RateLimiter] = None,
+        connection_pool: Optional[ConnectionPool] = None,
+    ):
+        self.socket_path = socket_path
+        self.api_base = api_base or get_api_base()
+        self.limiter = limiter or RateLimiter()
+        self.connection_pool = connection_pool or ConnectionPool(
+            max_idle_per_host=MAX_IDLE_UPSTREAM
+        )
+        # Requests from kernels, those sent upstream, and those which joined one
+        # already in flight.
+        self.request_count = 0
+        self.upstream_count = 0
+        self.coalesced_count = 0
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        _remove_stale_socket(socket_path)
+        super().__init__(socket_path, _Handler)
+
+    def submit(
+        self, method: str, path: str, body: Optional[bytes], headers: Dict[str, str]
+    ) -> Tuple[_Flight, bool]:
+        """The flight carrying the request, and whether it was already in flight.
+        Call `leave` once done with it."""
+        key = _request_key(
+            method, path, body, {k.lower(): v for k, v in headers.items()}
+        )
+        with self._lock:
+            self.request_count += 1
+            flight = self._flights.get(key)
+            coalesced = flight is not None
+            if coalesced:
+                self.coalesced_count += 1
+            else:
+                flight = self._flights[key] = _Flight(key)
+                self.upstream_count += 1
+            flight.waiters += 1
+        if not coalesced:
+            threading.Thread(
+                target=self._fetch,
+                args=(flight, method, path, body, headers),
+                name="gpt-magic-broker-fetch",
+                daemon=True,
+            ).start()
+        return flight, coalesced
+
+    def leave(self, flight: _Flight):
+        with self._lock:
+            flight.waiters -= 1
+            if flight.waiters == 0 and self._flights.get(flight.key) is flight:
+                # Nobody wants the rest of the response, so later requests start over.
+                flight.abandoned = True
+                del self._flights[flight.key]
+
+    def _land(self, flight: _Flight):
+        with self._lock:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+
+    def _fetch(self, flight: _Flight, method, path, body, headers):
+        pool = self.connection_pool
+        host, port, _ = self.api_base.target
+
+        def send():
+            connection, resp, _ = open_pooled(
+                pool, self.api_base.target, method, path, body, headers
+            )
+            if 200 <= resp.status < 300:
+                return connection, resp
+            try:
+                resp_body = resp.read()
+            finally:
+                connection.close()
+            raise APIResponseException(
+                method, path, headers, None, body, resp_body, resp.status, resp.headers
+            )
+
+        try:
+            connection, resp = call_with_retry(
+                send, tokens=_request_tokens(body), limiter=self.limiter
+            )
+        except APIResponseException as e:
+            flight.start(e.status, _relayed_headers(e.resp_headers.items()))
+            flight.add_chunk(e.resp_body)
+            flight.finish()
+            self._land(flight)
+            return
+        except Exception as e:
+            error = {"error": {"message": f"Broker: {e}", "type": "broker_error"}}
+            flight.start(502, [("Content-Type", "application/json")])
+            flight.add_chunk(json.dumps(error).encode("utf-8"))
+            flight.finish()
+            self._land(flight)
+            return
+
+        self.limiter.update_from_headers(resp.headers)
+        flight.start(resp.status, _relayed_headers(resp.getheaders()))
+        complete = False
+        try:
+            while not flight.abandoned:
+                chunk = resp.read1(READ_SIZE)
+                if not chunk:
+                    complete = True
+                    break
+                flight.add_chunk(chunk)
+        except Exception:
+            pass
+        finally:
+            flight.finish(failed=not complete)
+            self._land(flight)
+            # Hangs up if the response is incomplete.
+            if complete and not resp.will_close:
+                pool.release(host, port, connection)
+            else:
+                connection.close()
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+        self.connection_pool.clear()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="gpt-magic-broker", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m gpt_magic.broker", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument(
+        "--socket",
+        default=os.environ.get(BROKER_SOCKET_ENV) or DEFAULT_SOCKET_PATH,
+        help=f"Path of the Unix socket to listen on (default ${BROKER_SOCKET_ENV}, "
+        f"or {DEFAULT_SOCKET_PATH}).",
+    )
+    parser.add_argument(
+        "--api-base",
+        default=None,
+        help="Where to send requests (default $OPENAI_API_BASE, or OpenAI).",
+    )
+    parser.add_argument("--requests-per-minute", type=float, default=None)
+    parser.add_argument("--tokens-per-minute", type=float, default=None)
+    args = parser.parse_args(argv)
+
+    api_base = parse_api_base(args.api_base) if args.api_base else get_api_base()
+    limiter = RateLimiter(args.requests_per_minute, args.tokens_per_minute)
+    broker = Broker(args.socket, api_base, limiter)
+    print(f"Brokering requests to {api_base.url} on {args.socket}")
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from time import time
+from typing import Dict, List, Optional
+
+
+def default_cache_dir() -> Path:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join("~", ".cache")
+    return Path(base).expanduser() / "gpt_magic" / "responses"
+
+
+def make_cache_key(
+    messages: List[Dict], model: str, temperature=None, max_tokens=None
+) -> str:
+    """Content address of a chat completion request."""
+    payload = json.dumps(
+        {
+            "messages": messages,
+            "model": model,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryCache:
+    """Thread-safe LRU mapping of cache key -> response."""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: str):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskCache:
+    """One JSON file per response, evicted by age and by total size (oldest first).
+
+    Writes keep a running total of the cache's size, so the directory is only scanned
+    when it goes over `max_bytes`, or every `scan_every` writes (to catch expired
+    entries, and writes by other processes).
+    """
+
+    def __init__(
+        self,
+        directory: Optional[Path] = None,
+        max_bytes: int = 64 * 1024 * 1024,
+        max_age_seconds: float = 7 * 24 * 3600,
+        scan_every: int = 100,
+    ):
+        self.directory = Path(directory) if directory else default_cache_dir()
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.scan_every = scan_every
+        self._lock = threading.Lock()
+        # Bytes in the cache as of the last scan, plus this process's writes since.
+        # None until the first scan.
+        self._size: Optional[int] = None
+        self._writes_since_scan = 0
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            if time() - path.stat().st_mtime > self.max_age_seconds:
+                path.unlink()
+                return None
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)["response"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, key: str, value: str):
+        path = self._path(key)
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            try:
+                replaced = path.stat().st_size
+            except OSError:
+                replaced = 0
+            # Write to a temporary file first so readers never see a partial entry.
+            tmp_path = self.directory / f".{key}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"response": value}, f, ensure_ascii=False)
+            written = tmp_path.stat().st_size
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._writes_since_scan += 1
+                if self._size is not None:
+                    self._size += written - replaced
+                scan = (
+                    self._size is None
+                    or self._size > self.max_bytes
+                    or self._writes_since_scan >= self.scan_every
+                )
+            if scan:
+                self.evict()
+        except OSError:
+            # The disk tier is best-effort, a failed write is just a future cache miss.
+            pass
+
+    def evict(self):
+        """Remove expired entries, then the oldest entries until under `max_bytes`."""
+        entries = []
+        now = time()
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            stat = entry.stat()
+            if now - stat.st_mtime > self.max_age_seconds:
+                os.unlink(entry.path)
+            else:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.unlink(path)
+            total -= size
+        with self._lock:
+            self._size = total
+            self._writes_since_scan = 0
+
+    def clear(self):
+        if not self.directory.exists():
+            return
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                os.unlink(entry.path)
+        with self._lock:
+            self._size = 0
+            self._writes_since_scan = 0
+
+
+class ResponseCache:
+    """Two tier (memory, then disk) cache of chat completion responses.
+
+    Disk hits are promoted into the memory tier.
+    """
+
+    def __init__(
+        self,
+        memory: Optional[MemoryCache] = None,
+        disk: Optional[DiskCache] = None,
+    ):
+        self.memory = memory or MemoryCache()
+        self.disk = disk or DiskCache()
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.memory.get(key)
+        if value is None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.put(key, value)
+        return value
+
+    def put(self, key: str, value: str):
+        self.memory.put(key, value)
+        self.disk.put(key, value)
+
+    def clear(self):
+        self.memory.clear()
+        self.disk.clear()
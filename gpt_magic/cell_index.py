@@ -0,0 +1,217 @@
+"""The notebook cells most relevant to a prompt, for `%%gpt --auto-context`.
+
+Every executed cell (its input, and a short summary of its output) is added to a BM25
+index, by a `post_run_cell` hook, so that at prompt time only the query has to be
+scored. The index is built from the session's history the first time it is used, then
+kept up to date by the hook, so sessions which never use `--auto-context` pay nothing.
+
+Postings are kept in compact `array`s. A query only touches the postings of its own
+terms, which at notebook scale is fast enough in plain Python.
+"""
+import heapq
+import math
+import re
+import threading
+from array import array
+from typing import Dict, List, Tuple
+
+from IPython.core.getipython import get_ipython
+
+from .history import (
+    DEFAULT_OUTPUT_TOKENS,
+    CellRecord,
+    get_history_serializer,
+    summarize_output,
+)
+from .tokens import count_tokens
+
+# Output summaries are kept short, they only need to carry the salient words.
+INDEXED_OUTPUT_TOKENS = 100
+DEFAULT_TOP_K = 5
+# Budget for all the cells selected for one prompt.
+DEFAULT_CONTEXT_TOKENS = 2000
+
+# `%%gpt` commands themselves aren't useful context.
+_GPT_MAGIC_PATTERN = re.compile(r"\s*%%?gpt\b")
+
+_WORD_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|\d+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-cased words, with snake_case identifiers also split into their parts."""
+    terms = []
+    for word in _WORD_PATTERN.findall(text.lower()):
+        terms.append(word)
+        if "_" in word:
+            terms.extend(part for part in word.split("_") if part)
+    return terms
+
+
+class _Postings:
+    __slots__ = ("docs", "tfs")
+
+    def __init__(self):
+        # C ints, smaller than lists of Python ints.
+        self.docs = array("i")
+        self.tfs = array("i")
+
+
+class CellIndex:
+    """BM25 index over the cells of the current IPython session."""
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._postings: Dict[str, _Postings] = {}
+        # Per document: the cell's execution count, and its length in terms.
+        self._cells = array("i")
+        self._lengths = array("i")
+        self._total_length = 0
+        # History session the index belongs to, and the next execution count to index.
+        self._session = None
+        self._next_cell = 1
+        self._hooked_shell = None
+
+    def __len__(self) -> int:
+        return len(self._cells)
+
+    def add_cell(self, n: int, text: str):
+        counts: Dict[str, int] = {}
+        for term in tokenize(text):
+            counts[term] = counts.get(term, 0) + 1
+        with self._lock:
+            doc = len(self._cells)
+            for term, tf in counts.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = _Postings()
+                postings.docs.append(doc)
+                postings.tfs.append(tf)
+            length = sum(counts.values())
+            self._cells.append(n)
+            self._lengths.append(length)
+            self._total_length += length
+
+    def clear(self):
+        with self._lock:
+            self._postings.clear()
+            self._cells = array("i")
+            self._lengths = array("i")
+            self._total_length = 0
+            self._next_cell = 1
+
+    def sync(self, ipy, include_running: bool = False):
+        """Index the cells which have run since the last sync. The running cell (the
+        last one in the history) is only included if `include_running`, i.e. once it
+        has finished."""
+        history_manager = ipy.history_manager
+        if history_manager.session_number != self._session:
+            # Execution counts start again in a new session.
+            self.clear()
+            self._session = history_manager.session_number
+        inputs = history_manager.input_hist_raw
+        stop = len(inputs) if include_running else len(inputs) - 1
+        outputs = ipy.user_ns.get("_oh", {})
+        for n in range(self._next_cell, stop):
+            if _GPT_MAGIC_PATTERN.match(inputs[n]):
+                continue
+            output = outputs.get(n)
+            summary = (
+                ""
+                if output is None
+                else summarize_output(output, INDEXED_OUTPUT_TOKENS)
+            )
+            self.add_cell(n, f"{inputs[n]}\n{summary}")
+        self._next_cell = max(self._next_cell, stop)
+
+    def attach(self, ipy):
+        """Catch up with the session's history, and index each cell after it runs."""
+        self.sync(ipy)
+        if self._hooked_shell is not ipy:
+            ipy.events.register(
+                "post_run_cell", lambda result: self.sync(ipy, include_running=True)
+            )
+            self._hooked_shell = ipy
+
+    def search(self, query: str, k: int = DEFAULT_TOP_K) -> List[Tuple[int, float]]:
+        """The (execution count, score) of the `k` best matching cells, best first."""
+        terms = set(tokenize(query))
+        with self._lock:
+            n_docs = len(self._cells)
+            if n_docs == 0 or not terms:
+                return []
+            avg_length = self._total_length / n_docs or 1.0
+            scores: Dict[int, float] = {}
+            for term in terms:
+                postings = self._postings.get(term)
+                if postings is None:
+                    continue
+                df = len(postings.docs)
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                for doc, tf in zip(postings.docs, postings.tfs):
+                    norm = self.k1 * (
+                        1 - self.b + self.b * self._lengths[doc] / avg_length
+                    )
+                    scores[doc] = scores.get(doc, 0.0) + idf * tf * (self.k1 + 1) / (
+                        tf + norm
+                    )
+            cells = self._cells
+
+            # Ties go to the earlier cell.
+            top = heapq.nlargest(k, sorted(scores.items()), key=lambda item: item[1])
+            return [(cells[doc], score) for doc, score in top if score > 0]
+
+
+def select_cells(
+    index: CellIndex,
+    query: str,
+    cell_tokens,
+    max_tokens: int,
+    k: int = DEFAULT_TOP_K,
+) -> List[Tuple[int, float]]:
+    """The best matching cells whose `cell_tokens(n)` add up to at most `max_tokens`,
+    as (execution count, score), in execution order."""
+    chosen = []
+    budget = max_tokens
+    for n, score in index.search(query, k):
+        tokens = cell_tokens(n)
+        if tokens <= budget:
+            chosen.append((n, score))
+            budget -= tokens
+    return sorted(chosen)
+
+
+_cell_index = CellIndex()
+
+
+def get_cell_index() -> CellIndex:
+    return _cell_index
+
+
+def get_relevant_history(
+    query: str,
+    k: int = DEFAULT_TOP_K,
+    max_tokens: int = DEFAULT_CONTEXT_TOKENS,
+    max_output_tokens: int = DEFAULT_OUTPUT_TOKENS,
+) -> List[CellRecord]:
+    """The cells of the session most relevant to `query`, serialized as by
+    `--show`, and together within `max_tokens`."""
+    ipy = get_ipython()
+    index = get_cell_index()
+    index.attach(ipy)
+    serializer = get_history_serializer()
+    inputs = ipy.history_manager.input_hist_raw
+    records = {}
+
+    def cell_tokens(n: int) -> int:
+        records[n] = (
+            n,
+            inputs[n],
+            serializer.serialize_output(ipy, n, max_output_tokens),
+        )
+        return count_tokens(inputs[n]) + count_tokens(records[n][2])
+
+    return [
+        records[n] for n, _ in select_cells(index, query, cell_tokens, max_tokens, k)
+    ]
@@ -0,0 +1,103 @@
+"""Incremental extraction of the code block from a streamed `--code` response."""
+import ast
+from typing import Callable, Optional
+
+from .utils import maybe_find_backtick_block
+
+CODE_START_MARKER = "---cell-start---"
+CODE_END_MARKER = "---cell-end---"
+
+
+class CodeStreamParser:
+    """Finds the `---cell-start---` ... `---cell-end---` block as the response streams.
+
+    `feed` returns True as soon as the end marker has arrived, at which point the rest
+    of the response (usually an explanation of the code) can be skipped. Only the new
+    delta (plus a few characters held back, in case a marker is split across deltas) is
+    searched each time, so parsing is linear in the length of the response.
+
+    The extracted code is the same as `Conversation.get_code` would extract from the
+    complete response: the first marker block, or else the last backtick fenced block.
+    """
+
+    def __init__(
+        self, start_marker: str = CODE_START_MARKER, end_marker: str = CODE_END_MARKER
+    ):
+        self.start_marker = start_marker
+        self.end_marker = end_marker
+        self._parts = []
+        # End of the text seen so far which could be the start of a split marker.
+        self._pending = ""
+        # Pieces of the code block, once its start marker has been seen.
+        self._code_parts: Optional[list] = None
+        self._code: Optional[str] = None
+
+    @property
+    def text(self) -> str:
+        """The response so far."""
+        return "".join(self._parts)
+
+    @property
+    def complete(self) -> bool:
+        """Whether the end of the code block has been seen."""
+        return self._code is not None
+
+    @staticmethod
+    def _split_tail(text: str, marker: str):
+        """Split off the end of `text` which could be the start of `marker`."""
+        keep = len(marker) - 1
+        if keep == 0 or len(text) <= keep:
+            return ("", text) if keep else (text, "")
+        return text[:-keep], text[-keep:]
+
+    def feed(self, delta: str) -> bool:
+        """Add the next piece of the response. Returns `complete`."""
+        if self.complete or not delta:
+            return self.complete
+        self._parts.append(delta)
+        window = self._pending + delta
+
+        if self._code_parts is None:
+            i = window.find(self.start_marker)
+            if i == -1:
+                _, self._pending = self._split_tail(window, self.start_marker)
+                return False
+            self._code_parts = []
+            window = window[i + len(self.start_marker) :]
+
+        j = window.find(self.end_marker)
+        if j == -1:
+            code, self._pending = self._split_tail(window, self.end_marker)
+            self._code_parts.append(code)
+            return False
+
+        self._code_parts.append(window[:j])
+        code = "".join(self._code_parts).strip()
+        # GPT may ignore our instruction not to wrap the code in backticks.
+        bt_block = maybe_find_backtick_block(code)
+        self._code = bt_block if bt_block is not None else code
+        return True
+
+    def result(self) -> Optional[str]:
+        """The code, or None if the response (so far) doesn't contain any."""
+        if self._code is not None:
+            return self._code
+        # GPT has ignored our instructions, look for a block like '```[python]<code>```'
+        return maybe_find_backtick_block(self.text)
+
+
+def is_valid_code(code: str, transform: Optional[Callable[[str], str]] = None) -> bool:
+    """Whether `code` compiles, after `transform` (e.g. IPython's `transform_cell`, which
+    turns magics and shell escapes into Python)."""
+    try:
+        compile(
+            transform(code) if transform is not None else code,
+            "<gpt-code>",
+            "exec",
+            # Notebook cells may `await` at the top level.
+            flags=ast.PyCF_ALLOW_TOP_LEVEL_AWAIT,
+            dont_inherit=True,
+        )
+    except (SyntaxError, ValueError):
+        return False
+    return True
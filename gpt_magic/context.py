@@ -0,0 +1,122 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from .tokens import count_message_tokens, get_context_window, truncate_to_tokens
+
+STRATEGIES = ("none", "drop", "truncate", "summarize")
+
+
+@dataclass
+class ContextPolicy:
+    """Keeps the messages sent to the API within the model's context window.
+
+    The system message and the newest user message are always sent. When the whole
+    history doesn't fit, the oldest turns are shrunk according to `strategy`:
+
+    - "drop": leave out the oldest turns.
+    - "truncate": shorten the oldest messages to `truncated_message_tokens`, then drop
+      turns if that isn't enough.
+    - "summarize": replace the oldest turns with a locally built digest (the first line
+      of each message), added to the system message, so GPT knows roughly what was
+      discussed.
+    - "none": send everything.
+
+    If the newest user message doesn't fit even on its own, it is shortened too, keeping
+    its start and end.
+    """
+
+    strategy: str = "drop"
+    # Room left for the response when `max_tokens` isn't given for the request.
+    reserve_tokens: int = 1024
+    # Overrides the model's context window as the budget, e.g. to cap cost.
+    max_context_tokens: Optional[int] = None
+    truncated_message_tokens: int = 256
+
+    def __post_init__(self):
+        if self.strategy not in STRATEGIES:
+            raise ValueError(f"strategy must be one of {STRATEGIES}")
+
+    def budget(self, model: str, max_tokens: Optional[int] = None) -> int:
+        window = self.max_context_tokens or get_context_window(model)
+        return window - (max_tokens or self.reserve_tokens)
+
+    def apply(
+        self, messages: List[Dict], model: str, max_tokens: Optional[int] = None
+    ) -> List[Dict]:
+        budget = self.budget(model, max_tokens)
+        if self.strategy == "none" or count_message_tokens(messages) <= budget:
+            return messages
+
+        system, history, prompt = messages[0], messages[1:-1], messages[-1]
+
+        if self.strategy == "truncate":
+            history = [
+                {
+                    "role": m["role"],
+                    "content": truncate_to_tokens(
+                        m["content"], self.truncated_message_tokens
+                    ),
+                }
+                for m in history
+            ]
+
+        dropped = []
+        # Drop whole user/assistant turns, oldest first.
+        while history and count_message_tokens([system, *history, prompt]) > budget:
+            dropped.extend(history[:2])
+            history = history[2:]
+
+        if self.strategy == "summarize" and dropped:
+            summarized = self._summarize(system, dropped)
+            while history and (
+                count_message_tokens([summarized, *history, prompt]) > budget
+            ):
+                dropped.extend(history[:2])
+                history = history[2:]
+                summarized = self._summarize(system, dropped)
+            system = summarized
+
+        if count_message_tokens([system, *history, prompt]) > budget:
+            prompt = self._shorten(prompt, [system, *history], budget)
+
+        return [system, *history, prompt]
+
+    def _summarize(self, system: Dict, messages: List[Dict]) -> Dict:
+        """`system`, followed by a digest of `messages`."""
+        first_lines = [m["content"].strip().split("\n", 1)[0] for m in messages]
+        lines = [
+            f"- {m['role']}: {truncate_to_tokens(line, 40)}"
+            for m, line in zip(messages, first_lines)
+        ]
+        summary = "Earlier in this conversation (abridged):\n" + "\n".join(lines)
+        summary = truncate_to_tokens(summary, self.truncated_message_tokens)
+        return {**system, "content": f"{system['content']}\n\n{summary}"}
+
+    @staticmethod
+    def _shorten(message: Dict, before: List[Dict], budget: int) -> Dict:
+        """`message`, shortened to fit in `budget` after the messages `before` it."""
+        target = budget - count_message_tokens([*before, {**message, "content": ""}])
+        while target > 0:
+            content = truncate_to_tokens(message["content"], target)
+            over = count_message_tokens([*before, {**message, "content": content}])
+            if over <= budget:
+                return {**message, "content": content}
+            target -= over - budget
+        return {**message, "content": ""}
+
+
+def describe_request_size(
+    messages: List[Dict],
+    model: str,
+    policy: ContextPolicy,
+    max_tokens: Optional[int] = None,
+):
+    """One line summary of the request size, for `--debug` output."""
+    prompt_tokens = count_message_tokens(messages)
+    response_tokens = max_tokens or policy.reserve_tokens
+    window = policy.budget(model, max_tokens) + response_tokens
+    return (
+        f"Request tokens: {prompt_tokens} prompt + {response_tokens} for the response"
+        f" = {prompt_tokens + response_tokens} (of {window} for {model},"
+        f" strategy '{policy.strategy}')"
+    )
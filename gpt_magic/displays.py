@@ -1,12 +1,22 @@
+import sys
+from time import monotonic
+
 import IPython as ipy
 from IPython.display import Markdown, display
 
 
 class BaseDisplay:
-
     def display(self, results):
         raise NotImplementedError
 
+    def display_updatable(self, results):
+        """Display `results` and return a handle whose `update` method replaces them."""
+        raise NotImplementedError
+
+    def stream_renderer(self, label="", live=True):
+        """Return a renderer which displays a response as its pieces are `feed`-ed in."""
+        raise NotImplementedError
+
 
 class NotebookDisplay(BaseDisplay):
     # TODO: Doesn't render properly
@@ -19,16 +29,149 @@ class NotebookDisplay(BaseDisplay):
     # TEMPLATE = "<div style='width:60%;margin-left:5%;overflow: scroll;max-height:500px'>\n\n{}\n\n</div>"
     TEMPLATE = "<div style='width:60%;margin-left:5%;'>\n\n{}\n\n</div>"
 
-
     def display(self, results):
         display(Markdown(self.TEMPLATE.format(results)))
 
+    def display_updatable(self, results):
+        return NotebookDisplayHandle(self, results)
 
-class ShellDisplay(BaseDisplay):
+    def stream_renderer(self, label="", live=True):
+        return NotebookStreamRenderer(self, label)
 
+
+class ShellDisplay(BaseDisplay):
     def display(self, results):
         print(results)
 
+    def display_updatable(self, results):
+        return ShellDisplayHandle(self, results)
+
+    def stream_renderer(self, label="", live=True):
+        return ShellStreamRenderer(label, live)
+
+
+class NotebookDisplayHandle:
+    """Updates one output area in place (via its `display_id`), from any thread."""
+
+    def __init__(self, notebook_display, results):
+        self._display = notebook_display
+        self._handle = display(self._markdown(results), display_id=True)
+
+    def _markdown(self, results):
+        return Markdown(self._display.TEMPLATE.format(results))
+
+    def update(self, results, final=False):
+        self._handle.update(self._markdown(results))
+
+
+class ShellDisplayHandle:
+    """The terminal can't redraw earlier output, so only the final result is printed."""
+
+    def __init__(self, shell_display, results):
+        self._display = shell_display
+        self._display.display(results)
+
+    def update(self, results, final=False):
+        if final:
+            self._display.display(results)
+
+
+class NotebookStreamRenderer:
+    """Renders a streamed response into a single output area, updated in place.
+
+    Markdown can only be re-rendered as a whole, so updates are throttled adaptively:
+    at least `MIN_INTERVAL` apart, further apart if rendering turns out to be slow, and
+    only once the text has grown by `GROWTH_FRACTION` since the last render. The last
+    condition makes the sizes of successive renders grow geometrically, which keeps the
+    total rendering cost linear in the length of the response.
+    """
+
+    MIN_INTERVAL = 0.1
+    # Spend at most about this fraction of the time rendering.
+    MAX_RENDER_FRACTION = 0.1
+    GROWTH_FRACTION = 0.05
+
+    def __init__(self, notebook_display, label=""):
+        self._display = notebook_display
+        self.label = label
+        self._parts = []
+        self._n_chars = 0
+        self._n_chars_rendered = 0
+        self._t_last_render = monotonic()
+        self._interval = self.MIN_INTERVAL
+        # Create the output area now, so that it belongs to the cell which started the
+        # stream, even if the pieces are fed in from another thread.
+        self._handle = display(self._markdown(), display_id=True)
+
+    @property
+    def text(self):
+        return "".join(self._parts)
+
+    def feed(self, delta):
+        self._parts.append(delta)
+        self._n_chars += len(delta)
+        if (
+            self._n_chars - self._n_chars_rendered
+            >= self.GROWTH_FRACTION * self._n_chars_rendered
+            and monotonic() - self._t_last_render >= self._interval
+        ):
+            self._render()
+
+    def _markdown(self):
+        return Markdown(self._display.TEMPLATE.format(self.label + self.text))
+
+    def _render(self):
+        t_start = monotonic()
+        self._handle.update(self._markdown())
+        t_end = monotonic()
+
+        self._interval = max(
+            self.MIN_INTERVAL, (t_end - t_start) / self.MAX_RENDER_FRACTION
+        )
+        self._t_last_render = t_end
+        self._n_chars_rendered = self._n_chars
+
+    def finish(self, show=True):
+        """Render the complete response, or remove the partial one if not `show`."""
+        if show:
+            self._render()
+        else:
+            self._handle.update(Markdown(""))
+
+
+class ShellStreamRenderer:
+    """Writes each piece of the response straight to stdout as it arrives.
+
+    If not `live` (e.g. for background completions, which would interleave with the
+    prompt), the response is only printed once it is complete.
+    """
+
+    def __init__(self, label="", live=True, stream=None):
+        self.label = label
+        self.live = live
+        self.stream = stream or sys.stdout
+        self._parts = []
+
+    @property
+    def text(self):
+        return "".join(self._parts)
+
+    def feed(self, delta):
+        if self.live:
+            if not self._parts:
+                self.stream.write(self.label)
+            self.stream.write(delta)
+            self.stream.flush()
+        self._parts.append(delta)
+
+    def finish(self, show=True):
+        if self.live:
+            if self._parts:
+                self.stream.write("\n")
+                self.stream.flush()
+        elif show:
+            self.stream.write(self.label + self.text + "\n")
+
 
 DISPLAY_METHODS = {
     "ZMQInteractiveShell": NotebookDisplay,
@@ -39,6 +182,7 @@ DEFAULT_DISPLAY = ShellDisplay
 
 
 def get_registered_display():
-    DisplayClass = DISPLAY_METHODS.get(ipy.get_ipython().__class__.__name__,
-                                       DEFAULT_DISPLAY)
+    DisplayClass = DISPLAY_METHODS.get(
+        ipy.get_ipython().__class__.__name__, DEFAULT_DISPLAY
+    )
     return DisplayClass()
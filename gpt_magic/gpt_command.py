@@ -1,20 +1,31 @@
 import argparse
-from time import time
-import re
 import shlex
 from getpass import getpass
+from itertools import chain
 from typing import Dict, Optional
 
 from .utils import calls_oai_api, get_available_models, get_ipython_history
 
-from IPython.display import clear_output, display, Markdown
-
 from .gpt_state import GPTMagicState
 
 from .displays import get_registered_display
 
 from .api_client import OpenAIClient
 
+from .background import run_in_background
+
+from .context import describe_request_size
+
+from .models import get_model_catalog
+
+from .tracing import Tracer
+
+from .code_parser import CodeStreamParser, is_valid_code
+
+from .routing import estimate_prompt_tokens
+
+from .cell_index import DEFAULT_TOP_K, get_relevant_history
+
 
 def _parse_args(line):
     parser = argparse.ArgumentParser(prog="%%gpt")
@@ -30,7 +41,15 @@ def _parse_args(line):
     parser.add_argument(
         "--followup",
         "-f",
-        help="Continue the conversation.",
+        help="Continue the conversation. Optionally pass a conversation key (e.g. B) or message key (e.g. B2); following up an earlier message starts a new branch.",
+        nargs="?",
+        const="",
+        default=None,
+    )
+    parser.add_argument(
+        "--resume",
+        "-r",
+        help="Continue a response which was cut short (by interrupting the kernel, or by --code), instead of sending a prompt. Optionally pass a conversation key (e.g. B) or message key (e.g. B2), the default is the last conversation.",
         nargs="?",
         const="",
         default=None,
@@ -41,6 +60,18 @@ def _parse_args(line):
         action="store_true",
         help="Generate executable Python code based on <prompt> and put it in this cell.",
     )
+    parser.add_argument(
+        "--keep-explanation",
+        action="store_true",
+        help="With --code, keep streaming (and show) the rest of the response after the code block, rather than stopping as soon as the code is complete.",
+    )
+    parser.add_argument(
+        "--candidates",
+        type=int,
+        default=1,
+        metavar="N",
+        help="With --code, ask for N alternative responses at once and use the first whose code compiles (checked as each one streams in), stopping the others.",
+    )
     parser.add_argument(
         "--model",
         "-m",
@@ -56,6 +87,41 @@ def _parse_args(line):
         const="",
         default=None,
     )
+    parser.add_argument(
+        "--auto-context",
+        "-a",
+        help="Show GPT the cells of this session most relevant to the prompt (up to K, default 5), found with a search index of every cell that has run.",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="K",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always query the API, even if an identical request has been made before.",
+    )
+    parser.add_argument(
+        "--background",
+        "-b",
+        action="store_true",
+        help="Run the completion on a worker thread so other cells can run meanwhile. Returns a handle whose `.result()` is the response.",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Show latency and throughput percentiles of recent requests, then exit.",
+    )
+    parser.add_argument(
+        "--usage",
+        action="store_true",
+        help="Show the tokens used this session (by model and by conversation) and the token budget, then exit.",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="on|off|PATH",
+        help="Turn stage tracing of %%%%gpt commands on or off, or export the recorded trace to PATH (a Chrome trace, or JSON lines if PATH ends with .jsonl), then exit.",
+    )
     parser.add_argument(
         "--debug",
         "-d",
@@ -98,6 +164,9 @@ def _parse_args(line):
         elif args.show is not None:
             args.prompt = args.show
             args.show = ""
+        elif args.auto_context is not None:
+            args.prompt = args.auto_context
+            args.auto_context = ""
 
     return args
 
@@ -180,10 +249,87 @@ def _text_command(prompt: str, history, client: OpenAIClient):
 
 
 def gpt_command(state: GPTMagicState, line, cell=None):
+    tracer = state.tracer
+    with tracer.span("gpt_command", line=line):
+        return _gpt_command(state, tracer, line)
+
+
+def _trace_command(tracer: Tracer, value: str):
+    if value == "on":
+        tracer.enable()
+        print("Tracing enabled.")
+    elif value == "off":
+        tracer.disable()
+        print("Tracing disabled.")
+    else:
+        tracer.export(value)
+        print(f"Exported {len(tracer.spans())} spans to {value}.")
+
+
+def _cached_label(convo) -> str:
+    return f"GPT[{convo.get_message_key()}] (cached): "
+
+
+def _set_next_input(line: str, code: str):
+    get_ipython().set_next_input(f"#%gpt {line}\n{code}", replace=True)
+
+
+def _code_from_candidates(convo, model, n, keep_explanation, renderer, line):
+    """Stream `n` candidate responses, put the code of the first one whose code compiles
+    in the next cell, and add that candidate as the reply. Returns the code, or None if
+    no candidate had valid code."""
+    transform = get_ipython().transform_cell
+    parsers = [CodeStreamParser() for _ in range(n)]
+    texts = [[] for _ in range(n)]
+    winner = None
+    finished = False
+    stream = convo.stream_candidates(model, n)
+    try:
+        for i, delta in stream:
+            texts[i].append(delta)
+            if winner is None:
+                if parsers[i].feed(delta) and is_valid_code(
+                    parsers[i].result(), transform
+                ):
+                    winner = i
+                    _set_next_input(line, parsers[i].result())
+                    if not keep_explanation:
+                        # Skip the rest of all the candidates.
+                        break
+                    renderer.feed("".join(texts[i]))
+            elif i == winner:
+                renderer.feed(delta)
+        else:
+            finished = True
+    except KeyboardInterrupt:
+        # Keep what has arrived, as `do_completion` does. Other errors propagate
+        # without a reply being added.
+        if any(texts):
+            convo.add_response(_best_candidate(texts, parsers, winner), truncated=True)
+        raise
+    finally:
+        stream.close()
+    if any(texts):
+        convo.add_response(
+            _best_candidate(texts, parsers, winner), truncated=not finished
+        )
+    return parsers[winner].result() if winner is not None else None
+
+
+def _best_candidate(texts, parsers, winner) -> str:
+    if winner is None:
+        # Keep the first candidate with any code, `get_code` will extract it.
+        has_code = [i for i, parser in enumerate(parsers) if parser.result()]
+        winner = has_code[0] if has_code else 0
+    return "".join(texts[winner])
+
+
+def _gpt_command(state: GPTMagicState, tracer: Tracer, line):
     ipy_display = get_registered_display()
 
     try:
-        args = _parse_args(line)
+        with tracer.span("parse_args"):
+            args = _parse_args(line)
     except SystemExit as e:
         # Assume this was caused by `--help`.
         return
@@ -191,78 +337,198 @@ def gpt_command(state: GPTMagicState, line, cell=None):
     if args.debug:
         print("Arguments:", args)
 
+    if args.stats:
+        print(state.metrics.format_stats())
+        return
+
+    if args.usage:
+        print(state.accountant.format_usage())
+        return
+
+    if args.trace is not None:
+        _trace_command(tracer, args.trace)
+        return
+
     # if state.openai_api_key is None or args.login:
     #     ipy_display.display(_login_command(state))
 
     if args.model is not None:
-        avail_models = get_available_models()
         if args.model == "":
+            avail_models = get_available_models()
             print("Available models: ", *["• " + m for m in avail_models], sep="\n")
             return
         else:
-            model = args.model
-            if model not in avail_models:
-                choices = [m for m in avail_models if m.endswith(model)]
-                if len(choices) == 0:
-                    raise ValueError(f"Model {model} not found.")
-                model = choices[0]
+            with tracer.span("resolve_model", model=args.model):
+                model = get_model_catalog().resolve(args.model)
+            if model is None:
+                raise ValueError(f"Model {args.model} not found.")
     else:
-        model = state.default_model
+        # Chosen by the routing policy, once the prompt size is known.
+        model = None
 
     # messages = _get_messages(context,
     #                          args.prompt,
     #                          request_code=args.code,
     #                          reset_conversation=not args.followup)
 
-    followup_key = args.followup
-    if followup_key == "":
-        convo_key = state.last_convo_key
-        msg_key = None
-    elif followup_key is not None:
-        convo_key, msg_key = re.match(r"([A-Z]+)(\d*)", followup_key).groups()
-        msg_key = int(msg_key) if msg_key else None
-    else:
-        convo_key = None
-        msg_key = None
-    followup_key = (convo_key, msg_key)
+    resume = args.resume is not None
+    followup_key = state.parse_followup_key(args.resume if resume else args.followup)
 
     ipy_history = []
     if args.show is not None:
         last_n = 1 if args.show == "" else int(args.show)
-        ipy_history = get_ipython_history(last_n)
+        with tracer.span("get_ipython_history", last_n=last_n):
+            ipy_history = get_ipython_history(last_n, state.history_output_tokens)
+
+    if args.auto_context is not None:
+        k = int(args.auto_context) if args.auto_context else DEFAULT_TOP_K
+        with tracer.span("auto_context", k=k) as auto_context_span:
+            relevant = get_relevant_history(
+                args.prompt or "",
+                k,
+                state.auto_context_tokens,
+                state.history_output_tokens,
+            )
+            auto_context_span.set(cells=len(relevant))
+        if args.debug:
+            print("Relevant cells:", ", ".join(f"In[{n}]" for n, _, _ in relevant))
+        # Merged with any cells from `--show`, in execution order.
+        shown = {n for n, _, _ in ipy_history}
+        ipy_history = sorted(ipy_history + [r for r in relevant if r[0] not in shown])
 
     convo = state.get_convo(followup_key)
-    convo.add_prompt(args.prompt, args.code, ipy_history)
-
-    # convo = state.prep_convo(args.prompt, model, followup_key, args.code)
+    cache = None if args.no_cache else state.response_cache
+    semantic_cache = None if args.no_cache else state.semantic_cache
+
+    if model is None:
+        with tracer.span("route_model") as route_span:
+            prompt_tokens = estimate_prompt_tokens(
+                convo.to_messages(), args.prompt, ipy_history
+            )
+            routing = state.routing_policy.route(
+                prompt_tokens, args.code, state.default_model, state.metrics
+            )
+            model = routing.model
+            route_span.set(model=model, prompt_tokens=prompt_tokens)
+        if args.debug:
+            print(routing.describe())
+        elif model != state.default_model:
+            print(f"Using {model} ({routing.reason}).")
+
+    if args.candidates > 1 and (not args.code or resume):
+        print("--candidates needs --code, and can't be combined with --resume.")
+        return
 
-    if args.debug:
-        print("Using model:", model)
-        print("Continuing conversation:", convo.get_message_key())
-        ipy_display.display(convo.to_messages())
-
-    t_last_update = time()
-    for partial_resp in convo.do_completion(model, stream=True):
-        clear_output(wait=True)
-        t_now = time()
-        # Update every 100 ms
-        if t_now - t_last_update > 0.1:
-            display(Markdown(partial_resp))
-            t_last_update = t_now
-    clear_output(wait=False)
-
-    # gpt_resp, new_history = _get_response(messages, context, client,
-    #                                       args.temperature, args.max_tokens)
-    if args.debug:
-        print("RESPONSE:", convo.assistant_messages[-1])
-    # context["message_history"] = new_history
-
-    if args.code:
-        # code_resp = gpt_resp[gpt_resp.index(_CODE_START_MARKER) +
-        #                      len(_CODE_START_MARKER):gpt_resp.
-        #                      index(_CODE_END_MARKER)]
-        code_resp = convo.get_code()
-        get_ipython().set_next_input(f"#%gpt {line}\n{code_resp}", replace=True)
-    else:
-        ipy_display.display(f"GPT[{convo.get_message_key()}]: " + convo.get_message())
-    return
+    if args.background:
+        if args.code or resume:
+            print("--background can't be combined with --code or --resume.")
+            return
+        return run_in_background(
+            state,
+            convo,
+            args.prompt,
+            ipy_history,
+            model,
+            ipy_display,
+            cache,
+            semantic_cache,
+        )
+
+    # Wait for any background completion on this conversation to finish first.
+    with tracer.span("wait_for_conversation"):
+        convo.lock.acquire()
+    try:
+        if resume:
+            if convo.head is None or not convo.head.truncated:
+                print(
+                    f"GPT[{convo.key}]'s last response is complete, nothing to resume."
+                )
+                return
+        else:
+            with tracer.span("add_prompt"):
+                convo.add_prompt(args.prompt, args.code, ipy_history)
+
+        # convo = state.prep_convo(args.prompt, model, followup_key, args.code)
+
+        if args.debug:
+            print("Using model:", model)
+            print("Continuing conversation:", convo.get_message_key())
+            request_messages = convo.to_request_messages(model)
+            if convo.context_policy is not None:
+                print(
+                    describe_request_size(request_messages, model, convo.context_policy)
+                )
+            ipy_display.display(request_messages)
+
+        renderer = ipy_display.stream_renderer(f"GPT[{convo.get_message_key()}]: ")
+        code_parser = CodeStreamParser() if args.code else None
+        code_resp = None
+        if args.candidates > 1:
+            with tracer.span("candidates", model=model, n=args.candidates):
+                code_resp = _code_from_candidates(
+                    convo, model, args.candidates, args.keep_explanation, renderer, line
+                )
+        else:
+            # Time in "stream" which isn't in one of its "render" children is time spent
+            # waiting for the network.
+            with tracer.span("stream", model=model) as stream_span:
+                n_deltas = 0
+                stream = convo.do_completion(
+                    model,
+                    stream=True,
+                    cache=cache,
+                    resume=resume,
+                    semantic_cache=semantic_cache,
+                )
+                # A resumed response is shown (and parsed) from its start.
+                deltas = chain([convo.get_message()], stream) if resume else stream
+                try:
+                    for delta in deltas:
+                        n_deltas += 1
+                        if n_deltas == 1 and convo.head.cache_hit:
+                            renderer.label = _cached_label(convo)
+                        with tracer.span("render"):
+                            renderer.feed(delta)
+                        if code_parser is not None and code_resp is None:
+                            if code_parser.feed(delta):
+                                code_resp = code_parser.result()
+                                with tracer.span("set_next_input"):
+                                    _set_next_input(line, code_resp)
+                                if not args.keep_explanation:
+                                    # Skip the rest of the response.
+                                    break
+                except KeyboardInterrupt:
+                    renderer.finish()
+                    print(
+                        f"\nInterrupted, the partial response was kept. Continue it with"
+                        f" `%%gpt --resume {convo.get_message_key()}`."
+                    )
+                    raise
+                finally:
+                    # Hangs up if the response is incomplete, keeping what has arrived.
+                    stream.close()
+                stream_span.set(deltas=n_deltas)
+        # Code responses are put in the next cell rather than displayed.
+        with tracer.span("render_finish"):
+            renderer.finish(show=not args.code or args.keep_explanation)
+
+        # gpt_resp, new_history = _get_response(messages, context, client,
+        #                                       args.temperature, args.max_tokens)
+        if args.debug:
+            print("RESPONSE:", convo.get_message())
+            if convo.head.cache_hit:
+                print("Cache hit:", convo.head.cache_hit)
+        # context["message_history"] = new_history
+
+        if args.code and code_resp is None:
+            # code_resp = gpt_resp[gpt_resp.index(_CODE_START_MARKER) +
+            #                      len(_CODE_START_MARKER):gpt_resp.
+            #                      index(_CODE_END_MARKER)]
+            # No marker block (or no candidate's code compiled), fall back to a
+            # backtick block or a failure message.
+            with tracer.span("get_code"):
+                code_resp = convo.get_code()
+            with tracer.span("set_next_input"):
+                _set_next_input(line, code_resp)
+    finally:
+        convo.lock.release()
@@ -1,90 +1,456 @@
-from dataclasses import dataclass
-from itertools import chain, count, product, zip_longest
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import count, product
+import os
 import re
+import threading
 from typing import Dict, List, Optional, Tuple, Union
 
-from openai import ChatCompletion
+from .utils import (
+    calls_oai_api,
+    excel_style_column_name_seq,
+    maybe_find_backtick_block,
+    require_openai_api_key,
+)
 
-from .utils import calls_oai_api, excel_style_column_name_seq, maybe_find_backtick_block
+from .api_client import (
+    AsyncOpenAIClient,
+    OpenAIClient,
+    call_api_with_retry,
+    configure_openai,
+)
 
-from .api_client import OpenAIClient
+from .cache import ResponseCache, make_cache_key
+
+from .semantic_cache import SemanticCache
+
+from .code_parser import CODE_END_MARKER, CODE_START_MARKER
+
+from .context import ContextPolicy
+
+from .routing import RoutingPolicy
+
+from .metrics import MetricsRecorder, RequestMetrics, get_metrics_recorder
+
+from .accounting import TokenAccountant, get_token_accountant, usage_counts
+
+from .tracing import Tracer, get_tracer
+
+from .store import ConversationStore, StoredConversations
+
+from .retry import estimate_request_tokens
+
+from .tokens import count_message_tokens, count_tokens
 
 from .displays import BaseDisplay, get_registered_display
 
 FollowupKey = Optional[Tuple[str, Optional[int]]]
 
-_CODE_START_MARKER = "---cell-start---"
-_CODE_END_MARKER = "---cell-end---"
+_CODE_START_MARKER = CODE_START_MARKER
+_CODE_END_MARKER = CODE_END_MARKER
+
+# Sent after a truncated reply, to have GPT finish it (`%%gpt --resume`).
+RESUME_PROMPT = "Your last response was cut off. Continue it from exactly where it stopped, without repeating any of it."
+
+
+def _with_cell_history(prompt: str, cell_lines: List[str]) -> str:
+    cell_history = "\n".join(cell_lines)
+    return f"""
+I am going to give you the inputs and output of some Jupyter notebook cells, then make a request. Use the cell inputs/outputs as context to respond to the request.
+
+CELL HISTORY:
+{cell_history}
+
+REQUEST:
+{prompt}"""
+
+
+class MessageNode:
+    """One exchange in a conversation: a user message, and the assistant's reply once it
+    has arrived.
+
+    Nodes form a tree through `parent`, so following up an earlier message starts a new
+    branch which shares its prefix with the existing ones. `index` is the message number
+    used in message keys, e.g. the node with index 2 in conversation C is "C2".
+    `truncated` marks a reply which was cut short, and `cache_hit` one which was answered
+    from a cache ("exact", or "similar" for the semantic cache), see
+    `Conversation.do_completion`. `prompt` is the request as the user typed it, which
+    `user` wraps with any notebook cells shown to GPT (None if unknown), and
+    `code_request` whether it asked for code (`--code`).
+    """
+
+    __slots__ = (
+        "index",
+        "user",
+        "prompt",
+        "code_request",
+        "assistant",
+        "truncated",
+        "cache_hit",
+        "cells",
+        "carriers",
+        "user_in_full",
+        "parent",
+        "depth",
+    )
+
+    def __init__(self, index: int, user: str, parent: Optional["MessageNode"] = None):
+        self.index = index
+        self.user = user
+        self.prompt: Optional[str] = None
+        self.code_request = False
+        self.assistant: Optional[str] = None
+        self.truncated = False
+        self.cache_hit: Optional[str] = None
+        # Notebook cells included in the user message, as execution count -> hash of
+        # the cell's input and output.
+        self.cells: Dict[int, int] = {}
+        # Earlier messages including the cells which `user` refers back to rather than
+        # repeating, and `user` with those cells in full, for when they aren't sent.
+        self.carriers: Tuple["MessageNode", ...] = ()
+        self.user_in_full: Optional[str] = None
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+
+    def set_reply(self, assistant: str, truncated: bool = False):
+        self.assistant = assistant
+        self.truncated = truncated
+
+    def path(self) -> List["MessageNode"]:
+        """Nodes from the root of the tree down to this one."""
+        nodes = []
+        node = self
+        while node is not None:
+            nodes.append(node)
+            node = node.parent
+        return nodes[::-1]
+
+    def own_messages(self) -> Tuple[Dict, ...]:
+        """This node's user message, and its reply if it has one."""
+        if self.assistant is None:
+            return ({"role": "user", "content": self.user},)
+        return (
+            {"role": "user", "content": self.user},
+            {"role": "assistant", "content": self.assistant},
+        )
+
+    def messages(self) -> List[Dict]:
+        """The user/assistant messages on the path to this node.
+
+        Nodes are the cells of a persistent list, each one only holding its own
+        exchange, so branches share their prefix and replying to (or resuming) a node
+        is seen by all its descendants. The messages are materialized on each call.
+        """
+        return [message for node in self.path() for message in node.own_messages()]
 
 
 @dataclass
 class Conversation:
     """
     We assume all conversations have the role sequence: system, user, assistant, user, assistant, ...
+
+    Messages are stored as a tree of `MessageNode`s. `head` is the latest message of the
+    current branch, which is the one that is continued by the next prompt.
     """
 
     key: str
     system_message: str
-    user_messages: List[str]
-    assistant_messages: List[str]
-
-    def to_messages(self) -> List[Dict]:
-        messages = [
-            ("system", self.system_message),
-            *filter(
-                None,
-                chain.from_iterable(
-                    zip_longest(
-                        (("user", um) for um in self.user_messages),
-                        (("assistant", am) for am in self.assistant_messages),
-                    )
-                ),
-            ),
-        ]
-        messages = [{"role": role, "content": content} for role, content in messages]
-        return messages
+    head: Optional[MessageNode] = None
+    # All messages in the tree, by index.
+    nodes: List[MessageNode] = field(default_factory=list, repr=False)
+    # Held while a prompt/response exchange is in progress, so concurrent (background)
+    # completions on the same conversation don't interleave.
+    lock: threading.RLock = field(
+        default_factory=threading.RLock, repr=False, compare=False
+    )
+    # Decides which messages are sent when the history doesn't fit the context window.
+    context_policy: Optional[ContextPolicy] = None
+    # Where completion metrics are recorded, defaults to the shared recorder.
+    metrics: Optional[MetricsRecorder] = field(default=None, repr=False)
+    # Where messages are persisted, if anywhere.
+    store: Optional[ConversationStore] = field(default=None, repr=False)
+    # Counts the tokens used, and admits requests within the budget. Defaults to the
+    # shared accountant.
+    accountant: Optional[TokenAccountant] = field(default=None, repr=False)
+    # `to_messages()` of the head, as (head, messages), until a message is added or
+    # another one is checked out.
+    _head_messages: Optional[Tuple[MessageNode, List[Dict]]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    @property
+    def user_messages(self) -> List[str]:
+        """User messages on the current branch."""
+        return [node.user for node in self.head.path()] if self.head else []
+
+    @property
+    def assistant_messages(self) -> List[str]:
+        """Assistant messages on the current branch."""
+        if self.head is None:
+            return []
+        return [node.assistant for node in self.head.path() if node.assistant is not None]
+
+    def to_messages(self, node: Optional[MessageNode] = None) -> List[Dict]:
+        """The system message and the messages on the branch ending at `node`, by
+        default the head. The head's are cached, as each command needs them a few
+        times."""
+        if node is None or node is self.head:
+            cached = self._head_messages
+            if cached is None or cached[0] is not self.head:
+                cached = (self.head, self._build_messages(self.head))
+                self._head_messages = cached
+            return list(cached[1])
+        return self._build_messages(node)
+
+    def _build_messages(self, node: Optional[MessageNode]) -> List[Dict]:
+        branch = node.messages() if node is not None else []
+        return [{"role": "system", "content": self.system_message}, *branch]
+
+    def to_request_messages(
+        self, model: str, max_tokens=None, node: Optional[MessageNode] = None
+    ) -> List[Dict]:
+        """The messages actually sent to the API, after applying the context policy.
+
+        If the policy leaves out (or shortens) an earlier message including a cell which
+        the head message refers back to, the head message is sent with its cells in full.
+        """
+        messages = self.to_messages(node)
+        if self.context_policy is None:
+            return messages
+        request = self.context_policy.apply(messages, model, max_tokens)
+        head = node or self.head
+        if head is not None and head.user_in_full is not None:
+            sent = {m["content"] for m in request if m["role"] == "user"}
+            if any(node.user not in sent for node in head.carriers):
+                i = len(messages) - len(head.own_messages())
+                messages[i] = {"role": "user", "content": head.user_in_full}
+                request = self.context_policy.apply(messages, model, max_tokens)
+        return request
+
+    def _admit(
+        self, kwargs: Dict, resume: bool = False, node: Optional[MessageNode] = None
+    ) -> bool:
+        """Check the request `kwargs` against the token budget, before it is sent.
+        Switches it to a cheaper model (rebuilding its messages for that model) if the
+        budget says so, and returns whether it did."""
+        accountant = self.accountant or get_token_accountant()
+        model = accountant.admit(
+            kwargs["model"], estimate_request_tokens(kwargs), self.key
+        )
+        if model == kwargs["model"]:
+            return False
+        messages = self.to_request_messages(model, kwargs["max_tokens"], node)
+        if resume:
+            messages = [*messages, {"role": "user", "content": RESUME_PROMPT}]
+        kwargs.update(model=model, messages=messages)
+        return True
+
+    def _record_usage(self, kwargs: Dict, usage, completion: str):
+        prompt_tokens, completion_tokens = usage_counts(
+            usage, kwargs["messages"], completion
+        )
+        (self.accountant or get_token_accountant()).record(
+            self.key, kwargs["model"], prompt_tokens, completion_tokens
+        )
+
+    def shown_cells(self) -> Dict[int, Tuple[int, MessageNode]]:
+        """Cells already included in the current branch, as execution count -> (hash,
+        message which included it), see `MessageNode.cells`."""
+        shown = {}
+        if self.head is not None:
+            for node in self.head.path():
+                shown.update((n, (h, node)) for n, h in node.cells.items())
+        return shown
 
     def add_prompt(self, prompt: str, is_code_req: bool, ipy_history: List[Tuple]):
+        cells = {}
+        carriers = {}
+        user_message = prompt
+        user_in_full = None
         if len(ipy_history) > 0:
-            cell_history = "\n".join(
-                [
-                    f"In[{i}]: {inp}\nOut[{i}]: {outp}"
-                    for i, (inp, outp) in enumerate(ipy_history)
-                ]
-            )
-            prompt = f"""
-I am going to give you the inputs and output of some Jupyter notebook cells, then make a request. Use the cell inputs/outputs as context to respond to the request.
-
-CELL HISTORY:
-{cell_history}
-
-REQUEST:
-{prompt}"""
-
+            # Cells which are unchanged since an earlier message on this branch are
+            # referred back to rather than sent again.
+            shown = self.shown_cells()
+            repeated, lines, all_lines = [], [], []
+            for n, inp, outp in ipy_history:
+                cell_hash = hash((inp, outp))
+                cell = f"In[{n}]: {inp}\nOut[{n}]: {outp}"
+                all_lines.append(cell)
+                if n in shown and shown[n][0] == cell_hash:
+                    repeated.append(f"In[{n}]")
+                    carriers[shown[n][1].index] = shown[n][1]
+                else:
+                    cells[n] = cell_hash
+                    lines.append(cell)
+            if repeated:
+                lines.insert(
+                    0, f"({', '.join(repeated)}: as shown earlier in this conversation.)"
+                )
+                user_in_full = _with_cell_history(prompt, all_lines)
+            user_message = _with_cell_history(prompt, lines)
+
+        system_message = self.system_message
         if is_code_req:
             self.system_message = f"You are a helpful Python data science coding assistant. You are helping the user to write code which runs in a Jupyter notebook cell. If the user asks you to do something, interpret this as a request to provide code which does that thing. For example if the user asks for the time, you should provide code which prints the current time. At the end of each response you must include a block which starts with '{_CODE_START_MARKER}' (followed by a newline) and ends with '{_CODE_END_MARKER}'. This block should contain the code which you want to put in the IPython cell. Only valid, executable Python code should appear between these two markers. No backticks."
-        self.user_messages.append(prompt)
+        node = MessageNode(len(self.nodes), user_message, self.head)
+        node.prompt = prompt
+        node.code_request = is_code_req
+        node.cells = cells
+        node.carriers = tuple(carriers.values())
+        node.user_in_full = user_in_full
+        self.nodes.append(node)
+        self.head = node
+        self._head_messages = None
+
+        if self.store is not None:
+            self.store.append_message(self.key, node, "user", user_message)
+            if self.system_message != system_message:
+                self.store.append_message(self.key, node, "system", self.system_message)
+        return node
+
+    def add_response(
+        self,
+        response: str,
+        truncated: bool = False,
+        node: Optional[MessageNode] = None,
+    ):
+        """Reply to `node`, by default the head message."""
+        node = node or self.head
+        node.set_reply(response, truncated)
+        # The reply may be to an ancestor of the head, so is on its branch too.
+        self._head_messages = None
+        if self.store is not None:
+            self.store.append_message(self.key, node, "assistant", response, truncated)
 
     @calls_oai_api
     def do_completion(
-        self, model, temperature=None, max_tokens=None, stream: bool = False
+        self,
+        model,
+        temperature=None,
+        max_tokens=None,
+        stream: bool = False,
+        cache: Optional[ResponseCache] = None,
+        resume: bool = False,
+        semantic_cache: Optional[SemanticCache] = None,
     ):
+        """Get GPT's reply to the conversation and add it to the head message.
+
+        If `stream`, yields each new piece (delta) of the reply as it arrives. If the
+        stream is closed early, or the kernel is interrupted while it is being read, its
+        connection is closed and the partial reply is kept, marked as truncated.
+
+        If `resume`, the head message's truncated reply is continued instead, and only
+        the new pieces are yielded.
+
+        Replies are looked up in `cache` by the exact request, then in `semantic_cache`
+        by the meaning of the prompt. Other requests are checked against the token
+        budget first, which may send them to a cheaper model, or raise
+        `BudgetExceeded`.
+        """
+        messages = self.to_request_messages(model, max_tokens)
+        prefix = ""
+        if resume:
+            prefix = self.head.assistant or ""
+            messages = [*messages, {"role": "user", "content": RESUME_PROMPT}]
         kwargs = {
             "model": model,
-            "messages": self.to_messages(),
+            "messages": messages,
             "temperature": temperature,
             "max_tokens": max_tokens,
         }
-        api_resp = ChatCompletion.create(**kwargs, stream=stream)
 
-        if stream:
-            partial_resp = ""
-            for chunk in api_resp:
-                partial_resp += chunk['choices'][0]['delta'].get("content", "")
-                yield partial_resp
-            chat_response = partial_resp
-        else:
-            chat_response = api_resp["choices"][0]["message"]["content"]
+        cache_key = make_cache_key(**kwargs) if cache is not None else None
+        chat_response = cache.get(cache_key) if cache is not None else None
+        self.head.cache_hit = "exact" if chat_response is not None else None
+        # Where the response is added to the semantic cache, after a miss.
+        semantic_entry = None
+        if chat_response is None and semantic_cache is not None and not resume:
+            chat_response, semantic_entry = self._semantic_lookup(semantic_cache, kwargs)
+            if chat_response is not None:
+                self.head.cache_hit = "similar"
+
+        if chat_response is None and self._admit(kwargs, resume):
+            # Downgraded, so cached under the model actually used.
+            model = kwargs["model"]
+            if cache is not None:
+                cache_key = make_cache_key(**kwargs)
+            if semantic_entry is not None:
+                context, _ = self._split_semantic_request(semantic_cache, kwargs)
+                semantic_entry = (context, *semantic_entry[1:])
+
+        metrics = RequestMetrics("completion", "/chat/completions", model)
+        error = None
+        # The response's token counts, if the API sends them.
+        usage = None
+        try:
+            if chat_response is not None:
+                metrics.cached = True
+                # Replay the cached response as if it had been streamed as one delta.
+                if stream:
+                    metrics.first_token()
+                    yield chat_response
+            else:
+                from openai import ChatCompletion
+
+                configure_openai()
+                api_resp = call_api_with_retry(
+                    lambda: ChatCompletion.create(**kwargs, stream=stream),
+                    tokens=estimate_request_tokens(kwargs),
+                    on_retry=metrics.count_retry,
+                )
+
+                if stream:
+                    parts = []
+                    try:
+                        for chunk in api_resp:
+                            metrics.chunks += 1
+                            usage = chunk.get("usage") or usage
+                            if not chunk["choices"]:
+                                continue
+                            delta = chunk["choices"][0]["delta"].get("content", "")
+                            if delta:
+                                metrics.first_token()
+                                metrics.bytes += len(delta.encode("utf-8"))
+                                parts.append(delta)
+                                yield delta
+                    except (GeneratorExit, KeyboardInterrupt):
+                        # The caller stopped reading early (e.g. `--code` once the code
+                        # block is complete), or the kernel was interrupted. Closing
+                        # the `openai` stream hangs up, so the server stops generating.
+                        # Keep what has arrived, but don't cache it.
+                        if hasattr(api_resp, "close"):
+                            api_resp.close()
+                        metrics.output_tokens = count_tokens("".join(parts))
+                        self._record_usage(kwargs, usage, "".join(parts))
+                        self.add_response(prefix + "".join(parts), truncated=True)
+                        raise
+                    chat_response = "".join(parts)
+                else:
+                    metrics.first_token()
+                    metrics.chunks = 1
+                    chat_response = api_resp["choices"][0]["message"]["content"]
+                    metrics.bytes = len(chat_response.encode("utf-8"))
+                    usage = api_resp.get("usage")
+                self._record_usage(kwargs, usage, chat_response)
+
+                if cache is not None:
+                    cache.put(cache_key, chat_response)
+                if semantic_entry is not None:
+                    context, prompt, vector = semantic_entry
+                    semantic_cache.put(context, prompt, chat_response, vector)
+            metrics.output_tokens = count_tokens(chat_response)
+        except (GeneratorExit, KeyboardInterrupt):
+            metrics.cancelled = True
+            if metrics.cached:
+                self.add_response(prefix + chat_response)
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            metrics.finish(error)
+            (self.metrics or get_metrics_recorder()).record(metrics)
 
         # json_body = {
         #     "model": model,
@@ -98,17 +464,199 @@ REQUEST:
 
         # client = OpenAIClient()
         # resp = client.request("POST", "/chat/completions", json_body=json_body)
-        self.assistant_messages.append(chat_response)
+        self.add_response(prefix + chat_response)
+
+    def _split_semantic_request(self, semantic_cache: SemanticCache, request: Dict):
+        return semantic_cache.split_request(
+            prompt=self.head.prompt, code_request=self.head.code_request, **request
+        )
+
+    def _semantic_lookup(self, semantic_cache: SemanticCache, request: Dict):
+        """(cached response or None, (context key, prompt, prompt vector) to cache the
+        response under). The cache is best-effort, so a failing embedder is a miss."""
+        context, prompt = self._split_semantic_request(semantic_cache, request)
+        try:
+            response, _, vector = semantic_cache.lookup(context, prompt)
+        except Exception:
+            return None, None
+        return response, (context, prompt, vector)
+
+    @calls_oai_api
+    def stream_candidates(self, model, n: int, temperature=None, max_tokens=None):
+        """Stream `n` alternative replies to the head message, from one request.
+
+        Yields (candidate index, delta) pairs as they arrive. Closing the generator
+        stops all the candidates. Unlike `do_completion` no reply is added (or cached),
+        the caller picks one and adds it with `add_response`.
+        """
+        kwargs = {
+            "model": model,
+            "messages": self.to_request_messages(model, max_tokens),
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "n": n,
+        }
+        self._admit(kwargs)
+        model = kwargs["model"]
+        metrics = RequestMetrics("completion", "/chat/completions", model)
+        error = None
+        usage = None
+        sent = False
+        try:
+            from openai import ChatCompletion
+
+            configure_openai()
+            api_resp = call_api_with_retry(
+                lambda: ChatCompletion.create(**kwargs, stream=True),
+                tokens=estimate_request_tokens(kwargs),
+                on_retry=metrics.count_retry,
+            )
+            sent = True
+            try:
+                for chunk in api_resp:
+                    metrics.chunks += 1
+                    usage = chunk.get("usage") or usage
+                    for choice in chunk["choices"]:
+                        delta = choice["delta"].get("content", "")
+                        if delta:
+                            metrics.first_token()
+                            metrics.bytes += len(delta.encode("utf-8"))
+                            metrics.output_tokens += count_tokens(delta)
+                            yield choice["index"], delta
+            finally:
+                if hasattr(api_resp, "close"):
+                    api_resp.close()
+        except (GeneratorExit, KeyboardInterrupt):
+            metrics.cancelled = True
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            metrics.finish(error)
+            (self.metrics or get_metrics_recorder()).record(metrics)
+            if sent:
+                # Each candidate's tokens were counted as they streamed.
+                counted = {
+                    "prompt_tokens": count_message_tokens(kwargs["messages"]),
+                    "completion_tokens": metrics.output_tokens,
+                }
+                self._record_usage(kwargs, usage or counted, "")
+
+    def complete(self, model, **kwargs) -> str:
+        """Run a non-streamed `do_completion` and return the response."""
+        for _ in self.do_completion(model, stream=False, **kwargs):
+            pass
+        return self.get_message()
+
+    async def ado_completion(
+        self,
+        model,
+        temperature=None,
+        max_tokens=None,
+        cache: Optional[ResponseCache] = None,
+        client: Optional[AsyncOpenAIClient] = None,
+        node: Optional[MessageNode] = None,
+    ):
+        """Async version of `do_completion`. Yields each new piece of the response.
+
+        The reply is added to `node` (by default the head when the completion starts),
+        so completions running concurrently on the conversation each reply to their own
+        prompt.
+
+        Unlike `do_completion` it can't prompt for a missing API key, so raises
+        `AuthenticationError` instead, unless a `client` is given.
+        """
+        node = node or self.head
+        json_body = {
+            "model": model,
+            "messages": self.to_request_messages(model, max_tokens, node),
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        }
+
+        cache_key = make_cache_key(**json_body) if cache is not None else None
+        chat_response = cache.get(cache_key) if cache is not None else None
+
+        if chat_response is None:
+            if client is None:
+                client = AsyncOpenAIClient(require_openai_api_key())
+            if self._admit(json_body, node=node) and cache is not None:
+                cache_key = make_cache_key(**json_body)
+
+        metrics = RequestMetrics("completion", "/chat/completions", json_body["model"])
+        error = None
+        try:
+            if chat_response is not None:
+                metrics.cached = True
+                metrics.first_token()
+                yield chat_response
+            else:
+                request_body = {k: v for k, v in json_body.items() if v is not None}
+                parts = []
+                usage = None
+                sent = False
+                try:
+                    async for chunk in client.stream(
+                        "POST", "/chat/completions", json_body=request_body
+                    ):
+                        sent = True
+                        metrics.chunks += 1
+                        usage = chunk.get("usage") or usage
+                        if not chunk["choices"]:
+                            continue
+                        delta = chunk["choices"][0]["delta"].get("content", "")
+                        if delta:
+                            metrics.first_token()
+                            metrics.bytes += len(delta.encode("utf-8"))
+                            parts.append(delta)
+                            yield delta
+                except (GeneratorExit, asyncio.CancelledError, KeyboardInterrupt):
+                    # Keep what has arrived, but don't cache it.
+                    metrics.output_tokens = count_tokens("".join(parts))
+                    self.add_response("".join(parts), truncated=True, node=node)
+                    raise
+                finally:
+                    # As in `do_completion`, a stream closed or cancelled part way
+                    # still counts the tokens generated so far.
+                    if sent:
+                        self._record_usage(json_body, usage, "".join(parts))
+                chat_response = "".join(parts)
+
+                if cache is not None:
+                    cache.put(cache_key, chat_response)
+            metrics.output_tokens = count_tokens(chat_response)
+        except (GeneratorExit, asyncio.CancelledError, KeyboardInterrupt):
+            metrics.cancelled = True
+            if metrics.cached:
+                self.add_response(chat_response, node=node)
+            raise
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            metrics.finish(error)
+            (self.metrics or get_metrics_recorder()).record(metrics)
+
+        self.add_response(chat_response, node=node)
+
+    def get_node(self, msg_idx: int = -1) -> MessageNode:
+        """Non-negative indices are message numbers (as in message keys), negative ones
+        count back along the current branch."""
+        if msg_idx >= 0:
+            return self.nodes[msg_idx]
+        return self.head.path()[msg_idx]
 
     def get_message(self, msg_idx: int = -1):
-        return self.assistant_messages[msg_idx]
+        if self.head is None:
+            return None
+        return self.get_node(msg_idx).assistant
 
     def get_message_key(self, msg_idx: int = -1):
-        msg_idx = msg_idx if msg_idx >= 0 else len(self.user_messages) + msg_idx
-        return self.key + str(msg_idx)
+        return self.key + str(self.get_node(msg_idx).index)
 
     def get_code(self, msg_idx: int = -1):
-        msg = self.assistant_messages[msg_idx]
+        msg = self.get_message(msg_idx)
 
         pattern = rf"{_CODE_START_MARKER}\s*(.*?)\s*{_CODE_END_MARKER}"
         matches = re.findall(pattern, msg, flags=re.DOTALL)
@@ -129,9 +677,10 @@ REQUEST:
         outp = "FAILED TO EXTRACT CODE.\nFull GPT Response:\n" + msg
         return "\n".join(["#" + line for line in outp.split("\n")])
 
-    def truncate_to(self, n: int):
-        self.user_messages = self.user_messages[: n + 1]
-        self.assistant_messages = self.assistant_messages[: n + 1]
+    def checkout(self, msg_idx: int):
+        """Make message `msg_idx` the head, so the next prompt branches off from it."""
+        self.head = self.nodes[msg_idx]
+        self._head_messages = None
 
 
 @dataclass
@@ -141,27 +690,114 @@ class GPTMagicState:
     default_system_message: str = "You are a python data science coding assistant"
     conversations = {}
     convo_key_generator = excel_style_column_name_seq()
+    # Guards `conversations` and `convo_key_generator`, which are shared by all
+    # instances and may be used from background completion threads.
+    _lock = threading.RLock()
     last_convo_key: Optional[str] = None
-    display: BaseDisplay = get_registered_display()
+    # Open a connection for `%chat` in the background when the extension is loaded.
+    # Only read if the state is set up first, otherwise see `GPT_MAGIC_PRECONNECT`.
+    preconnect_on_load: bool = False
+    # Applied to new conversations, see `ContextPolicy`.
+    context_policy: ContextPolicy = field(default_factory=ContextPolicy)
+    # Chooses the model when `%%gpt` isn't given `-m`.
+    routing_policy: RoutingPolicy = field(default_factory=RoutingPolicy)
+    # Identical requests are answered from here, unless `%%gpt --no-cache` is used.
+    response_cache: ResponseCache = field(default_factory=ResponseCache)
+    # Answers prompts which mean the same as an earlier one, if set (needs numpy).
+    semantic_cache: Optional[SemanticCache] = field(default=None, repr=False)
+    # Looked up on first use, see `display`.
+    _display: Optional[BaseDisplay] = field(default=None, repr=False)
+    # Workers for `%%gpt --background`.
+    max_background_workers: int = 4
+    _executor: Optional[ThreadPoolExecutor] = field(default=None, repr=False)
+    # Most recent background completion for each conversation key.
+    background_completions: Dict = field(default_factory=dict, repr=False)
+    # Timings of recent requests, see `%gpt --stats`.
+    metrics: MetricsRecorder = field(default_factory=get_metrics_recorder, repr=False)
+    # Tokens used, and the budget for them, see `%gpt --usage`.
+    accountant: TokenAccountant = field(
+        default_factory=get_token_accountant, repr=False
+    )
+    # Budget for each cell output shown to GPT by `%%gpt --show`.
+    history_output_tokens: int = 500
+    # Budget for all the cells chosen by `%%gpt --auto-context`.
+    auto_context_tokens: int = 2000
+    # Stage-level spans of `%%gpt` commands, see `%gpt --trace`.
+    tracer: Tracer = field(default_factory=get_tracer, repr=False)
+    # Persists conversations across kernel restarts, see `enable_store`.
+    store: Optional[ConversationStore] = field(default=None, repr=False)
+
+    def __post_init__(self):
+        path = os.environ.get("GPT_MAGIC_STORE", "")
+        if self.store is None and path not in ("", "0"):
+            self.enable_store(None if path == "1" else path)
+
+    def enable_store(self, path=None, notebook: Optional[str] = None):
+        """Persist this notebook's conversations in an SQLite database (by default in
+        ~/.local/share/gpt_magic), and resume the ones stored by earlier sessions."""
+        store = ConversationStore(path, notebook)
+        with self._lock:
+            self.store = store
+            # Instance attributes, shadowing the in-memory class level ones.
+            self.conversations = StoredConversations(
+                store,
+                context_policy=self.context_policy,
+                metrics=self.metrics,
+                accountant=self.accountant,
+            )
+            self.convo_key_generator = excel_style_column_name_seq(
+                store.conversation_count()
+            )
+            self.last_convo_key = store.last_convo_key()
+
+    @property
+    def display(self) -> BaseDisplay:
+        if self._display is None:
+            self._display = get_registered_display()
+        return self._display
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_background_workers,
+                    thread_name_prefix="gpt-magic",
+                )
+            return self._executor
+
+    def parse_followup_key(self, followup: Optional[str]) -> FollowupKey:
+        """Parse the value of `--followup` (e.g. "", "B" or "C2") into a FollowupKey."""
+        if followup == "":
+            return self.last_convo_key, None
+        if followup is not None:
+            convo_key, msg_key = re.match(r"([A-Z]+)(\d*)", followup).groups()
+            return convo_key, int(msg_key) if msg_key else None
+        return None, None
 
     def get_convo(self, followup_key: FollowupKey) -> Conversation:
         convo_key, msg_key = followup_key
 
-        if convo_key is None:
-            convo_key = next(self.convo_key_generator)
-            convo = Conversation(
-                key=convo_key,
-                system_message=self.default_system_message,
-                user_messages=[],
-                assistant_messages=[],
-            )
-            self.conversations[convo_key] = convo
+        with self._lock:
+            if convo_key is None:
+                convo_key = next(self.convo_key_generator)
+                convo = Conversation(
+                    key=convo_key,
+                    system_message=self.default_system_message,
+                    context_policy=self.context_policy,
+                    metrics=self.metrics,
+                    accountant=self.accountant,
+                )
+                self.conversations[convo_key] = convo
+
+            convo = self.conversations[convo_key]
+            if self.store is not None and self.last_convo_key != convo.key:
+                self.store.set_last_convo_key(convo.key)
+            self.last_convo_key = convo.key
 
-        convo = self.conversations[convo_key]
         if msg_key is not None:
-            convo.truncate_to(msg_key)
+            with convo.lock:
+                convo.checkout(msg_key)
 
-        self.last_convo_key = convo.key
         return convo
 
     # def prep_convo(self, prompt: str, model: str, followup_key: FollowupKey,
@@ -0,0 +1,120 @@
+"""The notebook cells shown to GPT by `%%gpt --show`.
+
+Only the requested range of the input history is read, and each output is summarized
+to fit a token budget: DataFrames, Series and arrays by their shape, dtypes and first
+rows, anything else by its (truncated) text. Serialized outputs are memoized by
+execution count, since `Out[n]` doesn't change once cell `n` has run.
+"""
+import reprlib
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, List, Tuple
+
+from IPython.core.getipython import get_ipython
+
+from .tokens import truncate_to_tokens
+
+DEFAULT_OUTPUT_TOKENS = 500
+HEAD_ROWS = 5
+# Arrays with more elements than this are summarized rather than printed in full.
+ARRAY_SUMMARY_THRESHOLD = 100
+
+# (execution count, cell input, serialized cell output)
+CellRecord = Tuple[int, str, str]
+
+_repr = reprlib.Repr()
+_repr.maxlist = _repr.maxtuple = _repr.maxset = _repr.maxfrozenset = 20
+_repr.maxdict = 20
+_repr.maxstring = _repr.maxother = 200
+
+
+def _summarize_pandas(outp) -> str:
+    kind = type(outp).__name__
+    if kind == "DataFrame":
+        return (
+            f"DataFrame with shape {outp.shape}\n"
+            f"Column dtypes:\n{outp.dtypes.to_string()}\n"
+            f"First {HEAD_ROWS} rows:\n{outp.head(HEAD_ROWS).to_string()}"
+        )
+    if kind == "Series":
+        return (
+            f"Series {outp.name!r} with shape {outp.shape} and dtype {outp.dtype}\n"
+            f"First {HEAD_ROWS} rows:\n{outp.head(HEAD_ROWS).to_string()}"
+        )
+    return str(outp)
+
+
+def _summarize_numpy(outp) -> str:
+    if outp.size <= ARRAY_SUMMARY_THRESHOLD:
+        return str(outp)
+    # numpy must already be imported, since `outp` is an array.
+    numpy = sys.modules["numpy"]
+    values = numpy.array2string(outp, threshold=ARRAY_SUMMARY_THRESHOLD, edgeitems=3)
+    return f"{type(outp).__name__} with shape {outp.shape} and dtype {outp.dtype}\n{values}"
+
+
+def summarize_output(outp: Any, max_tokens: int = DEFAULT_OUTPUT_TOKENS) -> str:
+    """Text describing a cell's output, of at most roughly `max_tokens` tokens."""
+    package = type(outp).__module__.split(".")[0]
+    if package == "pandas":
+        text = _summarize_pandas(outp)
+    elif package == "numpy" and hasattr(outp, "shape") and hasattr(outp, "size"):
+        text = _summarize_numpy(outp)
+    elif isinstance(outp, (list, tuple, dict, set, frozenset)):
+        # Bounded, however large the container.
+        text = _repr.repr(outp)
+    else:
+        text = str(outp)
+
+    # Cut very long text down cheaply before counting its tokens.
+    max_chars = max_tokens * 16
+    if len(text) > max_chars:
+        text = text[: max_chars // 2] + text[-max_chars // 2 :]
+    return truncate_to_tokens(text, max_tokens)
+
+
+class HistorySerializer:
+    """Reads and serializes the last cells of the IPython session."""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        # (session, execution count, token budget) -> serialized output
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def serialize_output(self, ipy, n: int, max_tokens: int) -> str:
+        key = (ipy.history_manager.session_number, n, max_tokens)
+        with self._lock:
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                return self._memo[key]
+
+        text = summarize_output(ipy.user_ns["_oh"].get(n), max_tokens)
+
+        with self._lock:
+            self._memo[key] = text
+            if len(self._memo) > self.max_entries:
+                self._memo.popitem(last=False)
+        return text
+
+    def get_history(
+        self, last_n: int = 1, max_output_tokens: int = DEFAULT_OUTPUT_TOKENS
+    ) -> List[CellRecord]:
+        """The last `last_n` cells before the one currently running."""
+        ipy = get_ipython()
+        history_manager = ipy.history_manager
+        # Entry 0 is a placeholder, and the last entry is the running cell.
+        n_entries = len(history_manager.input_hist_raw)
+        start = max(1, n_entries - 1 - last_n)
+        return [
+            (n, inp, self.serialize_output(ipy, n, max_output_tokens))
+            for _, n, inp in history_manager.get_range(start=start, stop=-1)
+        ]
+
+
+_history_serializer = HistorySerializer()
+
+
+def get_history_serializer() -> HistorySerializer:
+    return _history_serializer
@@ -0,0 +1,186 @@
+"""Per-request latency and throughput metrics.
+
+Every completion made through `Conversation.do_completion`, and every request made
+through `OpenAIClient.request`, is recorded as a `RequestMetrics` in a bounded ring
+buffer. View percentiles with `%gpt --stats`, or subscribe to new records:
+
+    get_GPTMagicState().metrics.subscribe(lambda m: statsd.timing("gpt.ttft", m.ttft))
+"""
+import math
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from time import perf_counter, time
+from typing import Callable, Dict, List, Optional, Sequence
+
+DEFAULT_MAX_RECORDS = 1000
+DEFAULT_PERCENTILES = (50, 90, 99)
+
+# Shown by `%gpt --stats`, with their units.
+STATS_FIELDS = {
+    "connect": "ms",
+    "ttft": "ms",
+    "duration": "ms",
+    "chunks": "",
+    "tokens_per_second": "tok/s",
+    "bytes": "B",
+    "retries": "",
+}
+
+
+@dataclass
+class RequestMetrics:
+    """Timings of one request. Durations are in seconds, None when not measured."""
+
+    # "completion" for `Conversation.do_completion`, "api" for `OpenAIClient.request`.
+    source: str
+    endpoint: str
+    model: Optional[str] = None
+    started_at: float = field(default_factory=time)
+    # Setting up a new connection (TCP + TLS), 0 if a kept-alive one was reused. Not
+    # available for completions, which are made by the `openai` package.
+    connect: Optional[float] = None
+    # Time to the first token (the response headers, for unstreamed requests).
+    ttft: Optional[float] = None
+    duration: Optional[float] = None
+    chunks: int = 0
+    output_tokens: int = 0
+    # Size of the response body, or of the streamed text for completions.
+    bytes: int = 0
+    retries: int = 0
+    cached: bool = False
+    # Stopped before the response was complete (a closed stream or an interrupt).
+    cancelled: bool = False
+    error: Optional[str] = None
+    _t_start: float = field(default_factory=perf_counter, repr=False, compare=False)
+
+    def elapsed(self) -> float:
+        return perf_counter() - self._t_start
+
+    def first_token(self):
+        if self.ttft is None:
+            self.ttft = self.elapsed()
+
+    def count_retry(self, exc: BaseException, delay: float):
+        self.retries += 1
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.duration = self.elapsed()
+        if error is not None:
+            message = str(error)
+            self.error = type(error).__name__ + (f": {message}" if message else "")
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        """Output tokens per second while the response was being generated."""
+        if not self.output_tokens or self.duration is None:
+            return None
+        generating = self.duration - (self.ttft or 0)
+        return self.output_tokens / generating if generating > 0 else None
+
+
+def percentile(values: Sequence[float], p: float) -> float:
+    """The `p`th percentile of `values`, interpolating between the closest ranks."""
+    values = sorted(values)
+    rank = (len(values) - 1) * p / 100
+    low, high = math.floor(rank), math.ceil(rank)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+class MetricsRecorder:
+    """Ring buffer of the most recent `RequestMetrics`, with subscriber hooks."""
+
+    def __init__(self, max_records: int = DEFAULT_MAX_RECORDS):
+        self._records = deque(maxlen=max_records)
+        self._subscribers: List[Callable[[RequestMetrics], None]] = []
+        self._lock = threading.Lock()
+
+    def record(self, metrics: RequestMetrics):
+        with self._lock:
+            self._records.append(metrics)
+            subscribers = list(self._subscribers)
+        for fn in subscribers:
+            try:
+                fn(metrics)
+            except Exception:
+                # A broken monitoring hook mustn't break the request.
+                pass
+
+    def subscribe(self, fn: Callable[[RequestMetrics], None]) -> Callable[[], None]:
+        """Call `fn` with each new record. Returns a function which unsubscribes."""
+        with self._lock:
+            self._subscribers.append(fn)
+
+        def unsubscribe():
+            with self._lock:
+                if fn in self._subscribers:
+                    self._subscribers.remove(fn)
+
+        return unsubscribe
+
+    def records(self, source: Optional[str] = None) -> List[RequestMetrics]:
+        with self._lock:
+            records = list(self._records)
+        if source is not None:
+            records = [r for r in records if r.source == source]
+        return records
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    def percentiles(
+        self,
+        name: str,
+        percentiles: Sequence[float] = DEFAULT_PERCENTILES,
+        source: Optional[str] = None,
+    ) -> Dict[float, float]:
+        """Percentiles of metric `name` over the uncached, successful requests."""
+        values = [
+            getattr(r, name)
+            for r in self.records(source)
+            if not r.cached and r.error is None
+        ]
+        values = [v for v in values if v is not None]
+        if not values:
+            return {}
+        return {p: percentile(values, p) for p in percentiles}
+
+    def format_stats(self, percentiles: Sequence[float] = DEFAULT_PERCENTILES) -> str:
+        """A table of percentiles for each source, as shown by `%gpt --stats`."""
+        records = self.records()
+        if not records:
+            return "No requests recorded yet."
+
+        header = f"{'':<22}" + "".join(f"{f'p{p:g}':>10}" for p in percentiles)
+        lines = []
+        for source in sorted({r.source for r in records}):
+            source_records = [r for r in records if r.source == source]
+            n_cached = sum(r.cached for r in source_records)
+            n_failed = sum(r.error is not None for r in source_records)
+            n_cancelled = sum(r.cancelled for r in source_records)
+            cancelled = f", {n_cancelled} cancelled" if n_cancelled else ""
+            lines.append(
+                f"{source}: {len(source_records)} requests"
+                f" ({n_cached} cached, {n_failed} failed{cancelled})"
+            )
+            lines.append(header)
+            for name, unit in STATS_FIELDS.items():
+                values = self.percentiles(name, percentiles, source)
+                if not values:
+                    continue
+                scale = 1000 if unit == "ms" else 1
+                label = f"  {name} ({unit})" if unit else f"  {name}"
+                lines.append(
+                    f"{label:<22}"
+                    + "".join(f"{values[p] * scale:>10.1f}" for p in percentiles)
+                )
+            lines.append("")
+        return "\n".join(lines).rstrip()
+
+
+_metrics_recorder = MetricsRecorder()
+
+
+def get_metrics_recorder() -> MetricsRecorder:
+    return _metrics_recorder
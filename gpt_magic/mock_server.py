@@ -0,0 +1,295 @@
+"""A local stand-in for the OpenAI API, for benchmarks and tests that mustn't use the
+network.
+
+    python -m gpt_magic.mock_server --port 8000 --latency 0.3 --tokens-per-second 60
+
+Then point the extension at it with `OPENAI_API_BASE=http://127.0.0.1:8000/v1`, or
+`gpt_magic.api_client.set_api_base("http://127.0.0.1:8000/v1")`.
+
+Serves `POST /v1/chat/completions` (streamed as server-sent events, or not) and
+`GET /v1/models`. The reply is the same for every request unless `reply` is a function
+of the request body.
+"""
+import argparse
+import json
+import threading
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from time import sleep, time
+from typing import Callable, Dict, List, Optional, Union
+
+from .tokens import count_message_tokens, count_tokens
+
+DEFAULT_REPLY = (
+    "Here is one way to do it:\n"
+    "---cell-start---\n"
+    "import pandas as pd\n"
+    "\n"
+    "df = pd.read_csv('data.csv')\n"
+    "df.groupby('category')['value'].mean().plot.bar()\n"
+    "---cell-end---\n"
+    "This reads the file, averages `value` for each category and plots the result "
+    "as a bar chart. "
+) + "Adjust the column names to match your data. " * 8
+
+DEFAULT_MODELS = ["gpt-3.5-turbo", "gpt-3.5-turbo-16k", "gpt-4", "text-davinci-003"]
+
+
+@dataclass
+class MockServerConfig:
+    reply: Union[str, Callable[[Dict], str]] = DEFAULT_REPLY
+    # Characters per streamed delta, roughly one token by default.
+    chunk_chars: int = 4
+    # Seconds before the response starts, i.e. the server side of time-to-first-token.
+    latency: float = 0.0
+    # Deltas streamed per second. None streams them as fast as possible.
+    tokens_per_second: Optional[float] = None
+    models: List[str] = field(default_factory=lambda: list(DEFAULT_MODELS))
+    # Statuses to fail the next requests with, e.g. [429, 429] to exercise retries.
+    fail_statuses: List[int] = field(default_factory=list)
+    # Served under this path, e.g. "/openai" to stand in for a proxy.
+    path_prefix: str = ""
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Like real API servers, so small SSE writes aren't held back by Nagle's algorithm.
+    disable_nagle_algorithm = True
+    server: "MockOpenAIServer"
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.count_connection()
+
+    def _is_path(self, path: str) -> bool:
+        return self.path.rstrip("/") == self.server.config.path_prefix + path
+
+    def _send_json(self, status, obj, headers=None):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        return json.loads(body) if body else {}
+
+    def _maybe_fail(self) -> bool:
+        status = self.server.next_failure()
+        if status is None:
+            return False
+        self._send_json(
+            status,
+            {"error": {"message": "Mock failure", "type": "mock_error"}},
+            {"Retry-After": "0"},
+        )
+        return True
+
+    def do_GET(self):
+        self.server.count_request()
+        if not self._is_path("/v1/models"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        if self._maybe_fail():
+            return
+        models = [
+            {"id": model, "object": "model", "owned_by": "mock"}
+            for model in self.server.config.models
+        ]
+        self._send_json(200, {"object": "list", "data": models})
+
+    def do_POST(self):
+        self.server.count_request()
+        request = self._read_json()
+        if not self._is_path("/v1/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        if self._maybe_fail():
+            return
+
+        config = self.server.config
+        reply = config.reply(request) if callable(config.reply) else config.reply
+        if config.latency:
+            sleep(config.latency)
+        try:
+            if request.get("stream"):
+                self._stream_reply(request, reply)
+            else:
+                self._send_json(200, self.server.completion(request, reply))
+        except (BrokenPipeError, ConnectionResetError):
+            # The client hung up, e.g. because the user interrupted the stream.
+            self.close_connection = True
+            self.server.count_disconnect()
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _stream_reply(self, request, reply):
+        config = self.server.config
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        chunk_id = f"chatcmpl-mock-{self.server.request_count}"
+        step = max(1, config.chunk_chars)
+        deltas = [{"role": "assistant", "content": ""}]
+        deltas += [{"content": reply[i : i + step]} for i in range(0, len(reply), step)]
+        interval = 1 / config.tokens_per_second if config.tokens_per_second else 0
+        for i, delta in enumerate(deltas + [{}]):
+            if interval and i > 1:
+                sleep(interval)
+            event = {
+                "id": chunk_id,
+                "object": "chat.completion.chunk",
+                "created": int(time()),
+                "model": request.get("model", ""),
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": delta,
+                        "finish_reason": None if delta else "stop",
+                    }
+                ],
+            }
+            self._write_chunk(b"data: %s\n\n" % json.dumps(event).encode("utf-8"))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    """The mock API, listening on `host:port` (port 0 picks a free one).
+
+    Use as a context manager to serve on a background thread:
+
+        with MockOpenAIServer(MockServerConfig(latency=0.2)) as server:
+            set_api_base(server.url)
+            ...
+    """
+
+    daemon_threads = True
+    # Room for benchmarks which open many connections at once.
+    request_queue_size = 128
+
+    def __init__(
+        self,
+        config: Optional[MockServerConfig] = None,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        super().__init__((host, port), _Handler)
+        self.config = config or MockServerConfig()
+        self.request_count = 0
+        # Connections accepted, fewer than requests if they are kept alive.
+        self.connection_count = 0
+        # Responses abandoned by the client part way through, and an event set by each.
+        self.disconnect_count = 0
+        self.disconnected = threading.Event()
+        self._counter = count(1)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}{self.config.path_prefix}/v1"
+
+    def count_request(self):
+        with self._lock:
+            self.request_count = next(self._counter)
+
+    def count_connection(self):
+        with self._lock:
+            self.connection_count += 1
+
+    def count_disconnect(self):
+        with self._lock:
+            self.disconnect_count += 1
+        self.disconnected.set()
+
+    def next_failure(self) -> Optional[int]:
+        with self._lock:
+            if self.config.fail_statuses:
+                return self.config.fail_statuses.pop(0)
+        return None
+
+    def completion(self, request: Dict, reply: str) -> Dict:
+        prompt_tokens = count_message_tokens(request.get("messages", []))
+        completion_tokens = count_tokens(reply)
+        return {
+            "id": f"chatcmpl-mock-{self.request_count}",
+            "object": "chat.completion",
+            "created": int(time()),
+            "model": request.get("model", ""),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": reply},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.serve_forever, name="gpt-magic-mock-server", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m gpt_magic.mock_server", description=__doc__.split("\n\n")[0]
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--tokens-per-second", type=float, default=None)
+    parser.add_argument("--chunk-chars", type=int, default=4)
+    args = parser.parse_args(argv)
+
+    config = MockServerConfig(
+        chunk_chars=args.chunk_chars,
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+    )
+    server = MockOpenAIServer(config, args.host, args.port)
+    print(f"Serving a mock OpenAI API at {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
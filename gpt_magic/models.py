@@ -0,0 +1,173 @@
+import json
+import os
+import sys
+import threading
+from pathlib import Path
+from time import time
+from typing import Callable, Dict, List, Optional
+
+from .api_client import DEFAULT_API_BASE
+from .cache import default_cache_dir
+
+ModelFetcher = Callable[[], List[str]]
+
+DEFAULT_TTL_SECONDS = 24 * 3600
+
+
+def default_catalog_path() -> Path:
+    return default_cache_dir().parent / "models.json"
+
+
+def current_api_base() -> str:
+    """The API base `openai` lists the models of, without importing it."""
+    openai = sys.modules.get("openai")
+    if openai is not None:
+        return openai.api_base
+    return os.environ.get("OPENAI_API_BASE") or DEFAULT_API_BASE
+
+
+def fetch_model_ids() -> List[str]:
+    from .utils import list_model_ids
+
+    return list_model_ids()
+
+
+class ModelCatalog:
+    """The model ids available to the API key, cached in memory and on disk.
+
+    A stale catalog is still served, while it is refreshed on a background thread, so
+    the network is only on the critical path the very first time, or when a model
+    can't be found. The catalog belongs to the API base it was fetched from, and is
+    fetched again when the base changes (e.g. to a proxy).
+    """
+
+    def __init__(
+        self,
+        path: Optional[Path] = None,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        fetch: ModelFetcher = fetch_model_ids,
+        api_base: Callable[[], str] = current_api_base,
+    ):
+        self.path = Path(path) if path else default_catalog_path()
+        self.ttl_seconds = ttl_seconds
+        self.fetch = fetch
+        self.api_base = api_base
+        self._lock = threading.Lock()
+        self._models: Optional[List[str]] = None
+        # Chat models, the only ones `resolve` finds.
+        self._model_set = set()
+        self._fetched_at = 0.0
+        self._fetched_from: Optional[str] = None
+        # Suffix -> first chat model with that suffix, so that `-m 4` means `gpt-4`.
+        self._suffix_index: Dict[str, str] = {}
+        self._refresh_thread: Optional[threading.Thread] = None
+
+    def _set_models(self, models: List[str], fetched_at: float, api_base: str):
+        chat_models = self._chat_models(models)
+        suffix_index = {}
+        for model in chat_models:
+            for i in range(len(model)):
+                suffix_index.setdefault(model[i:], model)
+        with self._lock:
+            self._models = list(models)
+            self._model_set = set(chat_models)
+            self._fetched_at = fetched_at
+            self._fetched_from = api_base
+            self._suffix_index = suffix_index
+
+    @staticmethod
+    def _chat_models(models: List[str]) -> List[str]:
+        return [m for m in models if m.startswith("gpt")]
+
+    def _load(self, api_base: str) -> bool:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data["api_base"] != api_base:
+                return False
+            self._set_models(data["models"], data["fetched_at"], api_base)
+            return True
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+
+    def _save(self):
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(f".{threading.get_ident()}.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "api_base": self._fetched_from,
+                        "models": self._models,
+                        "fetched_at": self._fetched_at,
+                    },
+                    f,
+                )
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+    def is_stale(self) -> bool:
+        return time() - self._fetched_at > self.ttl_seconds
+
+    def refresh(self, fetch: Optional[ModelFetcher] = None):
+        """Fetch the list of models now."""
+        api_base = self.api_base()
+        self._set_models((fetch or self.fetch)(), time(), api_base)
+        self._save()
+
+    def _refresh_quietly(self, fetch: Optional[ModelFetcher] = None):
+        try:
+            self.refresh(fetch)
+        except Exception:
+            # Keep serving the stale catalog, the next lookup will try again.
+            pass
+
+    def refresh_in_background(self, fetch: Optional[ModelFetcher] = None):
+        with self._lock:
+            if self._refresh_thread is not None and self._refresh_thread.is_alive():
+                return
+            self._refresh_thread = threading.Thread(
+                target=self._refresh_quietly,
+                args=(fetch,),
+                name="gpt-magic-model-catalog",
+                daemon=True,
+            )
+            self._refresh_thread.start()
+
+    def models(self, fetch: Optional[ModelFetcher] = None) -> List[str]:
+        """All model ids. `fetch` overrides how they are fetched, if they need to be."""
+        api_base = self.api_base()
+        if self._fetched_from != api_base and not self._load(api_base):
+            self.refresh(fetch)
+        elif self.is_stale():
+            self.refresh_in_background(fetch)
+        return list(self._models)
+
+    def chat_models(self, fetch: Optional[ModelFetcher] = None) -> List[str]:
+        return self._chat_models(self.models(fetch))
+
+    def _lookup(self, name: str) -> Optional[str]:
+        if name in self._model_set:
+            return name
+        return self._suffix_index.get(name)
+
+    def resolve(self, name: str) -> Optional[str]:
+        """The model called `name`, or else the first chat model ending with `name`.
+
+        Only goes to the network if the catalog has never been fetched, or if `name`
+        isn't in it (in case the model is new).
+        """
+        self.models()
+        model = self._lookup(name)
+        if model is None and time() - self._fetched_at > 60:
+            self.refresh()
+            model = self._lookup(name)
+        return model
+
+
+_model_catalog = ModelCatalog()
+
+
+def get_model_catalog() -> ModelCatalog:
+    return _model_catalog
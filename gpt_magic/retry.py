@@ -0,0 +1,260 @@
+"""Retries with backoff, and client-side rate limiting.
+
+Used by both `OpenAIClient` (the `%chat` commands) and `Conversation` (the `%%gpt`
+magic), which share the module level `RetryPolicy` and `RateLimiter`, so that all
+requests from a kernel draw from the same requests-per-minute and tokens-per-minute
+budgets.
+"""
+import http.client
+import random
+import re
+import threading
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from itertools import count
+from time import monotonic, sleep, time
+from typing import Callable, Dict, Mapping, Optional
+
+from .tokens import count_message_tokens
+
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Parse durations like "20ms", "1.5s" or "6m0s" (as used in the rate limit reset
+    headers) or a plain number of seconds."""
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts or "".join(n + u for n, u in parts) != value:
+        return None
+    return sum(float(n) * _DURATION_UNITS[u] for n, u in parts)
+
+
+def _get_header(headers, name) -> Optional[str]:
+    if not headers:
+        return None
+    try:
+        value = headers.get(name)
+        if value is None and isinstance(headers, Mapping):
+            # Plain dicts aren't case-insensitive.
+            lowered = {str(k).lower(): v for k, v in headers.items()}
+            value = lowered.get(name)
+    except (AttributeError, TypeError):
+        return None
+    return value if isinstance(value, str) else None
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """Seconds the server asked us to wait, if it said so in the response headers."""
+    value = _get_header(headers, "retry-after-ms")
+    if value is not None and parse_duration(value) is not None:
+        return parse_duration(value) / 1000
+
+    value = _get_header(headers, "retry-after")
+    if value is not None:
+        seconds = parse_duration(value)
+        if seconds is not None:
+            return seconds
+        try:
+            return parsedate_to_datetime(value).timestamp() - time()
+        except (TypeError, ValueError):
+            pass
+
+    # Otherwise wait for whichever rate limit has been used up to reset.
+    resets = []
+    for kind in ("requests", "tokens"):
+        remaining = _get_header(headers, f"x-ratelimit-remaining-{kind}")
+        reset = _get_header(headers, f"x-ratelimit-reset-{kind}")
+        if remaining is not None and reset is not None and remaining.strip() == "0":
+            seconds = parse_duration(reset)
+            if seconds is not None:
+                resets.append(seconds)
+    return max(resets) if resets else None
+
+
+def get_error_status_and_headers(exc: BaseException):
+    """The HTTP status and response headers of a failed request, where available."""
+    # `APIResponseException` uses `status`, `openai.error.OpenAIError` `http_status`.
+    status = getattr(exc, "status", None) or getattr(exc, "http_status", None)
+    if hasattr(exc, "resp_headers"):
+        headers = exc.resp_headers
+    else:
+        headers = getattr(exc, "headers", None)
+    return status, headers
+
+
+def is_retryable(exc: BaseException) -> bool:
+    from openai import error as openai_error
+
+    status, _ = get_error_status_and_headers(exc)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUSES
+    return isinstance(
+        exc,
+        (
+            ConnectionError,
+            TimeoutError,
+            http.client.HTTPException,
+            openai_error.APIConnectionError,
+            openai_error.Timeout,
+            openai_error.TryAgain,
+            openai_error.ServiceUnavailableError,
+        ),
+    )
+
+
+@dataclass
+class RetryPolicy:
+    max_retries: int = 5
+    base_delay: float = 0.5
+    max_delay: float = 60.0
+
+    def backoff(self, attempt: int) -> float:
+        """Exponential backoff with "full jitter", so that many clients which failed at
+        the same time don't all retry at the same time."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def retry_delay(self, exc: BaseException, attempt: int) -> Optional[float]:
+        """Seconds to wait before retry number `attempt` (counting from 0) after `exc`,
+        or None if the request shouldn't be retried."""
+        if attempt >= self.max_retries or not is_retryable(exc):
+            return None
+        _, headers = get_error_status_and_headers(exc)
+        server_delay = parse_retry_after(headers)
+        if server_delay is not None:
+            # Honour the server's delay, plus a little jitter.
+            return min(self.max_delay, max(0.0, server_delay)) + random.uniform(0, 0.1)
+        return self.backoff(attempt)
+
+
+class RateLimiter:
+    """Client-side requests-per-minute and tokens-per-minute budgets.
+
+    Each budget is a token bucket. Callers `reserve` their share before sending a
+    request, and wait for as long as they are told to. Budgets which aren't set
+    explicitly are learned from the `x-ratelimit-*` response headers.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+    ):
+        self._lock = threading.Lock()
+        self._explicit = {
+            "requests": requests_per_minute,
+            "tokens": tokens_per_minute,
+        }
+        self._limits: Dict[str, Optional[float]] = dict(self._explicit)
+        self._levels: Dict[str, float] = {
+            k: v for k, v in self._limits.items() if v is not None
+        }
+        self._t_refill = monotonic()
+
+    def _refill(self):
+        now = monotonic()
+        elapsed = now - self._t_refill
+        self._t_refill = now
+        for kind, level in self._levels.items():
+            limit = self._limits[kind]
+            self._levels[kind] = min(limit, level + elapsed * limit / 60)
+
+    def reserve(self, tokens: int = 0) -> float:
+        """Take one request and `tokens` tokens from the budgets. Returns how many
+        seconds to wait before sending, if the budgets are overdrawn."""
+        wait = 0.0
+        with self._lock:
+            self._refill()
+            for kind, amount in (("requests", 1), ("tokens", tokens)):
+                if kind not in self._levels or not amount:
+                    continue
+                self._levels[kind] -= amount
+                if self._levels[kind] < 0:
+                    wait = max(wait, -self._levels[kind] / (self._limits[kind] / 60))
+        return wait
+
+    def acquire(self, tokens: int = 0):
+        """`reserve`, then wait until the request can be sent."""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            sleep(wait)
+
+    def update_from_headers(self, headers):
+        """Sync our view of the budgets with the server's."""
+        with self._lock:
+            self._refill()
+            for kind in ("requests", "tokens"):
+                limit = _get_header(headers, f"x-ratelimit-limit-{kind}")
+                remaining = _get_header(headers, f"x-ratelimit-remaining-{kind}")
+                try:
+                    limit = float(limit) if limit is not None else None
+                    remaining = float(remaining) if remaining is not None else None
+                except ValueError:
+                    continue
+                if limit and self._explicit[kind] is None:
+                    self._limits[kind] = limit
+                    self._levels.setdefault(kind, limit)
+                if remaining is not None and kind in self._levels:
+                    self._levels[kind] = min(self._levels[kind], remaining)
+
+
+def estimate_request_tokens(json_body: Optional[Dict]) -> int:
+    """Tokens a chat completion request counts against the tokens-per-minute limit.
+
+    The completion reserve is counted once per choice (`n`).
+    """
+    if not json_body or "messages" not in json_body:
+        return 0
+    return count_message_tokens(json_body["messages"]) + (
+        json_body.get("max_tokens") or 0
+    ) * (json_body.get("n") or 1)
+
+
+_retry_policy = RetryPolicy()
+_rate_limiter = RateLimiter()
+
+
+def get_retry_policy() -> RetryPolicy:
+    return _retry_policy
+
+
+def get_rate_limiter() -> RateLimiter:
+    return _rate_limiter
+
+
+def call_with_retry(
+    fn,
+    tokens: int = 0,
+    policy: Optional[RetryPolicy] = None,
+    limiter: Optional[RateLimiter] = None,
+    on_retry: Optional[Callable[[BaseException, float], None]] = None,
+):
+    """Call `fn()` within the rate limits, retrying it if it fails with a retryable
+    error (429, 5xx, dropped connection, ...). `on_retry(exc, delay)` is called before
+    each retry.
+
+    The request's `tokens` are reserved once, retries only take another request from
+    the requests-per-minute budget.
+    """
+    policy = policy or _retry_policy
+    limiter = limiter or _rate_limiter
+    for attempt in count():
+        limiter.acquire(tokens if attempt == 0 else 0)
+        try:
+            return fn()
+        except Exception as e:
+            delay = policy.retry_delay(e, attempt)
+            if delay is None:
+                raise
+            _, headers = get_error_status_and_headers(e)
+            limiter.update_from_headers(headers)
+            if on_retry is not None:
+                on_retry(e, delay)
+            sleep(delay)
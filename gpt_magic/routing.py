@@ -0,0 +1,180 @@
+"""Choosing the model for `%%gpt` commands which don't pass `-m`.
+
+`RoutingPolicy.route` takes the first candidate model (in order of preference) whose
+context window fits the prompt, optionally passing over models which have recently
+been slow to respond. With the default policy the candidate is just the default model,
+and a larger-context model of the same family is used when the prompt doesn't fit in
+it.
+
+    get_GPTMagicState().routing_policy = RoutingPolicy(
+        prose_models=["gpt-3.5-turbo", "gpt-3.5-turbo-16k"],
+        code_models=["gpt-4", "gpt-4-32k"],
+        max_ttft=2.0,
+    )
+
+`%%gpt` notes when a model other than the default is used, and `%%gpt --debug` shows
+why.
+"""
+import re
+from dataclasses import dataclass, field
+from statistics import median
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .metrics import MetricsRecorder
+from .tokens import (
+    TOKENS_PER_MESSAGE,
+    count_message_tokens,
+    count_tokens,
+    get_context_window,
+)
+
+
+_MODEL_VARIANT = re.compile(r"(-\d+k)?(-\d{4})?$")
+
+
+def model_family(model: str) -> str:
+    """The model without its context size and snapshot date, e.g. "gpt-4" for
+    "gpt-4-32k-0613"."""
+    return _MODEL_VARIANT.sub("", model)
+
+
+@dataclass
+class RoutingDecision:
+    model: str
+    reason: str
+    prompt_tokens: int
+    # Each model considered -> why it was passed over, or chosen.
+    considered: Dict[str, str] = field(default_factory=dict)
+
+    def describe(self) -> str:
+        """Summary of the decision, for `--debug` output."""
+        lines = [
+            f"Routed to {self.model} ({self.reason}),"
+            f" prompt ~{self.prompt_tokens} tokens"
+        ]
+        lines += [f"  {model}: {note}" for model, note in self.considered.items()]
+        return "\n".join(lines)
+
+
+@dataclass
+class RoutingPolicy:
+    # Candidates for prose and for `--code` requests, in order of preference. When
+    # empty, the only candidate is the default model.
+    prose_models: List[str] = field(default_factory=list)
+    code_models: List[str] = field(default_factory=list)
+    # Used when none of the candidates can fit the prompt, in order of preference. Only
+    # those in the same family as a candidate (see `model_family`) are considered.
+    fallback_models: List[str] = field(
+        default_factory=lambda: ["gpt-3.5-turbo-16k", "gpt-4-32k"]
+    )
+    # Room left for the response, as in `ContextPolicy`.
+    reserve_tokens: int = 1024
+    # Pass over models whose median time to first token (in seconds) over their last
+    # `latency_window` completions is above this, while a faster one fits. None to
+    # ignore latency.
+    max_ttft: Optional[float] = None
+    latency_window: int = 20
+    # Models with fewer completions than this are assumed to be fast enough.
+    min_latency_samples: int = 3
+
+    def fits(self, model: str, prompt_tokens: int) -> bool:
+        return prompt_tokens + self.reserve_tokens <= get_context_window(model)
+
+    def recent_ttft(self, model: str, metrics: MetricsRecorder) -> Optional[float]:
+        """Median time to first token of the model's recent completions."""
+        ttfts = [
+            r.ttft
+            for r in metrics.records("completion")
+            if r.model == model
+            and not r.cached
+            and r.error is None
+            and r.ttft is not None
+        ][-self.latency_window :]
+        if len(ttfts) < self.min_latency_samples:
+            return None
+        return median(ttfts)
+
+    def route(
+        self,
+        prompt_tokens: int,
+        is_code: bool,
+        default_model: str,
+        metrics: Optional[MetricsRecorder] = None,
+    ) -> RoutingDecision:
+        candidates = (self.code_models if is_code else self.prose_models) or [
+            default_model
+        ]
+        considered = {}
+
+        fitting = self._fitting(candidates, prompt_tokens, considered)
+        if not fitting:
+            families = {model_family(m) for m in candidates}
+            fallbacks = [
+                m
+                for m in self.fallback_models
+                if m not in candidates and model_family(m) in families
+            ]
+            fitting = self._fitting(fallbacks, prompt_tokens, considered)
+
+        if not fitting:
+            # The context policy will have to shorten the history.
+            model = max(considered, key=get_context_window)
+            reason = "nothing fits, largest context window"
+        elif self.max_ttft is None or metrics is None:
+            model, reason = fitting[0], self._reason(fitting[0], candidates)
+        else:
+            model, reason = self._fastest_enough(
+                fitting, candidates, metrics, considered
+            )
+
+        considered[model] = "chosen"
+        return RoutingDecision(model, reason, prompt_tokens, considered)
+
+    def _fastest_enough(
+        self,
+        fitting: List[str],
+        candidates: Sequence[str],
+        metrics: MetricsRecorder,
+        considered: Dict[str, str],
+    ) -> Tuple[str, str]:
+        """The first model which isn't slow, or else the least slow one."""
+        ttfts = {}
+        for model in fitting:
+            ttft = self.recent_ttft(model, metrics)
+            if ttft is None or ttft <= self.max_ttft:
+                return model, self._reason(model, candidates)
+            considered[model] = f"slow, median ttft {ttft:.2f}s"
+            ttfts[model] = ttft
+        return min(ttfts, key=ttfts.get), "all slow, the fastest"
+
+    def _fitting(
+        self, models: Sequence[str], prompt_tokens: int, considered: Dict[str, str]
+    ) -> List[str]:
+        fitting = []
+        for model in models:
+            if self.fits(model, prompt_tokens):
+                fitting.append(model)
+            else:
+                window = get_context_window(model)
+                considered[model] = f"too small, context window {window}"
+        return fitting
+
+    @staticmethod
+    def _reason(model: str, candidates: Sequence[str]) -> str:
+        if model not in candidates:
+            return "fallback, the candidates are too small"
+        return "first candidate" if model == candidates[0] else "next candidate"
+
+
+def estimate_prompt_tokens(
+    messages: List[Dict], prompt: Optional[str], ipy_history: List[Tuple]
+) -> int:
+    """Approximate size of the request once `prompt` (with its cells) is added to the
+    conversation `messages`."""
+    cells = sum(count_tokens(inp) + count_tokens(outp) for _, inp, outp in ipy_history)
+    return (
+        count_message_tokens(messages)
+        + TOKENS_PER_MESSAGE
+        + count_tokens(prompt or "")
+        + cells
+    )
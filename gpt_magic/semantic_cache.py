@@ -0,0 +1,171 @@
+"""Answers for prompts which are worded differently from an earlier one, but mean the
+same thing ("plot df histogram", "histogram of df").
+
+Opt-in, and needs numpy:
+
+    get_GPTMagicState().semantic_cache = SemanticCache(hashed_ngram_embedder())
+    # or, with OpenAI embeddings (one extra API call per uncached prompt):
+    get_GPTMagicState().semantic_cache = SemanticCache(openai_embedder(), threshold=0.95)
+
+Only the prompt, as the user typed it, is compared. The rest of the request must match
+exactly: the notebook cells shown with the prompt, whether code was asked for, and the
+system message, earlier messages, model and parameters. So a cached answer is never
+reused in a different conversation, or once the cells it was about have changed. Vectors are kept in one preallocated float32 matrix,
+and the least recently used entry is evicted once it is full.
+"""
+import re
+import threading
+import zlib
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from .api_client import configure_openai
+from .cache import make_cache_key
+
+# Texts -> one embedding vector per text.
+Embedder = Callable[[List[str]], Sequence[Sequence[float]]]
+
+DEFAULT_THRESHOLD = 0.9
+DEFAULT_MAX_ENTRIES = 1024
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError as e:
+        raise ImportError("The semantic cache needs numpy: pip install numpy") from e
+    return numpy
+
+
+def hashed_ngram_embedder(dim: int = 512) -> Embedder:
+    """A local embedder: counts of words and of their character trigrams, hashed into
+    `dim` buckets. Catches rewordings and reorderings, not synonyms."""
+    np = _numpy()
+
+    def embed(texts: List[str]):
+        vectors = np.zeros((len(texts), dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in _WORD_PATTERN.findall(text.lower()):
+                padded = f" {word} "
+                grams = [word] + [padded[i : i + 3] for i in range(len(padded) - 2)]
+                for gram in grams:
+                    vectors[row, zlib.crc32(gram.encode("utf-8")) % dim] += 1
+        return vectors
+
+    return embed
+
+
+def openai_embedder(model: str = "text-embedding-ada-002") -> Embedder:
+    def embed(texts: List[str]):
+        from openai import Embedding
+
+        configure_openai()
+        resp = Embedding.create(model=model, input=texts)
+        return [item["embedding"] for item in resp["data"]]
+
+    return embed
+
+
+class SemanticCache:
+    """Nearest-neighbour cache of responses, keyed by the embedding of the prompt."""
+
+    def __init__(
+        self,
+        embed: Embedder,
+        threshold: float = DEFAULT_THRESHOLD,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ):
+        self._np = _numpy()
+        self.embed = embed
+        # Minimum cosine similarity for a hit.
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # Allocated on the first `put`, once the embedding size is known.
+        self._vectors = None
+        self._contexts: List[Optional[str]] = [None] * max_entries
+        self._responses: List[Optional[str]] = [None] * max_entries
+        # Slots by context, so only comparable entries are compared.
+        self._slots: Dict[str, List[int]] = {}
+        self._last_used = self._np.zeros(max_entries, dtype=self._np.int64)
+        self._clock = 0
+        self._size = 0
+
+    @staticmethod
+    def split_request(
+        messages: List[Dict],
+        prompt: Optional[str] = None,
+        code_request: bool = False,
+        **request,
+    ) -> Tuple[str, str]:
+        """(context key, prompt) for a request: the prompt is compared by meaning,
+        everything else must match exactly.
+
+        `prompt` is the part of the newest user message the user typed, which it ends
+        with. The rest of the message (the cells shown with it) is part of the context.
+        If it isn't given, the whole message is the prompt.
+        """
+        content = messages[-1]["content"]
+        if prompt is None or not content.endswith(prompt):
+            prompt = content
+        shown = {"role": "user", "content": content[: len(content) - len(prompt)]}
+        context = make_cache_key([*messages[:-1], shown], **request)
+        return f"{'code' if code_request else 'chat'}:{context}", prompt
+
+    def _embed_one(self, prompt: str):
+        np = self._np
+        vector = np.asarray(self.embed([prompt])[0], dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, context: str, prompt: str) -> Tuple[Optional[str], float, object]:
+        """(response, similarity, prompt vector) of the closest cached prompt in the
+        same context. The response is None if nothing is similar enough. Pass the vector
+        back to `put` to avoid embedding the prompt again."""
+        vector = self._embed_one(prompt)
+        with self._lock:
+            slots = self._slots.get(context)
+            if not slots:
+                return None, 0.0, vector
+            similarities = self._vectors[slots] @ vector
+            best = int(similarities.argmax())
+            similarity = float(similarities[best])
+            if similarity < self.threshold:
+                return None, similarity, vector
+            slot = slots[best]
+            self._clock += 1
+            self._last_used[slot] = self._clock
+            return self._responses[slot], similarity, vector
+
+    def put(self, context: str, prompt: str, response: str, vector=None):
+        np = self._np
+        if vector is None:
+            vector = self._embed_one(prompt)
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, len(vector)), np.float32)
+            if self._size < self.max_entries:
+                slot = self._size
+                self._size += 1
+            else:
+                # Evict the least recently used entry.
+                slot = int(self._last_used.argmin())
+                self._slots[self._contexts[slot]].remove(slot)
+            self._vectors[slot] = vector
+            self._contexts[slot] = context
+            self._responses[slot] = response
+            self._slots.setdefault(context, []).append(slot)
+            self._clock += 1
+            self._last_used[slot] = self._clock
+
+    def __len__(self) -> int:
+        return self._size
+
+    def clear(self):
+        with self._lock:
+            self._slots.clear()
+            self._contexts = [None] * self.max_entries
+            self._responses = [None] * self.max_entries
+            self._last_used[:] = 0
+            self._size = 0
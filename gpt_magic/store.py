@@ -0,0 +1,257 @@
+"""Persistent conversations, in an SQLite database.
+
+Every message is appended to the database as soon as it is added to its conversation,
+so nothing is lost when the kernel restarts. Conversations are stored per notebook, and
+are only read back when they are first used (e.g. by `%%gpt -f B`), so loading the
+extension takes the same time however much history has been stored.
+
+Persistence is opt-in, with `get_GPTMagicState().enable_store()` or by setting
+`GPT_MAGIC_STORE` to 1 (or to the path of the database) in the environment.
+"""
+import os
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+from pathlib import Path
+from time import time
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from .gpt_state import Conversation, MessageNode
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notebooks (
+    notebook TEXT PRIMARY KEY,
+    n_conversations INTEGER NOT NULL DEFAULT 0,
+    last_convo_key TEXT
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    notebook TEXT NOT NULL,
+    key TEXT NOT NULL,
+    system_message TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (notebook, key)
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    notebook TEXT NOT NULL,
+    convo_key TEXT NOT NULL,
+    node INTEGER NOT NULL,
+    parent INTEGER,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    truncated INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS messages_by_conversation
+    ON messages (notebook, convo_key, id);
+"""
+
+
+def default_store_path() -> Path:
+    data_home = os.environ.get("XDG_DATA_HOME") or Path.home() / ".local" / "share"
+    return Path(data_home) / "gpt_magic" / "conversations.sqlite3"
+
+
+def get_notebook_key() -> str:
+    """Identifies the notebook the kernel is running, so that each notebook resumes its
+    own conversations."""
+    from IPython.core.getipython import get_ipython
+
+    ipy = get_ipython()
+    # Set by JupyterLab / Notebook 7 and by VS Code.
+    session = ipy.user_ns.get("__session__") if ipy is not None else None
+    session = session or os.environ.get("JPY_SESSION_NAME")
+    if session:
+        return str(session)
+    return f"ipython:{os.getcwd()}"
+
+
+class ConversationStore:
+    """The conversations of one notebook, in an SQLite database shared by all
+    notebooks."""
+
+    def __init__(self, path: Optional[Path] = None, notebook: Optional[str] = None):
+        self.path = Path(path) if path else default_store_path()
+        self.notebook = notebook if notebook is not None else get_notebook_key()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Messages are written from background completion threads too.
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None
+        )
+        with self._lock:
+            # WAL, so that writing a message doesn't wait for an fsync of the database.
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript(_SCHEMA)
+            columns = [
+                row[1] for row in self._db.execute("PRAGMA table_info(messages)")
+            ]
+            if "truncated" not in columns:
+                # Databases written before truncated replies were recorded.
+                self._db.execute(
+                    "ALTER TABLE messages"
+                    " ADD COLUMN truncated INTEGER NOT NULL DEFAULT 0"
+                )
+            self._db.execute(
+                "INSERT OR IGNORE INTO notebooks (notebook) VALUES (?)",
+                (self.notebook,),
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _execute(self, sql: str, params: Tuple = ()) -> List[Tuple]:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def conversation_count(self) -> int:
+        """How many conversation keys have been handed out in this notebook."""
+        [(n,)] = self._execute(
+            "SELECT n_conversations FROM notebooks WHERE notebook = ?",
+            (self.notebook,),
+        )
+        return n
+
+    def last_convo_key(self) -> Optional[str]:
+        [(key,)] = self._execute(
+            "SELECT last_convo_key FROM notebooks WHERE notebook = ?",
+            (self.notebook,),
+        )
+        return key
+
+    def set_last_convo_key(self, key: str):
+        self._execute(
+            "UPDATE notebooks SET last_convo_key = ? WHERE notebook = ?",
+            (key, self.notebook),
+        )
+
+    def keys(self) -> List[str]:
+        rows = self._execute(
+            "SELECT key FROM conversations WHERE notebook = ? ORDER BY created_at",
+            (self.notebook,),
+        )
+        return [key for (key,) in rows]
+
+    def add_conversation(self, convo: "Conversation"):
+        with self._lock:
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.execute(
+                    "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?)",
+                    (self.notebook, convo.key, convo.system_message, time()),
+                )
+                self._db.execute(
+                    "UPDATE notebooks SET n_conversations = n_conversations + 1"
+                    " WHERE notebook = ?",
+                    (self.notebook,),
+                )
+
+    def append_message(
+        self,
+        convo_key: str,
+        node: "MessageNode",
+        role: str,
+        content: str,
+        truncated: bool = False,
+    ):
+        """Append one message. "system" messages replace the conversation's system
+        message from this point on, and later "assistant" messages replace earlier
+        replies to the same node (e.g. when a truncated reply is resumed)."""
+        parent = node.parent.index if node.parent is not None else None
+        self._execute(
+            "INSERT INTO messages"
+            " (notebook, convo_key, node, parent, role, content, created_at, truncated)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                self.notebook,
+                convo_key,
+                node.index,
+                parent,
+                role,
+                content,
+                time(),
+                int(truncated),
+            ),
+        )
+
+    def load_conversation(self, key: str) -> Optional["Conversation"]:
+        from .gpt_state import Conversation, MessageNode
+
+        rows = self._execute(
+            "SELECT system_message FROM conversations WHERE notebook = ? AND key = ?",
+            (self.notebook, key),
+        )
+        if not rows:
+            return None
+        convo = Conversation(key=key, system_message=rows[0][0])
+
+        messages = self._execute(
+            "SELECT node, parent, role, content, truncated FROM messages"
+            " WHERE notebook = ? AND convo_key = ? ORDER BY id",
+            (self.notebook, key),
+        )
+        for index, parent, role, content, truncated in messages:
+            if role == "user":
+                parent = convo.nodes[parent] if parent is not None else None
+                node = MessageNode(index, content, parent)
+                convo.nodes.append(node)
+                convo.head = node
+            elif role == "assistant":
+                convo.nodes[index].set_reply(content, bool(truncated))
+            elif role == "system":
+                convo.system_message = content
+        convo.store = self
+        return convo
+
+
+class StoredConversations(MutableMapping):
+    """`GPTMagicState.conversations`, backed by a `ConversationStore`.
+
+    Conversations are loaded from the store when they are first looked up, and written
+    to it when they are added.
+    """
+
+    def __init__(self, store: ConversationStore, **conversation_kwargs):
+        self.store = store
+        # Applied to conversations as they are loaded, e.g. the context policy.
+        self.conversation_kwargs = conversation_kwargs
+        self._loaded: Dict[str, "Conversation"] = {}
+        self._lock = threading.RLock()
+
+    def __getitem__(self, key: str) -> "Conversation":
+        with self._lock:
+            if key not in self._loaded:
+                convo = self.store.load_conversation(key)
+                if convo is None:
+                    raise KeyError(key)
+                for name, value in self.conversation_kwargs.items():
+                    setattr(convo, name, value)
+                self._loaded[key] = convo
+            return self._loaded[key]
+
+    def __setitem__(self, key: str, convo: "Conversation"):
+        with self._lock:
+            convo.store = self.store
+            self.store.add_conversation(convo)
+            self._loaded[key] = convo
+
+    def __delitem__(self, key: str):
+        # Stored messages are append-only; forget the loaded copy only.
+        with self._lock:
+            del self._loaded[key]
+
+    def __contains__(self, key) -> bool:
+        return key in self._loaded or key in self.store.keys()
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(dict.fromkeys([*self.store.keys(), *self._loaded]))
+
+    def __len__(self) -> int:
+        return len(list(iter(self)))
+
+    def loaded_keys(self) -> List[str]:
+        """Keys of the conversations which have been read into memory."""
+        return list(self._loaded)
@@ -1,7 +1,13 @@
 import argparse
 import shlex
 
+from .accounting import get_token_accountant, usage_counts
 from .api_client import OpenAIClient
+from .models import get_model_catalog
+from .retry import estimate_request_tokens
+
+# Key under which the `%chat` conversation's tokens are counted.
+CHAT_CONVERSATION_KEY = "chat"
 
 
 class BaseIPythonGPTCommand:
@@ -97,8 +103,21 @@ class ChatCommand(BaseIPythonGPTCommand):
         if args.max_tokens:
             json_body["max_tokens"] = args.max_tokens
 
+        accountant = get_token_accountant()
+        json_body["model"] = accountant.admit(
+            model, estimate_request_tokens(json_body), CHAT_CONVERSATION_KEY
+        )
         resp = client.request("POST", "/chat/completions", json_body=json_body)
         chat_response = resp["choices"][0]["message"]["content"]
+        prompt_tokens, completion_tokens = usage_counts(
+            resp.get("usage"), messages, chat_response
+        )
+        accountant.record(
+            CHAT_CONVERSATION_KEY,
+            json_body["model"],
+            prompt_tokens,
+            completion_tokens,
+        )
         message_history += [
             {"role": "assistant", "content": chat_response},
         ]
@@ -119,12 +138,14 @@ class ConfigCommand(BaseIPythonGPTCommand):
         if args.reset_conversation:
             self.context["message_history"] = []
 
+        usage = get_token_accountant().usage()
         response = f"""
 ##### Conf set:
 
 * **Default model**: {self.context['config']['default_model']}
 * **Default system message**: {self.context['config']['default_system_message']}
 * **Chat history length**: {len(self.context['message_history'])}
+* **Tokens used this session**: {usage.describe()}
 """
         return response
 
@@ -139,11 +160,13 @@ class ChatModelsBrowserCommand(BaseIPythonGPTCommand):
         return parser
 
     def _execute(self, client, args, line, cell):
-        resp = client.request("GET", "/models")
-        models = [
-            m["id"]
-            for m in resp["data"]
-            if args.all_models or m["id"].startswith("gpt")
-        ]
+        def fetch():
+            resp = client.request("GET", "/models")
+            return [m["id"] for m in resp["data"]]
+
+        catalog = get_model_catalog()
+        models = (
+            catalog.models(fetch) if args.all_models else catalog.chat_models(fetch)
+        )
         formatted_models = "\n".join([f"\t- {model}" for model in models])
         return f"##### Available models:\n\n{formatted_models}"
@@ -0,0 +1,67 @@
+"""Local (offline) token counting.
+
+Counts are an approximation of OpenAI's BPE tokenizers: text is split with a
+pre-tokenizer pattern similar to theirs, and long pieces count as several tokens. This
+is typically within a few percent of the real count, which is plenty for budgeting.
+"""
+import re
+from functools import lru_cache
+from typing import Dict, List
+
+_TOKEN_PATTERN = re.compile(
+    r"'(?:s|t|re|ve|m|ll|d)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+(?!\S)|\s+"
+)
+
+# Tokens added by the chat format around each message, and to prime the reply.
+# See https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+# Longest matching prefix wins.
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-3.5-turbo-1106": 16385,
+    "gpt-3.5-turbo-0125": 16385,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-1106": 128000,
+    "gpt-4-0125": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Approximate number of tokens in `text`. Cached, since messages are re-counted
+    every time a conversation is continued."""
+    n_tokens = 0
+    for piece in _TOKEN_PATTERN.findall(text):
+        n_tokens += 1 + max(0, len(piece) - 7) // 4
+    return n_tokens
+
+
+def count_message_tokens(messages: List[Dict]) -> int:
+    """Approximate number of prompt tokens used by a list of chat messages."""
+    return TOKENS_PER_REPLY + sum(
+        TOKENS_PER_MESSAGE + count_tokens(m["content"]) for m in messages
+    )
+
+
+def get_context_window(model: str) -> int:
+    matches = [prefix for prefix in MODEL_CONTEXT_WINDOWS if model.startswith(prefix)]
+    if not matches:
+        return DEFAULT_CONTEXT_WINDOW
+    return MODEL_CONTEXT_WINDOWS[max(matches, key=len)]
+
+
+def truncate_to_tokens(text: str, max_tokens: int, marker: str = " [...] ") -> str:
+    """Shorten `text` to roughly `max_tokens`, keeping its start and end."""
+    n_tokens = count_tokens(text)
+    if n_tokens <= max_tokens:
+        return text
+    keep_chars = max(0, int(len(text) * max_tokens / n_tokens) - len(marker))
+    head = keep_chars // 2
+    return text[:head] + marker + text[len(text) - (keep_chars - head) :]
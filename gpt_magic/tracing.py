@@ -0,0 +1,143 @@
+"""Stage-level tracing of `%%gpt` commands.
+
+Spans are only recorded while the tracer is enabled (`%gpt --trace on`, or
+`GPT_MAGIC_TRACE=1` in the environment). Otherwise `span` returns a shared no-op
+context manager, so instrumentation costs next to nothing. Recorded spans can be
+exported after the fact:
+
+    %gpt --trace gpt.trace.json    # Chrome trace, open in chrome://tracing or Perfetto
+    %gpt --trace gpt.trace.jsonl   # One span per line
+"""
+import json
+import os
+import threading
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from time import perf_counter_ns
+from typing import Dict, List
+
+DEFAULT_MAX_SPANS = 100_000
+
+
+@dataclass
+class Span:
+    name: str
+    # Microseconds, from an arbitrary (but fixed) point in time.
+    start_us: float
+    duration_us: float = 0.0
+    thread_id: int = 0
+    args: Dict = field(default_factory=dict)
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _ActiveSpan:
+    __slots__ = ("_tracer", "_name", "_args", "_t_start")
+
+    def __init__(self, tracer: "Tracer", name: str, args: Dict):
+        self._tracer = tracer
+        self._name = name
+        self._args = args
+
+    def __enter__(self):
+        self._t_start = perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        t_end = perf_counter_ns()
+        if exc_type is not None:
+            self._args["error"] = exc_type.__name__
+        self._tracer._add(
+            Span(
+                self._name,
+                self._t_start / 1000,
+                (t_end - self._t_start) / 1000,
+                threading.get_ident(),
+                self._args,
+            )
+        )
+        return False
+
+    def set(self, **args):
+        """Attach more arguments to the span, e.g. counts only known at the end."""
+        self._args.update(args)
+
+
+class Tracer:
+    """Records timed spans into a bounded buffer, when enabled."""
+
+    def __init__(self, enabled: bool = False, max_spans: int = DEFAULT_MAX_SPANS):
+        self.enabled = enabled
+        self._spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+
+    def span(self, name: str, **args):
+        """Context manager timing the enclosed block as a span called `name`."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _ActiveSpan(self, name, args)
+
+    def _add(self, span: Span):
+        with self._lock:
+            self._spans.append(span)
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def spans(self) -> List[Span]:
+        with self._lock:
+            return list(self._spans)
+
+    def clear(self):
+        with self._lock:
+            self._spans.clear()
+
+    def to_chrome_trace(self) -> Dict:
+        """The spans in the Chrome trace event format ("complete" events)."""
+        pid = os.getpid()
+        events = [
+            {
+                "name": s.name,
+                "cat": "gpt_magic",
+                "ph": "X",
+                "ts": s.start_us,
+                "dur": s.duration_us,
+                "pid": pid,
+                "tid": s.thread_id,
+                "args": s.args,
+            }
+            for s in self.spans()
+        ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export(self, path: str):
+        """Write the spans to `path`, as JSON lines if it ends with ".jsonl" and as a
+        Chrome trace otherwise."""
+        with open(path, "w", encoding="utf-8") as f:
+            if path.endswith(".jsonl"):
+                for span in self.spans():
+                    f.write(json.dumps(asdict(span), default=str) + "\n")
+            else:
+                json.dump(self.to_chrome_trace(), f, default=str)
+
+
+_tracer = Tracer(enabled=os.environ.get("GPT_MAGIC_TRACE", "") not in ("", "0"))
+
+
+def get_tracer() -> Tracer:
+    return _tracer
@@ -1,31 +1,30 @@
 from functools import wraps
 from getpass import getpass
 from inspect import isgeneratorfunction
-from itertools import count, product
+from itertools import count, islice, product
 import re
 from typing import Optional
 
-from IPython.core.getipython import get_ipython
-from operator import itemgetter
-import openai
-from openai.error import AuthenticationError
 
+def get_ipython_history(last_n: int = 1, max_output_tokens: Optional[int] = None):
+    """(execution count, input, summarized output) of the last `last_n` cells."""
+    from .history import DEFAULT_OUTPUT_TOKENS, get_history_serializer
 
-def get_ipython_history(last_n: int = 1):
-    ipy = get_ipython()
-    execution_count = ipy.execution_count
+    return get_history_serializer().get_history(
+        last_n, max_output_tokens or DEFAULT_OUTPUT_TOKENS
+    )
 
-    input_history = list(ipy.history_manager.get_range(stop=-1))[-last_n:]
-    output_history = [ipy.user_ns["_oh"].get(n_exec) for _, n_exec, _ in input_history]
 
-    return list(zip(map(itemgetter(-1), input_history), output_history))
-
-
-def excel_style_column_name_seq():
+def excel_style_column_name_seq(start: int = 0):
+    """A, B, ..., Z, AA, AB, ..., skipping the first `start` names."""
     capital_alphabet = tuple(map(chr, range(ord("A"), ord("Z") + 1)))
     for n in count(1):
-        for x in product(*[capital_alphabet] * n):
+        if start >= len(capital_alphabet) ** n:
+            start -= len(capital_alphabet) ** n
+            continue
+        for x in islice(product(*[capital_alphabet] * n), start, None):
             yield "".join(x)
+        start = 0
 
 
 def maybe_find_backtick_block(s: str) -> Optional[str]:
@@ -49,22 +48,71 @@ def calls_oai_api(f):
     wrapper will prompt the user for their API key and try again.
     """
 
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        try:
-            if isgeneratorfunction(f):
+    def prompt_for_api_key():
+        # Imported here, as importing `openai` is slow.
+        import openai
+
+        openai.api_key = getpass("Please enter your OpenAI API key: ")
+
+    # A wrapper containing `yield` is always a generator function, so generator and
+    # regular functions need separate wrappers.
+    if isgeneratorfunction(f):
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            from openai.error import AuthenticationError
+
+            try:
                 yield from f(*args, **kwargs)
-            else:
+            except AuthenticationError:
+                prompt_for_api_key()
+                yield from f(*args, **kwargs)
+
+    else:
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            from openai.error import AuthenticationError
+
+            try:
+                return f(*args, **kwargs)
+            except AuthenticationError:
+                prompt_for_api_key()
                 return f(*args, **kwargs)
-        except AuthenticationError:
-            api_key = getpass("Please enter your OpenAI API key: ")
-            openai.api_key = api_key
-            return f(*args, **kwargs)
 
     return wrapper
 
 
+def get_openai_api_key() -> Optional[str]:
+    """The API key used by `openai`, which is read from $OPENAI_API_KEY on import."""
+    import openai
+
+    return openai.api_key
+
+
+def require_openai_api_key() -> str:
+    """`get_openai_api_key`, for code which can't prompt for a missing key (e.g. the
+    async API). Raises `AuthenticationError` rather than sending requests without one."""
+    api_key = get_openai_api_key()
+    if not api_key:
+        from openai.error import AuthenticationError
+
+        raise AuthenticationError(
+            "No OpenAI API key is set. Set $OPENAI_API_KEY or `openai.api_key`, or run"
+            " a `%%gpt` command, which asks for it."
+        )
+    return api_key
+
+
 @calls_oai_api
-def get_available_models():
+def list_model_ids():
+    import openai
+
     resp = openai.Model.list()
-    return [m["id"] for m in resp["data"] if m["id"].startswith("gpt")]
+    return [m["id"] for m in resp["data"]]
+
+
+def get_available_models():
+    from .models import get_model_catalog
+
+    return get_model_catalog().chat_models()
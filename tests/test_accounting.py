@@ -0,0 +1,176 @@
+import asyncio
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from gpt_magic import IPythonGPT
+from gpt_magic.accounting import (
+    BudgetExceeded,
+    TokenAccountant,
+    TokenBudget,
+    get_token_accountant,
+)
+from gpt_magic.api_client import AsyncOpenAIClient, OpenAIClient, parse_api_base
+from gpt_magic.gpt_command import gpt_command
+from gpt_magic.gpt_state import Conversation, GPTMagicState
+from gpt_magic.mock_server import MockOpenAIServer, MockServerConfig
+from gpt_magic.retry import estimate_request_tokens
+from gpt_magic.subcommands import ChatCommand, ConfigCommand
+from gpt_magic.tokens import count_message_tokens, count_tokens
+
+
+def _chunks(deltas):
+    return [{"choices": [{"delta": {"content": delta}}]} for delta in deltas]
+
+
+def _convo(accountant):
+    convo = Conversation("A", "You are a helpful assistant.", accountant=accountant)
+    convo.add_prompt("Testing message", False, [])
+    return convo
+
+
+def test_budget_downgrades_then_blocks():
+    accountant = TokenAccountant(
+        TokenBudget(max_conversation_tokens=100, downgrade_at=0.5)
+    )
+    assert accountant.admit("gpt-4", 40, "A") == "gpt-4"
+    accountant.record("A", "gpt-4", 30, 30)
+    assert accountant.admit("gpt-4", 20, "A") == "gpt-3.5-turbo"
+    # Other conversations have their own budget.
+    assert accountant.admit("gpt-4", 20, "B") == "gpt-4"
+    with pytest.raises(BudgetExceeded, match="conversation A has used 60"):
+        accountant.admit("gpt-4", 50, "A")
+    assert (accountant.blocked, accountant.downgraded) == (1, 1)
+
+
+def test_streamed_completion_is_counted_locally():
+    accountant = TokenAccountant()
+    convo = _convo(accountant)
+    request_messages = convo.to_request_messages("gpt-4")
+    with patch(
+        "openai.ChatCompletion.create", return_value=_chunks(["Hello", " there"])
+    ):
+        list(convo.do_completion("gpt-4", stream=True))
+
+    usage = accountant.usage("A")
+    assert usage.prompt_tokens == count_message_tokens(request_messages)
+    assert usage.completion_tokens == count_tokens("Hello there")
+    assert accountant.usage() == usage
+    assert accountant.model_usage()["gpt-4"] == usage
+
+    # Answered from the cache, so nothing more is used.
+    cache = MagicMock()
+    cache.get.return_value = "Hello there"
+    convo.add_prompt("Testing message", False, [])
+    list(convo.do_completion("gpt-4", stream=True, cache=cache))
+    assert accountant.usage().requests == 1
+
+
+def test_api_usage_is_preferred():
+    accountant = TokenAccountant()
+    convo = _convo(accountant)
+    response = {
+        "choices": [{"message": {"role": "assistant", "content": "Hello"}}],
+        "usage": {"prompt_tokens": 17, "completion_tokens": 2, "total_tokens": 19},
+    }
+    with patch("openai.ChatCompletion.create", return_value=response):
+        convo.complete("gpt-4")
+    assert accountant.usage("A").total_tokens == 19
+
+
+def test_gpt_command_within_budget(capsys):
+    state = GPTMagicState(default_model="gpt-4", accountant=TokenAccountant())
+    state.accountant.budget = TokenBudget(max_session_tokens=150, downgrade_at=0.1)
+    with patch(
+        "openai.ChatCompletion.create", return_value=_chunks(["Hello"])
+    ) as create:
+        gpt_command(state, "--no-cache 'Testing message'")
+        assert create.call_args.kwargs["model"] == "gpt-3.5-turbo"
+        convo_key = state.last_convo_key
+
+        state.accountant.record(None, "gpt-4", 140, 0)
+        create.reset_mock()
+        with pytest.raises(BudgetExceeded):
+            gpt_command(state, "--no-cache 'Testing message'")
+        create.assert_not_called()
+
+    gpt_command(state, "--usage")
+    out = capsys.readouterr().out
+    assert "Budget: 150 tokens per session" in out
+    assert "(1 blocked, 1 downgraded)" in out
+    assert f"  {convo_key}: " in out
+
+
+def test_chat_commands_count_tokens():
+    context = {
+        "config": {
+            "openai_api_key": "VERY SECRET KEY",
+            "default_model": "gpt-3.5-turbo",
+            "default_system_message": "You are a helpful assistant.",
+        },
+        "message_history": [],
+    }
+    response = {
+        "choices": [{"message": {"role": "assistant", "content": "Hello"}}],
+        "usage": {"prompt_tokens": 20, "completion_tokens": 1, "total_tokens": 21},
+    }
+    before = get_token_accountant().usage("chat")
+    with patch.object(OpenAIClient, "request", return_value=response):
+        ChatCommand(context).execute("", "Testing message")
+    after = get_token_accountant().usage("chat")
+    assert after.total_tokens - before.total_tokens == 21
+
+    config = ConfigCommand(context).execute("")
+    assert "**Tokens used this session**" in config
+
+
+def test_closed_async_stream_is_counted():
+    accountant = TokenAccountant()
+    convo = _convo(accountant)
+    config = MockServerConfig(reply="Hello from the mock server.", chunk_chars=5)
+
+    async def first_delta(client):
+        stream = convo.ado_completion("gpt-4", client=client)
+        delta = await stream.__anext__()
+        await stream.aclose()
+        return delta
+
+    with MockOpenAIServer(config) as server:
+        client = AsyncOpenAIClient("KEY", api_base=parse_api_base(server.url))
+        assert asyncio.run(first_delta(client)) == "Hello"
+
+    usage = accountant.usage("A")
+    assert usage.requests == 1
+    assert usage.completion_tokens == count_tokens("Hello")
+
+
+def test_every_choice_is_reserved():
+    messages = [{"role": "user", "content": "Testing message"}]
+    body = {"messages": messages, "max_tokens": 100}
+    assert estimate_request_tokens({**body, "n": 3}) == (
+        estimate_request_tokens(body) + 200
+    )
+
+    accountant = TokenAccountant(TokenBudget(max_session_tokens=250))
+    with patch("openai.ChatCompletion.create") as create:
+        with pytest.raises(BudgetExceeded):
+            list(_convo(accountant).stream_candidates("gpt-4", 3, max_tokens=100))
+        create.assert_not_called()
+
+
+def test_chat_magics_count_tokens(monkeypatch, capsys):
+    monkeypatch.setenv("OPENAI_API_KEY", "VERY SECRET KEY")
+    magics = IPythonGPT(shell=None)
+    response = {
+        "choices": [{"message": {"role": "assistant", "content": "Hello"}}],
+        "usage": {"prompt_tokens": 20, "completion_tokens": 1, "total_tokens": 21},
+    }
+    before = get_token_accountant().usage("chat")
+    with patch.object(OpenAIClient, "request", return_value=response):
+        magics.chat("", "Testing message")
+    after = get_token_accountant().usage("chat")
+    assert after.total_tokens - before.total_tokens == 21
+    assert magics._context["message_history"][-1]["content"] == "Hello"
+
+    magics.chat_config("")
+    assert "Tokens used this session" in capsys.readouterr().out
@@ -1,8 +1,20 @@
+import asyncio
 import json
-from http.client import HTTPSConnection
-from unittest.mock import Mock, patch
+import ssl
+from http.client import HTTPSConnection, RemoteDisconnected
+from unittest.mock import AsyncMock, Mock, patch
 
-from gpt_magic.api_client import OpenAIClient
+from gpt_magic import api_client
+from gpt_magic.api_client import (
+    OPEN_AI_API_HOST,
+    OPEN_AI_API_PORT,
+    AsyncOpenAIClient,
+    ConnectionPool,
+    OpenAIClient,
+    SSEParser,
+    parse_api_base,
+)
+from gpt_magic.mock_server import MockOpenAIServer, MockServerConfig
 
 
 def test_api_client_auth():
@@ -24,3 +36,124 @@ def test_api_client_auth():
                     "Content-Type": "application/json",
                 },
             )
+
+
+def test_api_client_reuses_connections():
+    pool = ConnectionPool()
+    with patch.object(HTTPSConnection, "request"):
+        mock = Mock(status=200, will_close=False)
+        mock.read.return_value = b'{"ok": true}'
+        with patch.object(HTTPSConnection, "getresponse", return_value=mock):
+            client = OpenAIClient("VERY SECRET KEY", connection_pool=pool)
+            assert client.request("GET", "/models") == {"ok": True}
+            assert client.request("GET", "/models") == {"ok": True}
+
+    conn, reused = pool.acquire(OPEN_AI_API_HOST, OPEN_AI_API_PORT)
+    assert reused
+    # Both requests shared one connection, so nothing else is left in the pool.
+    _, reused = pool.acquire(OPEN_AI_API_HOST, OPEN_AI_API_PORT)
+    assert not reused
+
+
+def test_api_client_reconnects_stale_connection():
+    pool = ConnectionPool()
+    stale = HTTPSConnection(OPEN_AI_API_HOST, OPEN_AI_API_PORT)
+    pool.release(OPEN_AI_API_HOST, OPEN_AI_API_PORT, stale)
+
+    ok = Mock(status=200, will_close=True)
+    ok.read.return_value = b""
+    with patch.object(HTTPSConnection, "request") as mocked_request:
+        with patch.object(
+            HTTPSConnection,
+            "getresponse",
+            side_effect=[RemoteDisconnected("closed"), ok],
+        ):
+            client = OpenAIClient("VERY SECRET KEY", connection_pool=pool)
+            client.request("GET", "/models")
+
+    assert mocked_request.call_count == 2
+
+
+def test_sse_parser_handles_split_events():
+    parser = SSEParser()
+    assert parser.feed(b'data: {"a"') == []
+    assert parser.feed(b": 1}\n\n: keep-alive\n\ndata: [DONE]\r\n") == ['{"a": 1}']
+    assert parser.feed(b"\r\n") == ["[DONE]"]
+
+
+def test_async_client_stream():
+    events = [
+        {"choices": [{"delta": {"content": "Hel"}}]},
+        {"choices": [{"delta": {"content": "lo"}}]},
+    ]
+    body = b"".join(f"data: {json.dumps(e)}\n\n".encode() for e in events)
+    body += b"data: [DONE]\n\n"
+    # Send the body with chunked transfer encoding, split mid-event.
+    chunked = b"".join(
+        b"%x\r\n%s\r\n" % (len(part), part) for part in [body[:10], body[10:]]
+    )
+    raw = (
+        b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n"
+        b"Content-Type: text/event-stream\r\n\r\n" + chunked + b"0\r\n\r\n"
+    )
+
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(raw)
+        reader.feed_eof()
+        writer = Mock(drain=AsyncMock())
+        with patch("asyncio.open_connection", AsyncMock(return_value=(reader, writer))):
+            client = AsyncOpenAIClient("VERY SECRET KEY")
+            chunks = [
+                c
+                async for c in client.stream(
+                    "POST", "/chat/completions", json_body={"model": "gpt-4"}
+                )
+            ]
+        request = writer.write.call_args[0][0]
+        assert request.startswith(b"POST /v1/chat/completions HTTP/1.1\r\n")
+        assert b"Authorization: Bearer VERY SECRET KEY" in request
+        assert request.endswith(b'{"model": "gpt-4", "stream": true}')
+        writer.close.assert_called_once()
+        return chunks
+
+    assert asyncio.run(run()) == events
+
+
+def test_async_client_reuses_its_tls_context(monkeypatch):
+    monkeypatch.setattr(api_client, "_ssl_context", None)
+    raw = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}"
+
+    def open_connection(*args, **kwargs):
+        reader = asyncio.StreamReader()
+        reader.feed_data(raw)
+        reader.feed_eof()
+        return reader, Mock(drain=AsyncMock())
+
+    async def run():
+        client = AsyncOpenAIClient("VERY SECRET KEY")
+        await client.request("GET", "/models")
+        await client.request("GET", "/models")
+
+    opened = AsyncMock(side_effect=open_connection)
+    with patch("asyncio.open_connection", opened), patch(
+        "ssl.create_default_context", wraps=ssl.create_default_context
+    ) as create_context:
+        asyncio.run(run())
+    create_context.assert_called_once()
+    contexts = [call.kwargs["ssl"] for call in opened.call_args_list]
+    assert contexts[0] is contexts[1] is api_client.get_ssl_context()
+
+
+def test_pooled_connections_time_out():
+    pool = ConnectionPool(connect_timeout=1.5, read_timeout=30.0)
+    conn, _ = pool.acquire(OPEN_AI_API_HOST, OPEN_AI_API_PORT)
+    assert conn.timeout == 1.5
+
+    with MockOpenAIServer(MockServerConfig()) as server:
+        api_base = parse_api_base(server.url)
+        conn, _ = pool.acquire(api_base.host, api_base.port, use_tls=False)
+        conn.connect()
+        # Connected within the connect timeout, reads wait for the read timeout.
+        assert conn.sock.gettimeout() == 30.0
+        conn.close()
@@ -0,0 +1,33 @@
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from gpt_magic.background import run_in_background
+from gpt_magic.displays import ShellDisplay
+from gpt_magic.gpt_state import GPTMagicState
+
+
+def test_concurrent_get_convo_allocates_unique_keys():
+    state = GPTMagicState()
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        convos = list(pool.map(lambda _: state.get_convo((None, None)), range(200)))
+    keys = [c.key for c in convos]
+    assert len(set(keys)) == len(keys)
+    assert all(state.conversations[k] is c for k, c in zip(keys, convos))
+
+
+def test_run_in_background(capsys):
+    state = GPTMagicState()
+    convo = state.get_convo((None, None))
+    chunks = [{"choices": [{"delta": {"content": c}}]} for c in ["Hel", "lo"]]
+
+    with patch("openai.ChatCompletion.create", return_value=chunks):
+        completion = run_in_background(
+            state, convo, "Testing message", [], "gpt-3.5-turbo", ShellDisplay()
+        )
+        assert completion.result(timeout=5) == "Hello"
+
+    assert completion.key == convo.key + "0"
+    assert repr(completion) == f"<GPT[{convo.key}0] done>"
+    assert state.background_completions[convo.key] is completion
+    assert convo.assistant_messages == ["Hello"]
+    assert capsys.readouterr().out.endswith(f"GPT[{convo.key}0]: Hello\n")
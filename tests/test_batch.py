@@ -0,0 +1,66 @@
+from unittest.mock import patch
+
+import openai
+import pytest
+
+from gpt_magic.batch import gpt_map, render_template
+from gpt_magic.gpt_state import Conversation
+from gpt_magic.models import ModelCatalog
+
+
+def test_render_template():
+    assert render_template("Classify: {}", "spam") == "Classify: spam"
+    assert render_template("{item}!", 3) == "3!"
+    assert render_template("{title} by {author}", {"title": "T", "author": "A"}) == (
+        "T by A"
+    )
+    assert render_template("{item[item]}: {}", {"item": "x"}) == "x: {'item': 'x'}"
+
+
+def _fake_create(messages, **kwargs):
+    prompt = messages[-1]["content"]
+    if prompt == "boom":
+        raise RuntimeError("API failure")
+    return {"choices": [{"message": {"content": prompt.upper()}}]}
+
+
+def test_gpt_map_preserves_order_and_captures_errors(monkeypatch):
+    monkeypatch.setattr(openai, "api_key", "sk-mock")
+    with patch("openai.ChatCompletion.create", side_effect=_fake_create):
+        results = gpt_map(
+            ["a", "boom", "c", "d"],
+            "{}",
+            concurrency=3,
+            use_cache=False,
+            progress=False,
+        )
+
+    assert results[0] == "A"
+    assert isinstance(results[1], RuntimeError)
+    assert results[2:] == ["C", "D"]
+
+
+def test_gpt_map_needs_an_api_key(monkeypatch):
+    monkeypatch.setattr(openai, "api_key", None)
+    with patch("openai.ChatCompletion.create") as create:
+        with pytest.raises(openai.error.AuthenticationError, match="No OpenAI API key"):
+            gpt_map(["a", "b"], "{}", use_cache=False, progress=False)
+    create.assert_not_called()
+
+
+def test_gpt_map_resolves_the_model_and_keys_each_batch(monkeypatch, tmp_path):
+    monkeypatch.setattr(openai, "api_key", "sk-mock")
+    catalog = ModelCatalog(tmp_path / "models.json", fetch=lambda: ["gpt-4"])
+    with patch(
+        "openai.ChatCompletion.create", side_effect=_fake_create
+    ) as create, patch(
+        "gpt_magic.batch.get_model_catalog", return_value=catalog
+    ), patch(
+        "gpt_magic.batch.Conversation", wraps=Conversation
+    ) as convo:
+        gpt_map(["a"], "{}", model="4", use_cache=False, progress=False)
+        gpt_map(["a"], "{}", model="4", use_cache=False, progress=False)
+
+    assert create.call_args.kwargs["model"] == "gpt-4"
+    first, second = [call.kwargs["key"] for call in convo.call_args_list]
+    assert first != second
@@ -0,0 +1,105 @@
+import threading
+
+import openai
+import pytest
+
+from gpt_magic.api_client import (
+    APIResponseException,
+    OpenAIClient,
+    parse_api_base,
+    set_broker_socket,
+)
+from gpt_magic.broker import Broker
+from gpt_magic.gpt_state import Conversation
+from gpt_magic.mock_server import DEFAULT_REPLY, MockOpenAIServer, MockServerConfig
+
+MESSAGES = [{"role": "user", "content": "Testing message"}]
+
+
+@pytest.fixture
+def broker_for(tmp_path, monkeypatch):
+    """Starts a broker in front of a mock server, and sends requests through it."""
+    monkeypatch.setattr(openai, "api_key", "sk-mock")
+    brokers = []
+
+    def start(server):
+        broker = Broker(str(tmp_path / "broker.sock"), parse_api_base(server.url))
+        brokers.append(broker.start())
+        set_broker_socket(broker.socket_path)
+        return broker
+
+    yield start
+    set_broker_socket(None)
+    for broker in brokers:
+        broker.stop()
+
+
+def _stream(results, i):
+    chunks = openai.ChatCompletion.create(
+        model="gpt-3.5-turbo", messages=MESSAGES, stream=True
+    )
+    results[i] = "".join(c["choices"][0]["delta"].get("content", "") for c in chunks)
+
+
+def test_identical_requests_in_flight_are_coalesced(broker_for):
+    config = MockServerConfig(latency=0.3, tokens_per_second=200)
+    with MockOpenAIServer(config) as server:
+        broker = broker_for(server)
+        results = {}
+        kernels = [
+            threading.Thread(target=_stream, args=(results, i)) for i in range(4)
+        ]
+        for kernel in kernels:
+            kernel.start()
+        for kernel in kernels:
+            kernel.join(timeout=10)
+
+        assert list(results.values()) == [DEFAULT_REPLY] * 4
+        assert server.request_count == 1
+        assert (broker.upstream_count, broker.coalesced_count) == (1, 3)
+
+        # Once the response is complete, the same request is sent again.
+        _stream(results, 0)
+        assert server.request_count == 2
+
+
+def test_other_requests_are_relayed(broker_for):
+    with MockOpenAIServer(MockServerConfig(fail_statuses=[400])) as server:
+        broker_for(server)
+        client = OpenAIClient("sk-mock")
+        with pytest.raises(APIResponseException) as exc_info:
+            client.request("GET", "/models")
+        assert exc_info.value.status == 400
+
+        models = client.request("GET", "/models")
+        assert models["data"][0]["id"] == "gpt-3.5-turbo"
+
+
+def test_kernels_leave_retries_to_the_broker(broker_for):
+    # One more failure than the broker retries.
+    with MockOpenAIServer(MockServerConfig(fail_statuses=[429] * 6)) as server:
+        broker_for(server)
+        with pytest.raises(APIResponseException) as exc_info:
+            OpenAIClient("sk-mock").request("GET", "/models")
+        assert exc_info.value.status == 429
+        assert server.request_count == 6
+
+        server.config.fail_statuses = [503] * 6
+        convo = Conversation("A", "system")
+        convo.add_prompt("Testing message", False, [])
+        with pytest.raises(openai.error.OpenAIError):
+            convo.complete("gpt-3.5-turbo")
+        assert server.request_count == 12
+
+
+def test_upstream_request_is_abandoned_with_its_kernels(broker_for):
+    with MockOpenAIServer(MockServerConfig(tokens_per_second=50)) as server:
+        broker = broker_for(server)
+        chunks = openai.ChatCompletion.create(
+            model="gpt-3.5-turbo", messages=MESSAGES, stream=True
+        )
+        next(chunks)
+        chunks.close()
+
+        assert server.disconnected.wait(timeout=2)
+        assert broker.upstream_count == 1
@@ -0,0 +1,84 @@
+import os
+from unittest.mock import patch
+
+from gpt_magic.cache import DiskCache, MemoryCache, ResponseCache, make_cache_key
+from gpt_magic.gpt_state import Conversation
+
+
+def test_cache_key_depends_on_request():
+    messages = [{"role": "user", "content": "Testing message"}]
+    key = make_cache_key(messages, "gpt-3.5-turbo")
+    assert key == make_cache_key(list(messages), "gpt-3.5-turbo")
+    assert key != make_cache_key(messages, "gpt-4")
+    assert key != make_cache_key(messages, "gpt-3.5-turbo", temperature=0.5)
+
+
+def test_memory_cache_evicts_least_recently_used():
+    cache = MemoryCache(max_entries=2)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    cache.get("a")
+    cache.put("c", "C")
+    assert cache.get("a") == "A"
+    assert cache.get("b") is None
+    assert cache.get("c") == "C"
+
+
+def test_disk_cache_evicts_by_age_and_size(tmp_path):
+    cache = DiskCache(tmp_path, max_bytes=10_000, max_age_seconds=60)
+    cache.put("old", "x")
+    os.utime(tmp_path / "old.json", (0, 0))
+    assert cache.get("old") is None
+
+    cache = DiskCache(tmp_path, max_bytes=100)
+    cache.put("first", "x" * 60)
+    os.utime(tmp_path / "first.json", (1, 1))
+    cache.put("second", "y" * 60)
+    assert cache.get("first") is None
+    assert cache.get("second") == "y" * 60
+
+
+def test_disk_cache_only_scans_when_needed(tmp_path):
+    cache = DiskCache(tmp_path, max_bytes=1_000, scan_every=5)
+    with patch("os.scandir", wraps=os.scandir) as scandir:
+        for i in range(9):
+            cache.put(f"key{i}", "x" * 10)
+        assert scandir.call_count == 2
+        # Going over the limit evicts straight away.
+        cache.put("big", "y" * 900)
+        assert scandir.call_count == 3
+    assert cache.get("key0") is None
+    assert cache.get("big") == "y" * 900
+
+
+def test_do_completion_replays_cached_response(tmp_path):
+    cache = ResponseCache(disk=DiskCache(tmp_path))
+    chunks = [{"choices": [{"delta": {"content": c}}]} for c in ["Hel", "lo"]]
+
+    def make_convo():
+        convo = Conversation("A", "system")
+        convo.add_prompt("Testing message", False, [])
+        return convo
+
+    with patch("openai.ChatCompletion.create") as mocked_create:
+        mocked_create.return_value = iter(chunks)
+        convo = make_convo()
+        assert list(convo.do_completion("gpt-3.5-turbo", stream=True, cache=cache)) == [
+            "Hel",
+            "lo",
+        ]
+
+        convo = make_convo()
+        assert list(convo.do_completion("gpt-3.5-turbo", stream=True, cache=cache)) == [
+            "Hello"
+        ]
+        assert convo.get_message() == "Hello"
+        mocked_create.assert_called_once()
+
+    # The disk tier survives a fresh memory tier.
+    assert (
+        ResponseCache(disk=DiskCache(tmp_path)).get(
+            make_cache_key(convo.to_messages()[:-1], "gpt-3.5-turbo")
+        )
+        == "Hello"
+    )
@@ -0,0 +1,97 @@
+import sys
+from unittest.mock import Mock, patch
+
+from gpt_magic.cell_index import CellIndex, get_relevant_history, tokenize
+from gpt_magic.gpt_command import gpt_command
+from gpt_magic.gpt_state import GPTMagicState
+
+CELLS = [
+    "import pandas as pd",
+    "sales_df = pd.read_csv('sales.csv')",
+    "weather = load_weather()",
+    "sales_df.groupby('region').revenue.sum()",
+    "x = 1",
+]
+
+
+class FakeHistoryManager:
+    session_number = 1
+
+    def __init__(self, inputs):
+        self.input_hist_raw = ["", *inputs]
+
+
+def _fake_ipython(inputs, outputs=None):
+    return Mock(
+        history_manager=FakeHistoryManager(inputs), user_ns={"_oh": outputs or {}}
+    )
+
+
+def test_tokenize_splits_identifiers():
+    assert tokenize("sales_df.groupby('Region')") == [
+        "sales_df",
+        "sales",
+        "df",
+        "groupby",
+        "region",
+    ]
+
+
+def test_search_ranks_relevant_cells():
+    index = CellIndex()
+    for n, cell in enumerate(CELLS, 1):
+        index.add_cell(n, cell)
+
+    # Searching doesn't need numpy.
+    with patch.dict(sys.modules, {"numpy": None}):
+        results = index.search("total revenue of each region in the sales data", k=2)
+    assert [n for n, _ in results] == [4, 2]
+    assert results[0][1] > results[1][1] > 0
+    assert index.search("nothing matches this") == []
+
+
+def test_index_catches_up_then_follows_the_post_run_cell_hook():
+    ipy = _fake_ipython([*CELLS, "%%gpt --auto-context 'Plot sales'"], {4: "region"})
+    index = CellIndex()
+    index.attach(ipy)
+    # The running `%%gpt` cell isn't indexed.
+    assert len(index) == len(CELLS)
+    [(event, hook)] = [c.args for c in ipy.events.register.call_args_list]
+    assert event == "post_run_cell"
+
+    ipy.history_manager.input_hist_raw.append("temperature = weather.mean()")
+    hook(None)
+    assert len(index) == len(CELLS) + 1
+    assert index.search("temperature")[0][0] == len(CELLS) + 2
+
+    # A new session starts again from its first cell.
+    ipy.history_manager.session_number = 2
+    ipy.history_manager.input_hist_raw[:] = ["", "y = 2", "%gpt -a"]
+    index.attach(ipy)
+    assert len(index) == 1
+    ipy.events.register.assert_called_once()
+
+
+def test_auto_context_sends_the_relevant_cells(capsys):
+    ipy = _fake_ipython(
+        [*CELLS, "%%gpt -a 2 'Sum of sales revenue by region'"], {4: 123}
+    )
+    state = GPTMagicState()
+    chunks = [{"choices": [{"delta": {"content": "Done"}}]}]
+    with patch("gpt_magic.cell_index.get_ipython", return_value=ipy), patch(
+        "gpt_magic.cell_index.get_cell_index", return_value=CellIndex()
+    ), patch("openai.ChatCompletion.create", return_value=chunks) as create:
+        gpt_command(state, "--debug --no-cache -a 2 'Sum of sales revenue by region'")
+
+    prompt = create.call_args.kwargs["messages"][-1]["content"]
+    assert "In[4]: sales_df.groupby('region').revenue.sum()\nOut[4]: 123" in prompt
+    assert "In[3]" not in prompt and "In[5]" not in prompt
+    assert "Relevant cells: In[2], In[4]" in capsys.readouterr().out
+
+
+def test_relevant_history_keeps_within_the_budget():
+    ipy = _fake_ipython(["revenue " * 50, "revenue = 1", "%gpt -a"])
+    with patch("gpt_magic.cell_index.get_ipython", return_value=ipy), patch(
+        "gpt_magic.cell_index.get_cell_index", return_value=CellIndex()
+    ):
+        assert [n for n, _, _ in get_relevant_history("revenue", max_tokens=20)] == [2]
@@ -0,0 +1,129 @@
+from unittest.mock import Mock, patch
+
+import openai
+import pytest
+
+from gpt_magic.code_parser import CodeStreamParser, is_valid_code
+from gpt_magic.gpt_command import gpt_command
+from gpt_magic.gpt_state import GPTMagicState
+
+RESPONSE = (
+    "Sure:\n---cell-start---\nprint('hi')\n---cell-end---\n"
+    "This prints a greeting. It works by calling print."
+)
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 16, 100])
+def test_markers_split_across_deltas(size):
+    parser = CodeStreamParser()
+    deltas = [RESPONSE[i : i + size] for i in range(0, len(RESPONSE), size)]
+    n_fed = 0
+    for delta in deltas:
+        n_fed += 1
+        if parser.feed(delta):
+            break
+    assert parser.result() == "print('hi')"
+    assert len(parser.text) < len(RESPONSE) or size == 100
+    assert "---cell-end---" in parser.text
+
+
+def test_backticks_in_marker_block_and_fallback():
+    parser = CodeStreamParser()
+    assert parser.feed("---cell-start---\n```python\nx = 1\n```\n---cell-end---")
+    assert parser.result() == "x = 1"
+
+    parser = CodeStreamParser()
+    assert not parser.feed("Here:\n```python\ny = 2\n```\nDone.")
+    assert not parser.complete
+    assert parser.result() == "y = 2"
+
+    parser = CodeStreamParser()
+    parser.feed("No code here.")
+    assert parser.result() is None
+
+
+def _chunks(consumed):
+    for i in range(0, len(RESPONSE), 4):
+        consumed.append(i)
+        yield {"choices": [{"delta": {"content": RESPONSE[i : i + 4]}}]}
+
+
+@pytest.mark.parametrize("keep_explanation", [False, True])
+def test_code_command_stops_after_the_code_block(keep_explanation, capsys):
+    state = GPTMagicState()
+    consumed = []
+    ipy = Mock()
+    line = "--code --no-cache 'Say hi'"
+    if keep_explanation:
+        line += " --keep-explanation"
+
+    with patch("openai.ChatCompletion.create", return_value=_chunks(consumed)), patch(
+        "gpt_magic.gpt_command.get_ipython", return_value=ipy, create=True
+    ):
+        gpt_command(state, line)
+
+    ipy.set_next_input.assert_called_once_with(
+        f"#%gpt {line}\nprint('hi')", replace=True
+    )
+    convo = state.conversations[state.last_convo_key]
+    if keep_explanation:
+        assert convo.get_message() == RESPONSE
+        assert "This prints a greeting" in capsys.readouterr().out
+    else:
+        assert len(consumed) < len(range(0, len(RESPONSE), 4))
+        # The partial response is kept.
+        assert "---cell-end---" in convo.get_message()
+        assert not convo.get_message().endswith("calling print.")
+
+
+def test_is_valid_code():
+    assert is_valid_code("x = 1\nawait asyncio.sleep(0)")
+    assert not is_valid_code("def f(:\n    pass")
+    assert not is_valid_code("%matplotlib inline")
+    assert is_valid_code(
+        "%matplotlib inline", transform=lambda c: "get_ipython().run_line_magic()"
+    )
+
+
+def test_candidates_use_the_first_valid_code():
+    state = GPTMagicState()
+    ipy = Mock()
+    ipy.transform_cell.side_effect = lambda code: code
+    broken = "---cell-start---\nprint('hi'\n---cell-end---\nBroken."
+    valid = "Sure:\n---cell-start---\nprint('hi')\n---cell-end---\nThis prints."
+    chunks = [
+        {"choices": [{"index": i, "delta": {"content": text[j : j + 8]}}]}
+        for j in range(0, max(len(broken), len(valid)), 8)
+        for i, text in enumerate([broken, valid])
+        if text[j : j + 8]
+    ]
+    line = "--code --candidates 2 'Say hi'"
+
+    with patch("openai.ChatCompletion.create", return_value=chunks) as create, patch(
+        "gpt_magic.gpt_command.get_ipython", return_value=ipy, create=True
+    ):
+        gpt_command(state, line)
+
+    assert create.call_args.kwargs["n"] == 2
+    ipy.set_next_input.assert_called_once_with(
+        f"#%gpt {line}\nprint('hi')", replace=True
+    )
+    convo = state.conversations[state.last_convo_key]
+    assert convo.get_message().startswith("Sure:")
+    assert "This prints." not in convo.get_message()
+    assert convo.head.truncated
+
+
+def test_failed_candidates_add_no_reply():
+    state = GPTMagicState()
+    ipy = Mock()
+    with patch(
+        "openai.ChatCompletion.create",
+        side_effect=openai.error.InvalidRequestError("Bad request", None),
+    ), patch("gpt_magic.gpt_command.get_ipython", return_value=ipy, create=True):
+        with pytest.raises(openai.error.InvalidRequestError):
+            gpt_command(state, "--code --candidates 3 'Say hi'")
+
+    convo = state.conversations[state.last_convo_key]
+    assert convo.get_message() is None
+    assert convo.head.truncated is False
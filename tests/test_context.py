@@ -0,0 +1,75 @@
+import pytest
+
+from gpt_magic.context import ContextPolicy, describe_request_size
+from gpt_magic.gpt_state import Conversation
+from gpt_magic.tokens import count_message_tokens, count_tokens, get_context_window
+
+
+def test_count_tokens():
+    assert count_tokens("") == 0
+    assert count_tokens("Hello, world! How are you doing today?") == 10
+    assert count_tokens("word " * 100) == pytest.approx(100, abs=2)
+
+
+def test_get_context_window():
+    assert get_context_window("gpt-4") == 8192
+    assert get_context_window("gpt-4-32k-0613") == 32768
+    assert get_context_window("gpt-3.5-turbo-16k") == 16384
+    assert get_context_window("some-other-model") == 4096
+
+
+def _long_convo(policy):
+    convo = Conversation("A", "system", context_policy=policy)
+    for i in range(20):
+        convo.add_prompt(f"Question {i}\n" + "words " * 200, False, [])
+        convo.add_response(f"Answer {i}\n" + "words " * 200)
+    convo.add_prompt("Final question", False, [])
+    return convo
+
+
+@pytest.mark.parametrize("strategy", ["drop", "truncate", "summarize"])
+def test_context_policy_fits_budget(strategy):
+    policy = ContextPolicy(strategy=strategy, max_context_tokens=3000)
+    convo = _long_convo(policy)
+    messages = convo.to_request_messages("gpt-3.5-turbo")
+
+    assert count_message_tokens(convo.to_messages()) > policy.budget("gpt-3.5-turbo")
+    assert count_message_tokens(messages) <= policy.budget("gpt-3.5-turbo")
+    assert messages[-1]["content"] == "Final question"
+    # The most recent exchange is kept verbatim.
+    assert messages[-2]["content"].startswith("Answer 19")
+    if strategy == "summarize":
+        assert messages[0]["content"].startswith("system\n\nEarlier in this conver")
+        assert "Question 0" in messages[0]["content"]
+    else:
+        assert messages[0]["content"] == "system"
+    roles = [m["role"] for m in messages]
+    assert all(a != b for a, b in zip(roles[1:], roles[2:]))
+
+
+def test_context_policy_none_sends_everything():
+    convo = _long_convo(ContextPolicy(strategy="none", max_context_tokens=3000))
+    assert convo.to_request_messages("gpt-3.5-turbo") == convo.to_messages()
+
+
+def test_oversized_prompt_is_shortened():
+    policy = ContextPolicy(max_context_tokens=300, reserve_tokens=100)
+    convo = _long_convo(policy)
+    convo.add_response("Final answer")
+    convo.add_prompt("Start " + "words " * 1000 + "end", False, [])
+    messages = convo.to_request_messages("gpt-3.5-turbo")
+
+    assert [m["role"] for m in messages] == ["system", "user"]
+    assert count_message_tokens(messages) <= 200
+    assert messages[1]["content"].startswith("Start words")
+    assert messages[1]["content"].endswith("words end")
+
+
+def test_request_size_includes_max_tokens():
+    policy = ContextPolicy(max_context_tokens=3000)
+    messages = [{"role": "user", "content": "Hello"}]
+    n = count_message_tokens(messages)
+    assert describe_request_size(messages, "gpt-4", policy, max_tokens=500) == (
+        f"Request tokens: {n} prompt + 500 for the response = {n + 500}"
+        " (of 3000 for gpt-4, strategy 'drop')"
+    )
@@ -0,0 +1,38 @@
+import io
+from unittest.mock import MagicMock, patch
+
+from gpt_magic.displays import NotebookDisplay, ShellStreamRenderer
+
+
+def test_shell_stream_renderer_writes_deltas():
+    out = io.StringIO()
+    renderer = ShellStreamRenderer("GPT[A0]: ", stream=out)
+    renderer.feed("Hel")
+    assert out.getvalue() == "GPT[A0]: Hel"
+    renderer.feed("lo")
+    renderer.finish()
+    assert out.getvalue() == "GPT[A0]: Hello\n"
+
+
+def test_shell_stream_renderer_not_live():
+    out = io.StringIO()
+    renderer = ShellStreamRenderer("GPT[A0]: ", live=False, stream=out)
+    renderer.feed("Hel")
+    renderer.feed("lo")
+    assert out.getvalue() == ""
+    renderer.finish()
+    assert out.getvalue() == "GPT[A0]: Hello\n"
+
+
+def test_notebook_stream_renderer_updates_one_display_in_place():
+    handle = MagicMock()
+    with patch("gpt_magic.displays.display", return_value=handle) as mocked_display:
+        renderer = NotebookDisplay().stream_renderer("GPT[A0]: ")
+        for _ in range(1000):
+            renderer.feed("word ")
+        renderer.finish()
+
+    mocked_display.assert_called_once()
+    # Throttled: far fewer renders than deltas, but the final render is complete.
+    assert 1 <= handle.update.call_count < 10
+    assert "GPT[A0]: " + "word " * 1000 in handle.update.call_args[0][0].data
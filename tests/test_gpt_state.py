@@ -0,0 +1,180 @@
+import asyncio
+from unittest.mock import patch
+
+import openai
+import pytest
+
+from gpt_magic.api_client import AsyncOpenAIClient, parse_api_base
+from gpt_magic.context import ContextPolicy
+from gpt_magic.gpt_state import Conversation, GPTMagicState, MessageNode
+from gpt_magic.metrics import MetricsRecorder
+from gpt_magic.mock_server import MockOpenAIServer, MockServerConfig
+
+
+def _exchange(convo, prompt, response):
+    convo.add_prompt(prompt, False, [])
+    convo.add_response(response)
+
+
+def test_followup_earlier_message_starts_a_branch():
+    convo = Conversation("C", "system")
+    _exchange(convo, "q0", "a0")
+    _exchange(convo, "q1", "a1")
+    assert convo.get_message_key() == "C1"
+
+    convo.checkout(0)
+    _exchange(convo, "q2", "a2")
+
+    assert convo.get_message_key() == "C2"
+    assert convo.user_messages == ["q0", "q2"]
+    assert convo.assistant_messages == ["a0", "a2"]
+    # The other branch is still addressable, and shares its prefix.
+    assert convo.get_message(1) == "a1"
+    assert convo.nodes[1].parent is convo.nodes[2].parent is convo.nodes[0]
+
+    convo.checkout(1)
+    assert [m["content"] for m in convo.to_messages()] == [
+        "system",
+        "q0",
+        "a0",
+        "q1",
+        "a1",
+    ]
+
+
+def test_branches_share_their_prefix():
+    convo = Conversation("C", "system")
+    _exchange(convo, "q0", "a0")
+    first = convo.head.messages()
+
+    _exchange(convo, "q1", "a1")
+    assert convo.head.messages()[: len(first)] == first
+    assert convo.nodes[0].messages() == first
+
+    convo.add_prompt("q2", False, [])
+    assert convo.to_messages()[-1] == {"role": "user", "content": "q2"}
+    convo.add_response("a2")
+    assert convo.to_messages()[-1] == {"role": "assistant", "content": "a2"}
+
+    # A new reply to an earlier node is seen by its descendants.
+    convo.add_response("a0, again", node=convo.nodes[0])
+    assert convo.to_messages()[2] == {"role": "assistant", "content": "a0, again"}
+
+
+def test_head_messages_are_built_once():
+    convo = Conversation("C", "system")
+    _exchange(convo, "q0", "a0")
+    convo.add_prompt("q1", False, [])
+    with patch.object(MessageNode, "messages", wraps=convo.head.messages) as messages:
+        assert convo.to_messages() == convo.to_messages()
+        assert convo.to_request_messages("gpt-4") == convo.to_messages()
+    assert messages.call_count == 1
+
+    convo.add_response("a1")
+    assert convo.to_messages()[-1]["content"] == "a1"
+    convo.checkout(0)
+    assert convo.to_messages()[-1]["content"] == "a0"
+
+
+def test_get_message_without_messages():
+    assert Conversation("C", "system").get_message() is None
+
+
+def test_get_convo_with_message_key():
+    state = GPTMagicState()
+    convo = state.get_convo((None, None))
+    _exchange(convo, "q0", "a0")
+    _exchange(convo, "q1", "a1")
+
+    assert state.get_convo(state.parse_followup_key(convo.key + "0")) is convo
+    assert convo.head is convo.nodes[0]
+
+
+def test_repeated_cells_are_referred_back_to():
+    convo = Conversation("C", "system")
+    convo.add_prompt("q0", False, [(1, "x = 1", "None"), (2, "x", "1")])
+    convo.add_response("a0")
+    convo.add_prompt("q1", False, [(2, "x", "1"), (3, "x + 1", "2")])
+    convo.add_response("a1")
+
+    assert "In[1]: x = 1" in convo.nodes[0].user
+    assert "(In[2]: as shown earlier in this conversation.)" in convo.nodes[1].user
+    assert "In[2]: x\n" not in convo.nodes[1].user
+    assert "In[3]: x + 1\nOut[3]: 2" in convo.nodes[1].user
+    assert convo.shown_cells().keys() == {1, 2, 3}
+
+    # A cell whose output changed (e.g. after a restart) is sent again, and a new branch
+    # only refers back to the cells on its own path.
+    convo.add_prompt("q2", False, [(3, "x + 1", "3")])
+    assert "Out[3]: 3" in convo.head.user
+    convo.checkout(0)
+    convo.add_prompt("q3", False, [(3, "x + 1", "2")])
+    assert "Out[3]: 2" in convo.head.user
+
+
+def test_cells_are_resent_once_their_message_is_left_out():
+    policy = ContextPolicy(max_context_tokens=700, reserve_tokens=0)
+    convo = Conversation("C", "system", context_policy=policy)
+    df = (1, "df = load()", "rows " * 300)
+    convo.add_prompt("q0", False, [df])
+    convo.add_response("a0")
+    convo.add_prompt("q1", False, [df])
+    assert "(In[1]: as shown earlier" in convo.head.user
+    messages = convo.to_request_messages("gpt-4")
+    assert messages[1]["content"] == convo.nodes[0].user
+
+    # The first message no longer fits, so its cell is sent with the latest one.
+    convo.add_response("a1 " + "words " * 300)
+    convo.add_prompt("q2", False, [df])
+    messages = convo.to_request_messages("gpt-4")
+    assert convo.nodes[0].user not in [m["content"] for m in messages]
+    assert messages[-1]["content"].count("In[1]: df = load()") == 1
+    assert "as shown earlier" not in messages[-1]["content"]
+
+
+def test_async_completion_needs_an_api_key(monkeypatch):
+    monkeypatch.setattr(openai, "api_key", None)
+    convo = Conversation("C", "system")
+    convo.add_prompt("q0", False, [])
+
+    async def complete():
+        return [delta async for delta in convo.ado_completion("gpt-4")]
+
+    with patch("asyncio.open_connection") as open_connection:
+        with pytest.raises(openai.error.AuthenticationError, match="No OpenAI API key"):
+            asyncio.run(complete())
+    open_connection.assert_not_called()
+
+
+def test_async_completions_reply_to_their_own_prompt():
+    convo = Conversation("C", "system", metrics=MetricsRecorder())
+    config = MockServerConfig(reply="Hello from the mock server.", chunk_chars=5)
+
+    async def complete(client, node):
+        return [
+            d async for d in convo.ado_completion("gpt-4", client=client, node=node)
+        ]
+
+    async def interrupted(client, node):
+        stream = convo.ado_completion("gpt-4", client=client, node=node)
+        await stream.__anext__()
+        await stream.aclose()
+
+    async def run(client):
+        q0 = convo.add_prompt("q0", False, [])
+        q1 = convo.add_prompt("q1", False, [])
+        await asyncio.gather(complete(client, q0), complete(client, q1))
+        await interrupted(client, convo.add_prompt("q2", False, []))
+
+    with MockOpenAIServer(config) as server:
+        asyncio.run(run(AsyncOpenAIClient("KEY", api_base=parse_api_base(server.url))))
+
+    replies = [(node.assistant, node.truncated) for node in convo.nodes]
+    assert replies == [
+        ("Hello from the mock server.", False),
+        ("Hello from the mock server.", False),
+        ("Hello", True),
+    ]
+    records = convo.metrics.records("completion")
+    assert [r.cancelled for r in records] == [False, False, True]
+    assert records[0].ttft is not None and records[0].output_tokens > 0
@@ -0,0 +1,78 @@
+from unittest.mock import Mock, patch
+
+import pytest
+
+from gpt_magic.gpt_state import Conversation
+from gpt_magic.history import HistorySerializer, summarize_output
+from gpt_magic.tokens import count_tokens
+
+
+class FakeHistoryManager:
+    session_number = 1
+
+    def __init__(self, inputs):
+        self.input_hist_raw = ["", *inputs]
+        self.ranges = []
+
+    def get_range(self, start=1, stop=None):
+        self.ranges.append((start, stop))
+        stop = len(self.input_hist_raw) + stop
+        for i in range(start, stop):
+            yield 0, i, self.input_hist_raw[i]
+
+
+def _fake_ipython(n_cells, outputs):
+    inputs = [f"x{i}" for i in range(1, n_cells)] + ["%gpt --show 2 'Explain'"]
+    return Mock(history_manager=FakeHistoryManager(inputs), user_ns={"_oh": outputs})
+
+
+def test_get_history_reads_only_the_last_cells():
+    ipy = _fake_ipython(1000, {998: "last", 997: ["a", "b"]})
+    with patch("gpt_magic.history.get_ipython", return_value=ipy):
+        history = HistorySerializer().get_history(2)
+
+    assert history == [(998, "x998", "last"), (999, "x999", "None")]
+    assert ipy.history_manager.ranges == [(998, -1)]
+
+
+def test_get_history_at_the_start_of_a_session():
+    ipy = _fake_ipython(2, {1: 42})
+    with patch("gpt_magic.history.get_ipython", return_value=ipy):
+        assert HistorySerializer().get_history(5) == [(1, "x1", "42")]
+
+
+def test_outputs_are_memoized_by_execution_count():
+    ipy = _fake_ipython(3, {1: "one"})
+    serializer = HistorySerializer()
+    assert serializer.serialize_output(ipy, 1, 100) == "one"
+    ipy.user_ns["_oh"][1] = "changed"
+    assert serializer.serialize_output(ipy, 1, 100) == "one"
+    assert serializer.serialize_output(ipy, 1, 50) == "changed"
+
+
+def test_large_outputs_are_capped():
+    text = summarize_output("word " * 100_000, max_tokens=200)
+    assert count_tokens(text) <= 210
+    assert len(summarize_output(list(range(100_000)))) < 200
+
+
+def test_numpy_arrays_are_summarized():
+    np = pytest.importorskip("numpy")
+    text = summarize_output(np.zeros((1000, 50)))
+    assert text.startswith("ndarray with shape (1000, 50) and dtype float64")
+    assert "..." in text
+
+
+def test_dataframes_are_summarized():
+    pd = pytest.importorskip("pandas")
+    df = pd.DataFrame({"a": range(10_000), "b": ["x"] * 10_000})
+    text = summarize_output(df)
+    assert text.startswith("DataFrame with shape (10000, 2)")
+    assert "object" in text
+    assert "9999" not in text
+
+
+def test_add_prompt_labels_cells_by_execution_count():
+    convo = Conversation("A", "system")
+    convo.add_prompt("Explain", False, [(7, "x = 1", "None"), (8, "x", "1")])
+    assert "In[7]: x = 1\nOut[7]: None\nIn[8]: x\nOut[8]: 1" in convo.head.user
@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+
+
+def _run(code, env=None):
+    return subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=REPO_ROOT,
+        env={**os.environ, **(env or {})},
+    ).stdout.strip()
+
+
+def test_import_is_lazy():
+    # Guards the extension's load time: run `python -m benchmarks.bench_import` to
+    # measure it.
+    loaded = _run(
+        "import sys, gpt_magic; "
+        "print(sorted(m for m in sys.modules if m.startswith(('openai', 'gpt_magic.'))))"
+    )
+    assert loaded == "[]"
+
+
+def test_lazy_attributes():
+    assert _run("import gpt_magic; print(gpt_magic.acomplete.__name__)") == "acomplete"
+    assert _run("from gpt_magic import gpt_map; print(gpt_map.__module__)") == (
+        "gpt_magic.batch"
+    )
+
+
+def test_loading_the_extension_only_preconnects():
+    code = (
+        "import sys, threading, gpt_magic; "
+        "from unittest.mock import Mock; "
+        "gpt_magic.load_ipython_extension(Mock()); "
+        "[t.join() for t in threading.enumerate() if t.name == 'gpt-magic-preconnect']; "
+        "print('gpt_magic.api_client' in sys.modules, 'gpt_magic.gpt_state' in sys.modules)"
+    )
+    env = {"OPENAI_API_BASE": "http://127.0.0.1:9/v1"}
+    assert _run(code, {**env, "GPT_MAGIC_PRECONNECT": "1"}) == "True False"
+    # Preconnecting is opt-in.
+    assert _run(code, env) == "False False"
@@ -0,0 +1,90 @@
+from unittest.mock import patch
+
+import pytest
+
+from gpt_magic.api_client import ConnectionPool, OpenAIClient, parse_api_base
+from gpt_magic.gpt_state import Conversation
+from gpt_magic.metrics import MetricsRecorder, RequestMetrics, percentile
+from gpt_magic.mock_server import MockOpenAIServer, MockServerConfig
+
+
+def test_percentile():
+    assert percentile([3, 1, 2], 50) == 2
+    assert percentile([1, 2, 3, 4], 50) == 2.5
+    assert percentile([1, 2, 3, 4], 100) == 4
+    assert percentile([5], 99) == 5
+
+
+def test_recorder_is_bounded_and_notifies_subscribers():
+    recorder = MetricsRecorder(max_records=3)
+    seen = []
+    unsubscribe = recorder.subscribe(seen.append)
+    recorder.subscribe(lambda m: 1 / 0)  # Broken hooks are ignored.
+
+    for i in range(5):
+        recorder.record(RequestMetrics("api", "GET /v1/models", ttft=i / 10))
+    assert len(recorder.records()) == 3
+    assert len(seen) == 5
+    assert recorder.percentiles("ttft", [0, 100]) == {0: 0.2, 100: 0.4}
+
+    unsubscribe()
+    recorder.record(RequestMetrics("api", "GET /v1/models"))
+    assert len(seen) == 5
+
+
+def test_do_completion_records_metrics():
+    recorder = MetricsRecorder()
+    convo = Conversation("A", "system", metrics=recorder)
+    convo.add_prompt("Testing message", False, [])
+    chunks = [{"choices": [{"delta": {"content": c}}]} for c in ["Hel", "lo"]]
+
+    with patch("openai.ChatCompletion.create", return_value=chunks):
+        assert list(convo.do_completion("gpt-3.5-turbo", stream=True)) == ["Hel", "lo"]
+
+    [metrics] = recorder.records()
+    assert metrics.source == "completion"
+    assert metrics.model == "gpt-3.5-turbo"
+    assert metrics.chunks == 2
+    assert metrics.bytes == 5
+    assert metrics.output_tokens == 1
+    assert 0 <= metrics.ttft <= metrics.duration
+    assert metrics.error is None
+    assert "completion: 1 requests (0 cached, 0 failed)" in recorder.format_stats()
+
+
+def test_api_client_records_connect_time_and_retries():
+    recorder = MetricsRecorder()
+    config = MockServerConfig(reply="Hello", fail_statuses=[429])
+    with MockOpenAIServer(config) as server, patch("gpt_magic.retry.sleep"):
+        client = OpenAIClient(
+            "KEY",
+            connection_pool=ConnectionPool(),
+            api_base=parse_api_base(server.url),
+            metrics=recorder,
+        )
+        json_body = {"model": "gpt-4", "messages": [{"role": "user", "content": "Hi"}]}
+        client.request("POST", "/chat/completions", json_body=json_body)
+        client.request("GET", "/models")
+
+    first, second = recorder.records()
+    assert first.endpoint == "POST /v1/chat/completions"
+    assert first.retries == 1
+    assert first.output_tokens == 1
+    assert first.bytes > 0
+    # The second request reuses the kept-alive connection.
+    assert second.connect == 0.0
+    assert second.retries == 0
+
+
+def test_failed_completion_is_recorded():
+    recorder = MetricsRecorder()
+    convo = Conversation("A", "system", metrics=recorder)
+    convo.add_prompt("Testing message", False, [])
+
+    with patch("openai.ChatCompletion.create", side_effect=ValueError("boom")):
+        with pytest.raises(ValueError):
+            list(convo.do_completion("gpt-3.5-turbo", stream=True))
+
+    [metrics] = recorder.records()
+    assert metrics.error == "ValueError: boom"
+    assert recorder.percentiles("duration") == {}
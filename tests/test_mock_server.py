@@ -0,0 +1,106 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from gpt_magic import api_client
+from gpt_magic.api_client import (
+    AsyncOpenAIClient,
+    ConnectionPool,
+    OpenAIClient,
+    parse_api_base,
+)
+from gpt_magic.mock_server import MockOpenAIServer, MockServerConfig
+
+JSON_BODY = {
+    "model": "gpt-3.5-turbo",
+    "messages": [{"role": "user", "content": "Testing message"}],
+}
+
+
+@pytest.fixture
+def server():
+    config = MockServerConfig(reply="Hello from the mock server.", chunk_chars=5)
+    with MockOpenAIServer(config) as server:
+        yield server
+
+
+def test_parse_api_base():
+    assert parse_api_base("https://api.openai.com/v1") == (
+        "api.openai.com",
+        443,
+        True,
+        "",
+    )
+    assert parse_api_base("http://127.0.0.1:8000/v1") == ("127.0.0.1", 8000, False, "")
+    proxied = parse_api_base("https://example.com/openai/v1/")
+    assert proxied.path_prefix == "/openai"
+    assert proxied.url == "https://example.com:443/openai/v1"
+    with pytest.raises(ValueError):
+        parse_api_base("127.0.0.1:8000")
+
+
+def test_invalid_api_base_env_falls_back_to_the_default(monkeypatch):
+    monkeypatch.setenv("OPENAI_API_BASE", "127.0.0.1:8000")
+    monkeypatch.setattr(api_client, "_api_base", None)
+    with pytest.warns(UserWarning, match="Invalid API base URL"):
+        assert api_client.get_api_base().url == "https://api.openai.com:443/v1"
+
+
+def test_mock_server_completions(server):
+    client = OpenAIClient(
+        "KEY", connection_pool=ConnectionPool(), api_base=parse_api_base(server.url)
+    )
+    models = client.request("GET", "/models")
+    assert "gpt-4" in [m["id"] for m in models["data"]]
+
+    resp = client.request("POST", "/chat/completions", json_body=JSON_BODY)
+    assert resp["choices"][0]["message"]["content"] == "Hello from the mock server."
+    assert resp["usage"]["prompt_tokens"] > 0
+    # Both requests went over the same keep-alive connection.
+    assert server.request_count == 2
+    assert server.connection_count == 1
+
+
+def test_api_base_path_prefix():
+    config = MockServerConfig(reply="Proxied.", path_prefix="/openai")
+    with MockOpenAIServer(config) as server:
+        api_base = parse_api_base(server.url)
+        client = OpenAIClient(
+            "KEY", connection_pool=ConnectionPool(), api_base=api_base
+        )
+        assert client.request("GET", "/models")["data"]
+
+        async_client = AsyncOpenAIClient("KEY", api_base=api_base)
+        resp = asyncio.run(
+            async_client.request("POST", "/chat/completions", json_body=JSON_BODY)
+        )
+        assert resp["choices"][0]["message"]["content"] == "Proxied."
+
+
+def test_mock_server_streams_deltas(server):
+    client = AsyncOpenAIClient("KEY", api_base=parse_api_base(server.url))
+
+    async def stream():
+        return [
+            event["choices"][0]["delta"].get("content")
+            async for event in client.stream(
+                "POST", "/chat/completions", json_body=JSON_BODY
+            )
+        ]
+
+    deltas = asyncio.run(stream())
+    assert deltas[0] == ""
+    assert deltas[1:4] == ["Hello", " from", " the "]
+    assert "".join(d for d in deltas if d) == "Hello from the mock server."
+
+
+def test_mock_server_failures_are_retried(server):
+    server.config.fail_statuses = [429, 503]
+    client = OpenAIClient(
+        "KEY", connection_pool=ConnectionPool(), api_base=parse_api_base(server.url)
+    )
+    with patch("gpt_magic.retry.sleep"):
+        resp = client.request("POST", "/chat/completions", json_body=JSON_BODY)
+    assert resp["choices"][0]["message"]["content"] == "Hello from the mock server."
+    assert server.request_count == 3
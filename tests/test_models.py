@@ -0,0 +1,76 @@
+import json
+from time import time
+from unittest.mock import Mock, patch
+
+from gpt_magic.models import ModelCatalog, current_api_base
+
+MODELS = ["whisper-1", "gpt-3.5-turbo", "gpt-4", "gpt-4-0314", "gpt-3.5-turbo-0301"]
+
+
+def test_resolve_model_suffix(tmp_path):
+    fetch = Mock(return_value=MODELS)
+    catalog = ModelCatalog(tmp_path / "models.json", fetch=fetch)
+
+    assert catalog.resolve("gpt-4") == "gpt-4"
+    assert catalog.resolve("4") == "gpt-4"
+    assert catalog.resolve("turbo") == "gpt-3.5-turbo"
+    assert catalog.resolve("0301") == "gpt-3.5-turbo-0301"
+    assert catalog.chat_models() == MODELS[1:]
+    # Only chat models are resolved, even by their exact id.
+    assert catalog.resolve("whisper-1") is None
+    fetch.assert_called_once()
+
+
+def test_catalog_is_persisted(tmp_path):
+    path = tmp_path / "models.json"
+    ModelCatalog(path, fetch=Mock(return_value=MODELS)).models()
+
+    fetch = Mock()
+    catalog = ModelCatalog(path, fetch=fetch)
+    assert catalog.resolve("4") == "gpt-4"
+    fetch.assert_not_called()
+
+
+def test_stale_catalog_refreshes_in_background(tmp_path):
+    path = tmp_path / "models.json"
+    path.write_text(
+        json.dumps(
+            {
+                "api_base": current_api_base(),
+                "models": MODELS,
+                "fetched_at": time() - 10**6,
+            }
+        )
+    )
+
+    catalog = ModelCatalog(path, fetch=Mock(return_value=MODELS))
+    with patch.object(catalog, "refresh_in_background") as mocked_refresh:
+        assert catalog.resolve("4") == "gpt-4"
+    mocked_refresh.assert_called_once()
+
+
+def test_unknown_model_triggers_refresh(tmp_path):
+    fetch = Mock(side_effect=[MODELS, MODELS + ["gpt-5"]])
+    catalog = ModelCatalog(tmp_path / "models.json", fetch=fetch)
+    catalog.models()
+    catalog._fetched_at -= 3600
+
+    assert catalog.resolve("5") == "gpt-5"
+    assert catalog.resolve("nonexistent") is None
+    assert fetch.call_count == 2
+
+
+def test_catalog_belongs_to_its_api_base(tmp_path):
+    path = tmp_path / "models.json"
+    api_base = Mock(return_value="https://api.openai.com/v1")
+    ModelCatalog(path, fetch=Mock(return_value=MODELS), api_base=api_base).models()
+
+    api_base.return_value = "https://example.com/openai/v1"
+    fetch = Mock(return_value=["gpt-35-turbo"])
+    catalog = ModelCatalog(path, fetch=fetch, api_base=api_base)
+    assert catalog.models() == ["gpt-35-turbo"]
+
+    api_base.return_value = "https://api.openai.com/v1"
+    fetch.return_value = MODELS
+    assert catalog.resolve("4") == "gpt-4"
+    assert fetch.call_count == 2
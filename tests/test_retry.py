@@ -0,0 +1,97 @@
+from http.client import HTTPSConnection
+from unittest.mock import Mock, patch
+
+import pytest
+
+from gpt_magic.api_client import APIResponseException, ConnectionPool, OpenAIClient
+from gpt_magic.retry import (
+    RateLimiter,
+    RetryPolicy,
+    call_with_retry,
+    parse_duration,
+    parse_retry_after,
+)
+
+
+def test_parse_duration():
+    assert parse_duration("20ms") == pytest.approx(0.02)
+    assert parse_duration("1.5s") == 1.5
+    assert parse_duration("6m0s") == 360
+    assert parse_duration("2") == 2
+    assert parse_duration("soon") is None
+
+
+def test_parse_retry_after():
+    assert parse_retry_after({"Retry-After": "3"}) == 3
+    assert parse_retry_after({"retry-after-ms": "250"}) == 0.25
+    headers = {
+        "x-ratelimit-remaining-requests": "0",
+        "x-ratelimit-reset-requests": "1s",
+        "x-ratelimit-remaining-tokens": "10",
+        "x-ratelimit-reset-tokens": "6m0s",
+    }
+    assert parse_retry_after(headers) == 1
+    assert parse_retry_after({}) is None
+
+
+def test_rate_limiter_waits_when_budget_is_used_up():
+    limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=6000)
+    assert limiter.reserve(tokens=5000) == 0
+    # 1000 tokens short, refilled at 100 tokens per second.
+    assert limiter.reserve(tokens=2000) == pytest.approx(10, rel=0.01)
+
+
+def test_rate_limiter_learns_limits_from_headers():
+    limiter = RateLimiter()
+    assert limiter.reserve(tokens=10**6) == 0
+    limiter.update_from_headers(
+        {"x-ratelimit-limit-requests": "60", "x-ratelimit-remaining-requests": "0"}
+    )
+    assert limiter.reserve() == pytest.approx(1, rel=0.01)
+
+
+def _error(status, headers=None):
+    return APIResponseException("POST", "/", {}, None, "", b"", status, headers)
+
+
+def test_call_with_retry_honours_retry_after():
+    fn = Mock(side_effect=[_error(429, {"retry-after": "2"}), _error(503), "ok"])
+    with patch("gpt_magic.retry.sleep") as mocked_sleep:
+        assert call_with_retry(fn, limiter=RateLimiter()) == "ok"
+    assert fn.call_count == 3
+    assert 2 <= mocked_sleep.call_args_list[0][0][0] <= 2.1
+
+
+def test_retries_reserve_the_tokens_once():
+    limiter = RateLimiter(tokens_per_minute=1000)
+    fn = Mock(side_effect=[_error(429, {"retry-after": "0"}), _error(502), "ok"])
+    with patch("gpt_magic.retry.sleep"):
+        assert call_with_retry(fn, tokens=300, limiter=limiter) == "ok"
+    # Had each attempt reserved them, the budget would be overdrawn.
+    assert limiter.reserve(700) == 0
+
+
+def test_call_with_retry_gives_up():
+    for status in (400, 409):
+        fn = Mock(side_effect=_error(status))
+        with pytest.raises(APIResponseException):
+            call_with_retry(fn, limiter=RateLimiter())
+        assert fn.call_count == 1
+
+    fn = Mock(side_effect=_error(500))
+    with patch("gpt_magic.retry.sleep"), pytest.raises(APIResponseException):
+        call_with_retry(fn, policy=RetryPolicy(max_retries=2), limiter=RateLimiter())
+    assert fn.call_count == 3
+
+
+def test_api_client_retries_rate_limited_requests():
+    limited = Mock(status=429, will_close=False, headers={"retry-after": "0"})
+    limited.read.return_value = b'{"error": "rate limited"}'
+    ok = Mock(status=200, will_close=False, headers={})
+    ok.read.return_value = b'{"ok": true}'
+
+    with patch.object(HTTPSConnection, "request"), patch.object(
+        HTTPSConnection, "getresponse", side_effect=[limited, ok]
+    ), patch("gpt_magic.retry.sleep"):
+        client = OpenAIClient("VERY SECRET KEY", connection_pool=ConnectionPool())
+        assert client.request("GET", "/models") == {"ok": True}
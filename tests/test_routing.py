@@ -0,0 +1,97 @@
+from unittest.mock import patch
+
+from gpt_magic.gpt_command import gpt_command
+from gpt_magic.gpt_state import GPTMagicState
+from gpt_magic.metrics import MetricsRecorder, RequestMetrics
+from gpt_magic.routing import RoutingPolicy, estimate_prompt_tokens, model_family
+
+
+def _record_ttfts(recorder, model, ttfts):
+    for ttft in ttfts:
+        recorder.record(
+            RequestMetrics("completion", "/chat/completions", model, ttft=ttft)
+        )
+
+
+def test_routes_by_prompt_size_and_request_type():
+    policy = RoutingPolicy(
+        prose_models=["gpt-3.5-turbo"], code_models=["gpt-4", "gpt-4-32k"]
+    )
+    assert policy.route(100, False, "gpt-4").model == "gpt-3.5-turbo"
+    assert policy.route(100, True, "gpt-3.5-turbo").model == "gpt-4"
+
+    decision = policy.route(10_000, True, "gpt-3.5-turbo")
+    assert decision.model == "gpt-4-32k"
+    assert decision.considered["gpt-4"] == "too small, context window 8192"
+
+    decision = policy.route(10_000, False, "gpt-3.5-turbo")
+    assert decision.model == "gpt-3.5-turbo-16k"
+    assert decision.reason == "fallback, the candidates are too small"
+
+    decision = policy.route(100_000, False, "gpt-3.5-turbo")
+    assert decision.model == "gpt-3.5-turbo-16k"
+    assert decision.reason == "nothing fits, largest context window"
+
+
+def test_fallbacks_stay_in_the_default_models_family():
+    assert model_family("gpt-4-32k-0613") == "gpt-4"
+    assert model_family("gpt-3.5-turbo-16k") == "gpt-3.5-turbo"
+
+    policy = RoutingPolicy()
+    assert policy.route(10_000, False, "gpt-4").model == "gpt-4-32k"
+    assert policy.route(10_000, False, "gpt-3.5-turbo").model == "gpt-3.5-turbo-16k"
+    decision = policy.route(10_000, False, "gpt-4-0613")
+    assert decision.model == "gpt-4-32k"
+    assert "gpt-3.5-turbo-16k" not in decision.considered
+
+
+def test_slow_models_are_passed_over():
+    recorder = MetricsRecorder()
+    policy = RoutingPolicy(prose_models=["gpt-4", "gpt-3.5-turbo"], max_ttft=1.0)
+    # Too few samples to judge.
+    _record_ttfts(recorder, "gpt-4", [3.0, 3.0])
+    assert policy.route(100, False, "gpt-4", recorder).model == "gpt-4"
+
+    _record_ttfts(recorder, "gpt-4", [3.0])
+    decision = policy.route(100, False, "gpt-4", recorder)
+    assert decision.model == "gpt-3.5-turbo"
+    assert decision.considered["gpt-4"] == "slow, median ttft 3.00s"
+
+    _record_ttfts(recorder, "gpt-3.5-turbo", [5.0, 5.0, 5.0])
+    decision = policy.route(100, False, "gpt-4", recorder)
+    assert (decision.model, decision.reason) == ("gpt-4", "all slow, the fastest")
+
+
+def test_gpt_command_routes_large_prompts(capsys):
+    state = GPTMagicState()
+    history = [(1, "df", "x " * 5000)]
+    assert estimate_prompt_tokens([], "Describe it", history) > 5000
+    chunks = [{"choices": [{"delta": {"content": "Hi"}}]}]
+
+    with patch("openai.ChatCompletion.create", return_value=chunks) as create, patch(
+        "gpt_magic.gpt_command.get_ipython_history", return_value=history
+    ):
+        gpt_command(state, "--debug --no-cache -s 'Describe it'")
+
+    assert create.call_args.kwargs["model"] == "gpt-3.5-turbo-16k"
+    out = capsys.readouterr().out
+    assert "Routed to gpt-3.5-turbo-16k (fallback, the candidates are too small)" in out
+    assert "gpt-3.5-turbo: too small, context window 4096" in out
+
+
+def test_gpt_command_notes_a_routed_model(capsys):
+    state = GPTMagicState(default_model="gpt-4")
+    history = [(1, "df", "x " * 9000)]
+    chunks = [{"choices": [{"delta": {"content": "Hi"}}]}]
+
+    with patch("openai.ChatCompletion.create", return_value=chunks) as create, patch(
+        "gpt_magic.gpt_command.get_ipython_history", return_value=history
+    ):
+        gpt_command(state, "--no-cache -s 'Describe it'")
+        assert create.call_args.kwargs["model"] == "gpt-4-32k"
+        gpt_command(state, "--no-cache 'Hello'")
+        assert create.call_args.kwargs["model"] == "gpt-4"
+
+    out = capsys.readouterr().out
+    assert out.count("Using gpt-4-32k (fallback, the candidates are too small).") == 1
+    assert "Using gpt-4 " not in out
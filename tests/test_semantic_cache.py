@@ -0,0 +1,117 @@
+from unittest.mock import patch
+
+import pytest
+
+from gpt_magic.cache import DiskCache, ResponseCache
+from gpt_magic.gpt_command import gpt_command
+from gpt_magic.gpt_state import Conversation, GPTMagicState
+from gpt_magic.semantic_cache import SemanticCache, hashed_ngram_embedder
+
+pytest.importorskip("numpy")
+
+
+def _cache(**kwargs):
+    return SemanticCache(hashed_ngram_embedder(), **kwargs)
+
+
+def test_reworded_prompts_hit_within_the_same_context():
+    cache = _cache(threshold=0.6)
+    cache.put("ctx", "plot df histogram", "df.hist()")
+
+    response, similarity, _ = cache.lookup("ctx", "histogram of df, plotted")
+    assert response == "df.hist()"
+    assert similarity >= 0.6
+    assert cache.lookup("ctx", "read the csv file into a dataframe")[0] is None
+    assert cache.lookup("other", "plot df histogram")[0] is None
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = _cache(threshold=0.99, max_entries=2)
+    cache.put("ctx", "first prompt", "1")
+    cache.put("ctx", "second prompt", "2")
+    cache.lookup("ctx", "first prompt")
+    cache.put("ctx", "third prompt", "3")
+
+    assert len(cache) == 2
+    assert cache.lookup("ctx", "first prompt")[0] == "1"
+    assert cache.lookup("ctx", "second prompt")[0] is None
+    assert cache.lookup("ctx", "third prompt")[0] == "3"
+
+
+def _reply(**kwargs):
+    return {"choices": [{"message": {"content": "df.hist()"}}]}
+
+
+def test_do_completion_uses_the_semantic_cache():
+    cache = _cache(threshold=0.6)
+    with patch("openai.ChatCompletion.create", side_effect=_reply) as create:
+        convo = Conversation("A", "system")
+        convo.add_prompt("plot df histogram", False, [])
+        convo.complete("gpt-3.5-turbo", semantic_cache=cache)
+        assert convo.head.cache_hit is None
+
+        convo = Conversation("B", "system")
+        convo.add_prompt("histogram of df", False, [])
+        assert convo.complete("gpt-3.5-turbo", semantic_cache=cache) == "df.hist()"
+        assert convo.head.cache_hit == "similar"
+
+        # A different model is a different context.
+        convo = Conversation("C", "system")
+        convo.add_prompt("histogram of df", False, [])
+        convo.complete("gpt-4", semantic_cache=cache)
+        assert convo.head.cache_hit is None
+    assert create.call_count == 2
+
+
+def test_failing_embedder_is_a_miss():
+    def embed(texts):
+        raise ConnectionError("no network")
+
+    convo = Conversation("A", "system")
+    convo.add_prompt("plot df histogram", False, [])
+    with patch("openai.ChatCompletion.create", side_effect=_reply):
+        assert convo.complete("gpt-3.5-turbo", semantic_cache=SemanticCache(embed))
+
+
+def test_cache_hits_are_labelled(capsys, tmp_path):
+    state = GPTMagicState(response_cache=ResponseCache(disk=DiskCache(tmp_path)))
+    state.semantic_cache = _cache(threshold=0.6)
+    chunks = [{"choices": [{"delta": {"content": "df.hist()"}}]}]
+    with patch("openai.ChatCompletion.create", return_value=chunks):
+        gpt_command(state, "'plot df histogram'")
+    first = state.last_convo_key
+    with patch("openai.ChatCompletion.create") as create:
+        gpt_command(state, "'histogram of df'")
+
+    create.assert_not_called()
+    out = capsys.readouterr().out
+    assert f"GPT[{first}0]: df.hist()" in out
+    assert f"GPT[{state.last_convo_key}0] (cached): df.hist()" in out
+
+
+def test_shown_cells_must_match(tmp_path):
+    cells = [
+        (1, "df = pd.read_csv('sales.csv')", "None"),
+        (2, "df.head()", "   region  price  units\n0  north   9.5     3"),
+    ]
+    state = GPTMagicState(response_cache=ResponseCache(disk=DiskCache(tmp_path)))
+    state.semantic_cache = _cache(threshold=0.6)
+
+    def ask(prompt, history=cells):
+        chunks = [{"choices": [{"delta": {"content": f"Answer to {prompt}"}}]}]
+        with patch(
+            "gpt_magic.gpt_command.get_ipython_history", return_value=history
+        ), patch("openai.ChatCompletion.create", return_value=chunks):
+            gpt_command(state, f"-s 2 '{prompt}'")
+        return state.conversations[state.last_convo_key].get_message()
+
+    assert ask("plot a histogram of units") == "Answer to plot a histogram of units"
+    assert ask("plot histogram of the units") == "Answer to plot a histogram of units"
+    # Other questions about the same cells, and the same question about other cells,
+    # aren't answered from the cache.
+    for prompt in ["compute the mean price per region", "drop rows where units is 0"]:
+        assert ask(prompt) == f"Answer to {prompt}"
+    changed = [cells[0], (2, "df.head()", "   region  price  units\n0  south   1.0  7")]
+    assert ask("plot the histogram of units", changed).endswith(
+        "the histogram of units"
+    )
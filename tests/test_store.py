@@ -0,0 +1,66 @@
+from itertools import islice
+from unittest.mock import patch
+
+from gpt_magic.gpt_state import GPTMagicState
+from gpt_magic.utils import excel_style_column_name_seq
+
+
+def _fake_create(messages, **kwargs):
+    return {"choices": [{"message": {"content": f"Reply {len(messages)}"}}]}
+
+
+def _new_state(tmp_path, notebook="notebook.ipynb"):
+    state = GPTMagicState()
+    state.enable_store(tmp_path / "conversations.sqlite3", notebook)
+    return state
+
+
+def test_excel_style_column_name_seq_start():
+    assert list(islice(excel_style_column_name_seq(), 3)) == ["A", "B", "C"]
+    assert list(islice(excel_style_column_name_seq(25), 3)) == ["Z", "AA", "AB"]
+    assert next(excel_style_column_name_seq(26 + 26 * 26)) == "AAA"
+
+
+def test_conversations_are_resumed(tmp_path):
+    state = _new_state(tmp_path)
+    with patch("openai.ChatCompletion.create", side_effect=_fake_create):
+        convo = state.get_convo((None, None))
+        convo.add_prompt("First", False, [])
+        convo.complete("gpt-3.5-turbo")
+        convo.add_prompt("Second", True, [])
+        convo.complete("gpt-3.5-turbo")
+        # Branch off the first message.
+        convo = state.get_convo(("A", 0))
+        convo.add_prompt("Third", False, [])
+        convo.complete("gpt-3.5-turbo")
+        state.get_convo((None, None))
+        state.get_convo(("A", None))
+    state.store.close()
+
+    state = _new_state(tmp_path)
+    assert state.conversations.loaded_keys() == []
+    assert state.last_convo_key == "A"
+    assert list(state.conversations) == ["A", "B"]
+
+    convo = state.get_convo(("A", None))
+    assert state.conversations.loaded_keys() == ["A"]
+    assert convo.store is state.store
+    assert convo.context_policy is state.context_policy
+    assert convo.system_message.startswith("You are a helpful Python")
+    assert convo.user_messages == ["First", "Third"]
+    assert convo.assistant_messages == ["Reply 2", "Reply 4"]
+    assert convo.nodes[1].user == "Second"
+    assert convo.nodes[1].assistant == "Reply 4"
+
+    # Keys carry on from where the previous session left off.
+    assert state.get_convo((None, None)).key == "C"
+
+
+def test_notebooks_are_isolated(tmp_path):
+    state = _new_state(tmp_path, "one.ipynb")
+    state.get_convo((None, None)).add_prompt("Hello", False, [])
+
+    other = _new_state(tmp_path, "two.ipynb")
+    assert list(other.conversations) == []
+    assert other.last_convo_key is None
+    assert other.get_convo((None, None)).key == "A"
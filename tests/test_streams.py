@@ -0,0 +1,154 @@
+from threading import Event
+from unittest.mock import patch
+
+import openai
+import pytest
+
+from gpt_magic.background import run_in_background
+from gpt_magic.displays import ShellDisplay
+from gpt_magic.gpt_command import gpt_command
+from gpt_magic.gpt_state import RESUME_PROMPT, GPTMagicState
+from gpt_magic.metrics import MetricsRecorder
+from gpt_magic.mock_server import MockOpenAIServer, MockServerConfig
+
+
+def _chunks(deltas, interrupt_after=None):
+    for i, delta in enumerate(deltas):
+        if i == interrupt_after:
+            raise KeyboardInterrupt
+        yield {"choices": [{"delta": {"content": delta}}]}
+
+
+def test_interrupted_command_keeps_partial_response_and_resumes(capsys):
+    state = GPTMagicState()
+    state.metrics = MetricsRecorder()
+    interrupted = _chunks(["Once ", "upon ", "a ", "time"], interrupt_after=2)
+
+    with patch("openai.ChatCompletion.create", return_value=interrupted):
+        with pytest.raises(KeyboardInterrupt):
+            gpt_command(state, "--no-cache 'Tell me a story'")
+
+    convo = state.conversations[state.last_convo_key]
+    assert convo.get_message() == "Once upon "
+    assert convo.head.truncated
+    assert f"%%gpt --resume {convo.key}0" in capsys.readouterr().out
+    [metrics] = state.metrics.records()
+    assert metrics.cancelled and metrics.error is None
+
+    with patch(
+        "openai.ChatCompletion.create", return_value=_chunks(["a ", "time"])
+    ) as create:
+        gpt_command(state, "--resume --no-cache")
+
+    request_messages = create.call_args.kwargs["messages"]
+    assert request_messages[-2] == {"role": "assistant", "content": "Once upon "}
+    assert request_messages[-1] == {"role": "user", "content": RESUME_PROMPT}
+    assert convo.get_message() == "Once upon a time"
+    assert not convo.head.truncated
+    assert capsys.readouterr().out.endswith("Once upon a time\n")
+
+    gpt_command(state, "--resume")
+    assert "nothing to resume" in capsys.readouterr().out
+
+
+def test_resumed_reply_is_sent_by_followups(capsys):
+    state = GPTMagicState()
+    interrupted = _chunks(["Once ", "upon ", "a ", "time"], interrupt_after=2)
+    with patch("openai.ChatCompletion.create", return_value=interrupted):
+        with pytest.raises(KeyboardInterrupt):
+            gpt_command(state, "--no-cache 'Tell me a story'")
+    key = state.last_convo_key
+
+    replies = [_chunks(["Next"]), _chunks(["More"]), _chunks(["a ", "time"])]
+    with patch("openai.ChatCompletion.create", side_effect=replies):
+        gpt_command(state, f"-f {key}0 --no-cache 'next'")
+        gpt_command(state, f"-f {key}1 --no-cache 'more'")
+        gpt_command(state, f"--resume {key}0 --no-cache")
+    with patch(
+        "openai.ChatCompletion.create", return_value=_chunks(["More"])
+    ) as create:
+        gpt_command(state, f"-f {key}1 --no-cache 'more again'")
+
+    request_messages = create.call_args.kwargs["messages"]
+    assert request_messages[2] == {"role": "assistant", "content": "Once upon a time"}
+
+
+class _InterruptedDisplay(ShellDisplay):
+    """Interrupted while rendering the second delta."""
+
+    def stream_renderer(self, *args, **kwargs):
+        renderer = super().stream_renderer(*args, **kwargs)
+        feed = renderer.feed
+        n_fed = []
+
+        def interrupting_feed(delta):
+            n_fed.append(delta)
+            if len(n_fed) == 2:
+                raise KeyboardInterrupt
+            feed(delta)
+
+        renderer.feed = interrupting_feed
+        return renderer
+
+
+def test_interrupting_the_command_hangs_up(monkeypatch, capsys):
+    monkeypatch.setattr(openai, "api_key", "sk-mock")
+    config = MockServerConfig(tokens_per_second=50)
+    state = GPTMagicState()
+    with MockOpenAIServer(config) as server, patch(
+        "gpt_magic.gpt_command.get_registered_display", _InterruptedDisplay
+    ):
+        monkeypatch.setattr(openai, "api_base", server.url)
+        with pytest.raises(KeyboardInterrupt) as exc_info:
+            gpt_command(state, "--no-cache 'Testing message'")
+
+        # The server notices straight away, rather than streaming the whole reply,
+        # although the traceback (kept by IPython as `sys.last_traceback`) refers to
+        # the stream.
+        assert exc_info.tb is not None
+        assert server.disconnected.wait(timeout=2)
+
+    convo = state.conversations[state.last_convo_key]
+    assert len(convo.get_message()) == 8
+    assert convo.head.truncated
+
+
+def test_cancel_running_background_completion():
+    state = GPTMagicState()
+    convo = state.get_convo((None, None))
+    started, cancelled = Event(), Event()
+
+    def chunks():
+        yield {"choices": [{"delta": {"content": "Hel"}}]}
+        started.set()
+        cancelled.wait(timeout=5)
+        yield {"choices": [{"delta": {"content": "lo"}}]}
+        yield {"choices": [{"delta": {"content": " there"}}]}
+
+    with patch("openai.ChatCompletion.create", return_value=chunks()):
+        completion = run_in_background(
+            state, convo, "Testing message", [], "gpt-3.5-turbo", ShellDisplay()
+        )
+        assert started.wait(timeout=5)
+        assert completion.cancel()
+        cancelled.set()
+        # Whatever arrived before the cancellation was noticed is kept.
+        assert completion.result(timeout=5) == "Hello"
+
+    assert convo.head.truncated
+    assert repr(completion) == f"<GPT[{convo.key}0] cancelled>"
+
+
+def test_truncated_replies_are_stored(tmp_path):
+    state = GPTMagicState()
+    state.enable_store(tmp_path / "conversations.sqlite3", "notebook.ipynb")
+    convo = state.get_convo((None, None))
+    convo.add_prompt("Testing message", False, [])
+    convo.add_response("Partial", truncated=True)
+    state.store.close()
+
+    state = GPTMagicState()
+    state.enable_store(tmp_path / "conversations.sqlite3", "notebook.ipynb")
+    convo = state.get_convo(("A", None))
+    assert convo.get_message() == "Partial"
+    assert convo.head.truncated
@@ -3,11 +3,15 @@ from unittest.mock import MagicMock, patch
 from gpt_magic.api_client import OpenAIClient
 from gpt_magic.subcommands import ChatCommand
 
+RESPONSE = {"choices": [{"message": {"role": "assistant", "content": "Test response"}}]}
+
 
 def test_basic_chat_command():
     SYSTEM_MESSAGE = "You're a python data science coding assistant"
     GPT_MODEL = "gpt-3.5-turbo"
-    with patch.object(OpenAIClient, "request", MagicMock()) as mocked_request:
+    with patch.object(
+        OpenAIClient, "request", MagicMock(return_value=RESPONSE)
+    ) as mocked_request:
         context = {
             "config": {
                 "openai_api_key": "VERY SECRET KEY",
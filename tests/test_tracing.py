@@ -0,0 +1,73 @@
+import json
+from unittest.mock import patch
+
+from gpt_magic.gpt_command import gpt_command
+from gpt_magic.gpt_state import GPTMagicState
+from gpt_magic.models import ModelCatalog
+from gpt_magic.tracing import Tracer
+
+
+def test_disabled_tracer_records_nothing():
+    tracer = Tracer()
+    with tracer.span("stage") as span:
+        span.set(n=1)
+    assert tracer.spans() == []
+
+
+def test_spans_are_exported(tmp_path):
+    tracer = Tracer(enabled=True)
+    with tracer.span("outer", key="A0"):
+        with tracer.span("inner") as span:
+            span.set(deltas=3)
+
+    inner, outer = tracer.spans()
+    assert (inner.name, inner.args) == ("inner", {"deltas": 3})
+    assert outer.args == {"key": "A0"}
+    assert outer.start_us <= inner.start_us
+    assert inner.duration_us <= outer.duration_us
+
+    tracer.export(str(tmp_path / "trace.json"))
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    assert [(e["name"], e["ph"]) for e in events] == [("inner", "X"), ("outer", "X")]
+
+    tracer.export(str(tmp_path / "trace.jsonl"))
+    lines = (tmp_path / "trace.jsonl").read_text().splitlines()
+    assert [json.loads(line)["name"] for line in lines] == ["inner", "outer"]
+
+
+def test_gpt_command_stages_are_traced(capsys):
+    state = GPTMagicState(tracer=Tracer())
+    gpt_command(state, "--trace on")
+    chunks = [{"choices": [{"delta": {"content": c}}]} for c in ["Hel", "lo"]]
+    with patch("openai.ChatCompletion.create", return_value=chunks):
+        gpt_command(state, "--no-cache 'Testing message'")
+
+    # Only the second command ran with tracing enabled.
+    names = [span.name for span in state.tracer.spans()]
+    assert names == [
+        "parse_args",
+        "route_model",
+        "wait_for_conversation",
+        "add_prompt",
+        "render",
+        "render",
+        "stream",
+        "render_finish",
+        "gpt_command",
+    ]
+    assert state.tracer.spans()[-3].args == {"model": "gpt-3.5-turbo", "deltas": 2}
+    assert "Hello" in capsys.readouterr().out
+
+
+def test_model_resolution_is_traced(tmp_path):
+    catalog = ModelCatalog(tmp_path / "models.json", fetch=lambda: ["gpt-4"])
+    state = GPTMagicState(tracer=Tracer(enabled=True))
+    chunks = [{"choices": [{"delta": {"content": "Hello"}}]}]
+    with patch("gpt_magic.gpt_command.get_model_catalog", return_value=catalog), patch(
+        "openai.ChatCompletion.create", return_value=chunks
+    ) as create:
+        gpt_command(state, "-m 4 --no-cache 'x'")
+
+    assert create.call_args.kwargs["model"] == "gpt-4"
+    (span,) = [s for s in state.tracer.spans() if s.name == "resolve_model"]
+    assert span.args == {"model": "4"}